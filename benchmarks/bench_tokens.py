@@ -0,0 +1,194 @@
+"""
+Offline microbenchmarks for the token generation hot paths.
+
+Runs against stubbed tenants and a generated RSA key (see stubs.py), so no Tapis site is needed:
+
+    python -m benchmarks.bench_tokens                       # run and compare with benchmarks/baseline.json, if any
+    python -m benchmarks.bench_tokens --output results.json # also write the results
+    python -m benchmarks.bench_tokens --save-baseline       # store the results as the new baseline
+
+The results are JSON: for each case, the median and minimum time per operation, in microseconds, over several
+rounds, and the median relative to that of the `calibration` case, a fixed pure-Python workload measured in the same
+run. When a baseline is available, the process exits with status 1 if the relative median of any case is higher than
+the baseline's by more than --threshold (a fraction; 0.25 by default). Comparing relative times makes the comparison
+less sensitive to the speed of the machine, but a baseline is still best generated on the same machine, e.g., by
+running the benchmarks on the base revision first in the same CI job. No baseline is committed to the repository.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from benchmarks.stubs import bootstrap
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# the case the other cases are timed relative to --
+CALIBRATION_CASE = 'calibration'
+
+
+def measure(fn, rounds, min_time):
+    """
+    Time `fn`: calibrate the number of calls per round so that a round takes at least `min_time` seconds, then run
+    `rounds` rounds.
+    :return: dict with the median and minimum time per call, in microseconds, and the calls per round.
+    """
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {'median_us': statistics.median(timings),
+            'min_us': min(timings),
+            'number': number,
+            'rounds': rounds}
+
+
+def get_cases():
+    """
+    Build the benchmark cases. Imports the service modules, so bootstrap() must have been called.
+    :return: dict mapping case name to a function of no arguments.
+    """
+    from types import SimpleNamespace
+
+    from service import tenants
+    from service.auth import validate_refresh_token
+    from service.controllers import TokensResource
+    from service.keys import signing_keys
+    from service.models import TapisAccessToken
+    from service.signing import pyjwt_encode, tapis_encode
+    from service.validation import new_token_request_validator
+
+    tenants.reload_tenants()
+
+    def new_token_body(num_claims=0):
+        body = {'token_tenant_id': 'dev',
+                'account_type': 'user',
+                'token_username': 'jdoe',
+                'generate_refresh_token': True}
+        if num_claims:
+            body['claims'] = {f'claim_{i}': f'value_{i}' for i in range(num_claims)}
+        return body
+
+    validated_body = SimpleNamespace(**new_token_body(num_claims=5))
+    token_data = TapisAccessToken.get_derived_values(validated_body)
+    access_token = TapisAccessToken(**token_data)
+    access_token.sign_token()
+    refresh_token = TokensResource.get_refresh_from_access_token_data(dict(token_data), access_token)
+    claims = access_token.claims_to_dict()
+    key = signing_keys.get_key(tenants.get_tenant_config('dev'))
+
+    def sign_token():
+        TapisAccessToken(**token_data).sign_token()
+
+    def refresh_claims():
+        # the claims work of PUT /v3/tokens: verify the refresh token and rebuild the new access token from it --
+        refresh_token_data = validate_refresh_token(refresh_token.jwt)
+        new_token_data = TapisAccessToken.get_data_from_refresh_claims(refresh_token_data['tapis/access_token'])
+        TapisAccessToken(**new_token_data).claims_to_dict()
+
+    cases = {
+        'get_derived_values': lambda: TapisAccessToken.get_derived_values(validated_body),
+        'claims_to_dict': access_token.claims_to_dict,
+        'sign_token': sign_token,
+        'tapis_encode': lambda: tapis_encode(claims, key),
+        'pyjwt_encode': lambda: pyjwt_encode(claims, key),
+        'get_refresh_from_access_token_data':
+            lambda: TokensResource.get_refresh_from_access_token_data(dict(token_data), access_token),
+        'refresh_claims': refresh_claims,
+    }
+    for num_claims in (0, 10, 100):
+        body = new_token_body(num_claims)
+        cases[f'validate_new_token_request_{num_claims}_claims'] = \
+            lambda body=body: new_token_request_validator.validate(body)
+    return cases
+
+
+def calibration():
+    """
+    A fixed pure-Python workload; the other cases are compared with a baseline relative to its time.
+    """
+    return sorted(str(i * 7919 % 1000) for i in range(1000))
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with a baseline, using the medians relative to the calibration case.
+    :return: list of (case, baseline median, current median, relative change) for the cases that regressed.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base or name == CALIBRATION_CASE or 'relative' not in base:
+            continue
+        change = result['relative'] / base['relative'] - 1
+        if change > threshold:
+            regressions.append((name, base['median_us'], result['median_us'], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline microbenchmarks for the Tokens API.')
+    parser.add_argument('--rounds', type=int, default=7, help='number of timed rounds per case.')
+    parser.add_argument('--min-time', type=float, default=0.1, help='minimum duration of a round, in seconds.')
+    parser.add_argument('--cases', nargs='*', help='only run the cases whose name contains one of these strings.')
+    parser.add_argument('--output', help='path to write the results to, as JSON.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the baseline results.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fail when a case is slower than the baseline by more than this fraction.')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline.')
+    args = parser.parse_args(argv)
+
+    bootstrap()
+    cases = get_cases()
+    if args.cases:
+        cases = {name: fn for name, fn in cases.items() if any(c in name for c in args.cases)}
+    cases = dict({CALIBRATION_CASE: calibration}, **cases)
+    results = {'python': platform.python_version(),
+               'machine': platform.machine(),
+               'results': {}}
+    for name, fn in cases.items():
+        result = measure(fn, args.rounds, args.min_time)
+        results['results'][name] = result
+        result['relative'] = result['median_us'] / results['results'][CALIBRATION_CASE]['median_us']
+        print(f"{name:45} median {result['median_us']:10.1f} us   min {result['min_us']:10.1f} us   "
+              f"relative {result['relative']:8.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.baseline}.")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; skipping the comparison.")
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for name, base, current, change in regressions:
+        print(f"REGRESSION {name}: {base:.1f} us -> {current:.1f} us (+{change:.0%} relative to {CALIBRATION_CASE})")
+    if regressions:
+        return 1
+    print(f"no regressions beyond {args.threshold:.0%} of the baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
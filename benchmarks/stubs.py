@@ -0,0 +1,105 @@
+"""
+Offline bootstrap for the benchmarks: generates an RSA signing key, writes a service config for a stubbed site and
+replaces the Tenants API client used by the tenant cache with a stub, so that the service modules can be imported
+and exercised without a Tapis site.
+
+bootstrap() must be called before anything imports tapisservice or the service package.
+"""
+import json
+import os
+import tempfile
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SITE_ID = 'bench'
+ADMIN_TENANT_ID = 'admin'
+
+
+def generate_rsa_private_key():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(encoding=serialization.Encoding.PEM,
+                             format=serialization.PrivateFormat.PKCS8,
+                             encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+
+def get_stub_tenants(tenant_ids):
+    """
+    Tenant and site descriptions, as returned by the Tenants API, for a single (primary) site owning `tenant_ids`.
+    """
+    site = {'site_id': SITE_ID,
+            'primary': True,
+            'base_url': f'https://{SITE_ID}.tapis.example',
+            'site_admin_tenant_id': ADMIN_TENANT_ID,
+            'services': ['tokens']}
+    tenants = [{'tenant_id': tenant_id,
+                'site_id': SITE_ID,
+                'base_url': f'https://{tenant_id}.{SITE_ID}.tapis.example',
+                'token_service': f'https://{tenant_id}.{SITE_ID}.tapis.example/v3/tokens',
+                'security_kernel': f'https://{tenant_id}.{SITE_ID}.tapis.example/v3/security',
+                'public_key': None,
+                'status': 'active'} for tenant_id in tenant_ids]
+    return site, tenants
+
+
+def bootstrap(tenant_ids=('admin', 'dev'), config=None):
+    """
+    Configure the service to run offline against stubbed tenants.
+    :param tenant_ids: the tenants of the stubbed site; the first must be the site admin tenant.
+    :param config: optional dict of additional config values.
+    :return: the service config dict written.
+    """
+    service_config = {
+        'service_name': 'tokens',
+        'primary_site_admin_tenant_base_url': f'https://{ADMIN_TENANT_ID}.{SITE_ID}.tapis.example',
+        'service_site_id': SITE_ID,
+        'service_tenant_id': ADMIN_TENANT_ID,
+        'use_sk': False,
+        'tenants': list(tenant_ids),
+        'log_level': 'WARNING',
+        'use_allservices_password': False,
+        'site_admin_privatekey': generate_rsa_private_key(),
+    }
+    service_config.update(config or {})
+    config_dir = tempfile.mkdtemp(prefix='tokens-bench-')
+    config_path = os.path.join(config_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(service_config, f)
+    os.environ['TAPIS_CONFIG_PATH'] = config_path
+    os.environ['TAPIS_CONFIGSCHEMA_PATH'] = os.path.join(REPO_DIR, 'configschema.json')
+    os.environ['TAPIS_API_SPEC_PATH'] = os.path.join(REPO_DIR, 'service', 'resources', 'openapi_v3.yml')
+    install_stub_tenants_api(tenant_ids)
+    return service_config
+
+
+def install_stub_tenants_api(tenant_ids):
+    """
+    Make the tenant caches (tapisservice's and the service's) read the stubbed tenants instead of calling the
+    Tenants API.
+    """
+    import tapipy.tapis
+    from tapipy.tapis import TapisResult
+
+    site, tenants = get_stub_tenants(tenant_ids)
+
+    class StubTenantsResource(object):
+        def list_tenants(self, **kwargs):
+            return [TapisResult(**tenant) for tenant in tenants]
+
+        def list_sites(self, **kwargs):
+            return [TapisResult(**site)]
+
+    class StubTapis(object):
+        def __init__(self, base_url=None, **kwargs):
+            self.base_url = base_url
+            self.tenants = StubTenantsResource()
+
+    real_tapis = tapipy.tapis.Tapis
+    tapipy.tapis.Tapis = StubTapis
+    try:
+        # the tenant cache module binds Tapis when it is imported, and keeps the stub for later reloads --
+        import tapisservice.tenants
+    finally:
+        tapipy.tapis.Tapis = real_tapis
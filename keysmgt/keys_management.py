@@ -28,7 +28,12 @@ sys.path.extend(['/home/tapis/service', '/home/tapis/keymgtService', '/home/tapi
 # from tenantsService.service.models import Tenant, TenantHistory
 
 # "service" here is the original tokens api service package:
-from service.auth import t, generate_private_keypair_in_sk
+from service import auth
+from service.auth import generate_private_keypair_in_sk
+from service.factory import create_app
+# initialize the tenants, the tokens service client and the signing keys --
+create_app()
+t = auth.t
 valid_tenants = [tn.tenant_id for tn in t.tenant_cache.tenants]
 
 DATA_DIR = os.environ.get('DATA_DIR', '/home/tapis/data')
@@ -53,8 +58,11 @@ def create_keys_for_tenant(tenant_id):
     Calls the SK to generate a new public/private key pair for a given tenant id
     """
     print(f"Top of create_keys_for_tenant for tenant: {tenant_id}")
+    # the type of key generated matches the tenant's signing algorithm (RS256 unless configured otherwise)
+    alg = conf.tenant_signing_algorithms.get(tenant_id, 'RS256')
+    print(f"Generating {alg} keys for tenant {tenant_id}")
     try:
-        priv_key, pub_key = generate_private_keypair_in_sk(tenant_id)
+        priv_key, pub_key = generate_private_keypair_in_sk(tenant_id, alg)
     except Exception as e:
         print(f"Got exception trying to generate keypair; e: {e}")
         raise e
@@ -0,0 +1,313 @@
+"""
+Load driver for the Tokens API: replays a weighted mix of operations at a target rate and reports the throughput and
+the p50/p95/p99 latency of each operation. The operations are:
+  - post: generate a user access and refresh token (POST /v3/tokens) as a service, with its service token.
+  - refresh: refresh a previously generated token (PUT /v3/tokens).
+  - revoke: revoke a previously generated access token (POST /v3/tokens/revoke).
+  - keys: rotate the signing key of the user tokens' tenant (PUT /v3/tokens/keys).
+
+For example, against a Tokens API configured for the stand-in (see loadtest/standin.py):
+
+    python -m loadtest.driver --url http://localhost:5001 --rate 100 --duration 60 \\
+        --mix post=70,refresh=25,revoke=5 --output results.json
+
+The load is open-loop: requests are started on a fixed schedule whether or not the earlier ones have completed, and
+latencies are measured from the time each request was scheduled, so that time spent queued in the driver when the
+API falls behind is counted instead of hidden. The driver reports the number of requests that started late (by more
+than --late-threshold) so that a saturated driver can be told apart from a slow API. (This deliberately deviates
+from a closed-loop driver, where a fixed number of clients each wait for a response before sending the next
+request: a closed loop slows down with the API, which hides queueing delays from the latencies.)
+
+A key rotation empties the pool of tokens used by the refresh and revoke operations, since tokens signed with the old
+key can no longer be refreshed or revoked; refreshes or revocations already in flight can still fail with a 400.
+"""
+import argparse
+import collections
+import itertools
+import json
+import math
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+OPERATIONS = ('post', 'refresh', 'revoke', 'keys')
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def parse_mix(value):
+    """
+    Parse an operation mix, e.g., "post=70,refresh=25,revoke=5", into a dict of weights.
+    """
+    mix = {}
+    for item in value.split(','):
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'unknown operation "{operation}"; expected one of '
+                                             f'{", ".join(OPERATIONS)}.')
+        try:
+            mix[operation] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid weight for {operation}: "{weight}".')
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError('the mix needs at least one operation with a positive weight.')
+    return mix
+
+
+class Results(object):
+    """
+    Latencies and outcomes of the requests, per operation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.late = 0
+
+    def record(self, operation, latency, status):
+        with self.lock:
+            self.statuses[operation][status] += 1
+            if isinstance(status, int) and status < 400:
+                self.latencies[operation].append(latency)
+
+    def summary(self, elapsed):
+        """
+        :return: dict with the overall and per operation throughput, errors and latency percentiles (in ms).
+        """
+        def summarize(latencies, statuses):
+            latencies = sorted(latencies)
+            count = sum(statuses.values())
+            return {'requests': count,
+                    'errors': count - len(latencies),
+                    'throughput': count / elapsed if elapsed else 0.0,
+                    'statuses': {str(status): n for status, n in statuses.items()},
+                    'p50_ms': _ms(percentile(latencies, 0.50)),
+                    'p95_ms': _ms(percentile(latencies, 0.95)),
+                    'p99_ms': _ms(percentile(latencies, 0.99)),
+                    'max_ms': _ms(latencies[-1] if latencies else None)}
+
+        with self.lock:
+            operations = {operation: summarize(self.latencies[operation], statuses)
+                          for operation, statuses in self.statuses.items()}
+            all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+            all_statuses = collections.Counter()
+            for statuses in self.statuses.values():
+                all_statuses.update(statuses)
+            late = self.late
+        return {'elapsed': elapsed,
+                'late': late,
+                'total': summarize(all_latencies, all_statuses),
+                'operations': operations}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class TokensLoadDriver(object):
+    """
+    Sends the operations of the mix to the Tokens API. Tokens generated by post and refresh operations are kept in a
+    bounded pool, from which refresh and revoke operations draw; when the pool is empty, they fall back to a post.
+    """
+    def __init__(self, url, site_id='loadtest', admin_tenant_id='admin', tenant_id='dev', service_user='loadtest',
+                 service_password='loadtest', users=100, pool_size=1000, timeout=30):
+        self.url = url.rstrip('/')
+        self.site_id = site_id
+        self.admin_tenant_id = admin_tenant_id
+        self.tenant_id = tenant_id
+        self.service_user = service_user
+        self.service_password = service_password
+        self.users = users
+        self.timeout = timeout
+        self.pool = collections.deque(maxlen=pool_size)
+        self.pool_lock = threading.Lock()
+        self.service_token = None
+        self.user_numbers = itertools.count()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # one keep-alive session per driver thread --
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def service_headers(self):
+        return {'X-Tapis-Token': self.service_token,
+                'X-Tapis-Tenant': self.admin_tenant_id,
+                'X-Tapis-User': self.service_user}
+
+    def login(self):
+        """
+        Generate the service token used by the post and keys operations, with the service password.
+        """
+        response = self.session.post(f'{self.url}/v3/tokens',
+                                     auth=(self.service_user, self.service_password),
+                                     json={'token_tenant_id': self.admin_tenant_id,
+                                           'account_type': 'service',
+                                           'token_username': self.service_user,
+                                           'target_site_id': self.site_id,
+                                           'access_token_ttl': 24 * 3600},
+                                     timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f'could not generate the service token: {response.status_code} {response.text}')
+        self.service_token = response.json()['result']['access_token']['access_token']
+
+    def keep(self, response):
+        if response.status_code == 200:
+            result = response.json()['result']
+            with self.pool_lock:
+                self.pool.append((result['access_token']['access_token'], result['refresh_token']['refresh_token']))
+
+    def take(self, remove=False):
+        with self.pool_lock:
+            if not self.pool:
+                return None
+            if remove:
+                return self.pool.popleft()
+            return random.choice(self.pool)
+
+    def post(self):
+        response = self.session.post(f'{self.url}/v3/tokens',
+                                     headers=self.service_headers(),
+                                     json={'token_tenant_id': self.tenant_id,
+                                           'account_type': 'user',
+                                           'token_username': f'loadtest{next(self.user_numbers) % self.users}',
+                                           'generate_refresh_token': True},
+                                     timeout=self.timeout)
+        self.keep(response)
+        return 'post', response.status_code
+
+    def refresh(self):
+        tokens = self.take()
+        if not tokens:
+            return self.post()
+        response = self.session.put(f'{self.url}/v3/tokens', json={'refresh_token': tokens[1]}, timeout=self.timeout)
+        self.keep(response)
+        return 'refresh', response.status_code
+
+    def revoke(self):
+        tokens = self.take(remove=True)
+        if not tokens:
+            return self.post()
+        response = self.session.post(f'{self.url}/v3/tokens/revoke', json={'token': tokens[0]}, timeout=self.timeout)
+        return 'revoke', response.status_code
+
+    def keys(self):
+        response = self.session.put(f'{self.url}/v3/tokens/keys',
+                                    headers=self.service_headers(),
+                                    json={'tenant_id': self.tenant_id},
+                                    timeout=self.timeout)
+        if response.status_code == 200:
+            # the pooled tokens were signed with the old key and can no longer be refreshed or revoked --
+            with self.pool_lock:
+                self.pool.clear()
+        return 'keys', response.status_code
+
+    def run(self, mix, rate, duration, workers=32, warmup=0.0, late_threshold=0.01, seed=None):
+        """
+        Send requests at `rate` per second for `warmup` + `duration` seconds, and return the results of the requests
+        scheduled after the warmup.
+        :return: the Results.summary() dict.
+        """
+        chooser = random.Random(seed)
+        operations = list(mix)
+        weights = [mix[operation] for operation in operations]
+        results = Results()
+        warmup_results = Results()
+
+        def send(operation, scheduled, measured):
+            if time.perf_counter() - scheduled > late_threshold:
+                with measured.lock:
+                    measured.late += 1
+            try:
+                operation, status = getattr(self, operation)()
+            except requests.RequestException as e:
+                status = type(e).__name__
+            measured.record(operation, time.perf_counter() - scheduled, status)
+
+        interval = 1.0 / rate
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            start = time.perf_counter()
+            measured_start = start + warmup
+            end = measured_start + duration
+            i = 0
+            while True:
+                scheduled = start + i * interval
+                if scheduled >= end:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                operation = chooser.choices(operations, weights)[0]
+                pool.submit(send, operation, scheduled, results if scheduled >= measured_start else warmup_results)
+                i += 1
+        return results.summary(time.perf_counter() - measured_start)
+
+
+def format_summary(summary):
+    lines = [f"{'operation':10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+             f"{'p99 ms':>9} {'max ms':>9}"]
+    rows = sorted(summary['operations'].items()) + [('total', summary['total'])]
+    for name, row in rows:
+        values = [row[field] for field in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+        lines.append(f"{name:10} {row['requests']:>9} {row['errors']:>7} {row['throughput']:>9.1f} "
+                     + ' '.join(f"{'-' if value is None else f'{value:.1f}':>9}" for value in values))
+    lines.append(f"elapsed {summary['elapsed']:.1f} s; {summary['late']} requests started late.")
+    errors = {name: row['statuses'] for name, row in summary['operations'].items() if row['errors']}
+    if errors:
+        lines.append(f"statuses of the operations with errors: {errors}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load driver for the Tokens API.')
+    parser.add_argument('--url', default='http://localhost:5001', help='base URL of the Tokens API.')
+    parser.add_argument('--rate', type=float, default=50, help='target requests per second.')
+    parser.add_argument('--duration', type=float, default=30, help='measured duration, in seconds.')
+    parser.add_argument('--warmup', type=float, default=5, help='unmeasured warmup before the test, in seconds.')
+    parser.add_argument('--mix', type=parse_mix, default='post=70,refresh=20,revoke=9,keys=1',
+                        help='weights of the operations (post, refresh, revoke, keys).')
+    parser.add_argument('--workers', type=int, default=32, help='maximum number of requests in flight.')
+    parser.add_argument('--site-id', default='loadtest', help='site of the Tokens API.')
+    parser.add_argument('--admin-tenant', default='admin', help='tenant of the service account.')
+    parser.add_argument('--tenant', default='dev', help='tenant of the user tokens and of the key rotations.')
+    parser.add_argument('--service-user', default='loadtest')
+    parser.add_argument('--service-password', default='loadtest')
+    parser.add_argument('--users', type=int, default=100, help='number of distinct users to generate tokens for.')
+    parser.add_argument('--late-threshold', type=float, default=0.01,
+                        help='a request starting this many seconds after its scheduled time is counted as late.')
+    parser.add_argument('--seed', type=int, help='seed of the operation mix, to replay the same sequence.')
+    parser.add_argument('--output', help='path to write the results to, as JSON.')
+    args = parser.parse_args(argv)
+
+    driver = TokensLoadDriver(args.url, site_id=args.site_id, admin_tenant_id=args.admin_tenant,
+                              tenant_id=args.tenant, service_user=args.service_user,
+                              service_password=args.service_password, users=args.users)
+    driver.login()
+    summary = driver.run(args.mix, args.rate, args.duration, workers=args.workers, warmup=args.warmup,
+                         late_threshold=args.late_threshold, seed=args.seed)
+    summary.update({'url': args.url, 'rate': args.rate, 'mix': args.mix})
+    print(format_summary(summary))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
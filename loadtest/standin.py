@@ -0,0 +1,407 @@
+"""
+A local stand-in for the Tapis services the Tokens API calls, for load testing without a Tapis site:
+  - Security Kernel: readSecret, writeSecret, getUsersWithRole, hasRole and validateServicePassword.
+  - Tenants API: list tenants and sites, get and update a tenant.
+  - site-router: token revocation.
+
+State is kept in memory. Each tenant gets a generated RSA signing key pair, stored as its jwtsigning secret and
+published as the tenant's public_key, and writeSecret with the "<generate-secret>" value generates a new one, so
+key rotation (PUT /v3/tokens/keys) works end to end. Every service password equal to --service-password is valid
+and the --role-members are members of every role.
+
+Latency and errors can be injected per upstream (sk, tenants, site_router):
+
+    python -m loadtest.standin --port 8900 --latency sk=0.02:0.005 --error-rate sk=0.01 \\
+        --write-config /tmp/tokens-loadtest.json
+
+and changed while a test runs by PUT /_standin/faults with a body such as
+{"sk": {"latency": 0.05, "jitter": 0.01, "error_rate": 0.1, "error_status": 503}}. GET /_standin/stats returns the
+number of calls and injected errors per endpoint.
+
+With --write-config, a Tokens API config file pointing at the stand-in (use_sk true, the admin tenant's signing key
+as site_admin_privatekey) is written; start the Tokens API with TAPIS_CONFIG_PATH set to it.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+UPSTREAMS = ('sk', 'tenants', 'site_router')
+
+# value of a writeSecret data item asking the SK to generate the secret --
+GENERATE_SECRET = '<generate-secret>'
+
+
+def generate_rsa_keypair():
+    """
+    :return: (private key, public key) as PEM strings.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(encoding=serialization.Encoding.PEM,
+                                    format=serialization.PrivateFormat.PKCS8,
+                                    encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+    public_key = key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                               format=serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+    return private_key, public_key
+
+
+class Fault(object):
+    """
+    The latency and errors injected in the calls to one upstream. The latency of each call is drawn from a normal
+    distribution with mean `latency` and standard deviation `jitter`, in seconds; a fraction `error_rate` of the calls
+    fail with `error_status`.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def update(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(self, name):
+                raise ValueError(f'unknown fault setting: {name}')
+            setattr(self, name, int(value) if name == 'error_status' else float(value))
+
+    def apply(self):
+        """
+        Sleep for the injected latency.
+        :return: the status code of the injected error, or None.
+        """
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status
+        return None
+
+    def as_dict(self):
+        return {'latency': self.latency,
+                'jitter': self.jitter,
+                'error_rate': self.error_rate,
+                'error_status': self.error_status}
+
+
+class StandInState(object):
+    """
+    The in-memory tenants, secrets, roles and revocations served by the stand-in.
+    """
+    def __init__(self, base_url, site_id='loadtest', tenant_ids=('admin', 'dev'), service_password='loadtest',
+                 role_members=('loadtest', 'tokens')):
+        self.base_url = base_url
+        self.site_id = site_id
+        self.admin_tenant_id = tenant_ids[0]
+        self.service_password = service_password
+        self.role_members = list(role_members)
+        self.faults = {upstream: Fault() for upstream in UPSTREAMS}
+        self.lock = threading.Lock()
+        # (tenant_id, secret type, secret name) -> [version, secret map]
+        self.secrets = {}
+        self.revoked = set()
+        # endpoint -> [calls, injected errors]
+        self.calls = {}
+        self.site = {'site_id': site_id,
+                     'primary': True,
+                     'base_url': base_url,
+                     'site_admin_tenant_id': self.admin_tenant_id,
+                     'services': ['tokens', 'security', 'tenants']}
+        self.tenants = {}
+        for tenant_id in tenant_ids:
+            private_key, public_key = generate_rsa_keypair()
+            self.secrets[(tenant_id, 'jwtsigning', 'keys')] = [1, {'privateKey': private_key,
+                                                                   'publicKey': public_key}]
+            self.tenants[tenant_id] = {'tenant_id': tenant_id,
+                                       'site_id': site_id,
+                                       'base_url': base_url,
+                                       'token_service': f'{base_url}/v3/tokens',
+                                       'security_kernel': f'{base_url}/v3/security',
+                                       'authenticator': f'{base_url}/v3/oauth2',
+                                       'admin_user': 'admin',
+                                       'token_gen_services': list(role_members),
+                                       'public_key': public_key,
+                                       'status': 'active',
+                                       'description': f'{tenant_id} tenant of the load test stand-in'}
+
+    def record(self, endpoint, error=False):
+        with self.lock:
+            counts = self.calls.setdefault(endpoint, [0, 0])
+            counts[0] += 1
+            if error:
+                counts[1] += 1
+
+    def stats(self):
+        with self.lock:
+            calls = {endpoint: {'calls': calls, 'injected_errors': errors}
+                     for endpoint, (calls, errors) in self.calls.items()}
+            revoked = len(self.revoked)
+        return {'calls': calls,
+                'revoked': revoked,
+                'faults': {upstream: fault.as_dict() for upstream, fault in self.faults.items()}}
+
+    def tokens_config(self):
+        """
+        A Tokens API config for a site served by this stand-in.
+        """
+        return {'service_name': 'tokens',
+                'primary_site_admin_tenant_base_url': self.base_url,
+                'service_site_id': self.site_id,
+                'service_tenant_id': self.admin_tenant_id,
+                'use_sk': True,
+                'tenants': list(self.tenants),
+                'log_level': 'WARNING',
+                'use_allservices_password': False,
+                # the Tokens API does not use its database to issue, refresh or revoke tokens --
+                'sql_db_url': 'sqlite://',
+                'site_admin_privatekey': self.secrets[(self.admin_tenant_id, 'jwtsigning', 'keys')][1]['privateKey']}
+
+    # Security Kernel --
+
+    def read_secret(self, params, secret_type, secret_name):
+        key = (params.get('tenant'), secret_type, secret_name)
+        with self.lock:
+            secret = self.secrets.get(key)
+        if not secret:
+            return 404, f'Secret {secret_type}/{secret_name} not found in tenant {key[0]}.', None
+        version, secret_map = secret
+        return 200, 'Secret read.', {'secretMap': dict(secret_map),
+                                     'metadata': {'version': version, 'destroyed': False}}
+
+    def write_secret(self, body, secret_type, secret_name):
+        tenant_id = body.get('tenant')
+        data = body.get('data') or {}
+        if data.get('value') == GENERATE_SECRET:
+            private_key, public_key = generate_rsa_keypair()
+            secret_map = {'privateKey': private_key, 'publicKey': public_key}
+        else:
+            secret_map = dict(data)
+        key = (tenant_id, secret_type, secret_name)
+        with self.lock:
+            version = self.secrets.get(key, [0])[0] + 1
+            self.secrets[key] = [version, secret_map]
+        return 200, 'Secret written.', {'version': version}
+
+    def validate_service_password(self, body, secret_name):
+        authorized = body.get('password') == self.service_password
+        return 200, 'Password checked.', {'isAuthorized': authorized}
+
+    def get_users_with_role(self, params, role_name):
+        return 200, 'Users with role.', {'names': list(self.role_members)}
+
+    def has_role(self, body):
+        return 200, 'Role checked.', {'isAuthorized': body.get('user') in self.role_members}
+
+    # Tenants API --
+
+    def list_tenants(self):
+        with self.lock:
+            return 200, 'Tenants retrieved.', [dict(tenant) for tenant in self.tenants.values()]
+
+    def list_sites(self):
+        return 200, 'Sites retrieved.', [dict(self.site)]
+
+    def get_tenant(self, tenant_id):
+        with self.lock:
+            tenant = self.tenants.get(tenant_id)
+            if not tenant:
+                return 404, f'Tenant {tenant_id} not found.', None
+            return 200, 'Tenant retrieved.', dict(tenant)
+
+    def update_tenant(self, body, tenant_id):
+        with self.lock:
+            tenant = self.tenants.get(tenant_id)
+            if not tenant:
+                return 404, f'Tenant {tenant_id} not found.', None
+            tenant.update({name: value for name, value in body.items() if name != 'tenant_id'})
+            return 200, 'Tenant updated.', dict(tenant)
+
+    # site-router --
+
+    def revoke_token(self, body):
+        token = body.get('token')
+        if not token:
+            return 400, 'token is required.', None
+        with self.lock:
+            self.revoked.add(token)
+        return 200, 'Token revoked.', None
+
+
+# (method, path pattern, endpoint, upstream, handler name, arguments passed to the handler). validateServicePassword
+# must be matched before writeSecret, whose path pattern also matches it.
+ROUTES = [
+    ('POST', r'/v3/security/vault/secret/validateServicePassword/(?P<secret_name>[^/]+)',
+     'validateServicePassword', 'sk', 'validate_service_password', ('body',)),
+    ('GET', r'/v3/security/vault/secret/(?P<secret_type>[^/]+)/(?P<secret_name>[^/]+)',
+     'readSecret', 'sk', 'read_secret', ('params',)),
+    ('POST', r'/v3/security/vault/secret/(?P<secret_type>[^/]+)/(?P<secret_name>[^/]+)',
+     'writeSecret', 'sk', 'write_secret', ('body',)),
+    ('GET', r'/v3/security/user/withRole/(?P<role_name>[^/]+)',
+     'getUsersWithRole', 'sk', 'get_users_with_role', ('params',)),
+    ('POST', r'/v3/security/user/hasRole', 'hasRole', 'sk', 'has_role', ('body',)),
+    ('GET', r'/v3/tenants', 'list_tenants', 'tenants', 'list_tenants', ()),
+    ('GET', r'/v3/sites', 'list_sites', 'tenants', 'list_sites', ()),
+    ('GET', r'/v3/tenants/(?P<tenant_id>[^/]+)', 'get_tenant', 'tenants', 'get_tenant', ()),
+    ('PUT', r'/v3/tenants/(?P<tenant_id>[^/]+)', 'update_tenant', 'tenants', 'update_tenant', ('body',)),
+    ('POST', r'/v3/site-router/tokens/revoke', 'revoke', 'site_router', 'revoke_token', ('body',)),
+]
+ROUTES = [(method, re.compile(pattern + '/?$'), endpoint, upstream, handler, args)
+          for method, pattern, endpoint, upstream, handler, args in ROUTES]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the SK and Tenants API behind their proxies --
+    protocol_version = 'HTTP/1.1'
+    server_version = 'TapisStandIn/1.0'
+    # set on the subclass created by make_server() --
+    state = None
+    verbose = False
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_result(self, status, message, result=None):
+        body = json.dumps({'status': 'success' if status < 400 else 'error',
+                           'message': message,
+                           'result': result,
+                           'version': 'stand-in',
+                           'metadata': {}}).encode('utf-8')
+        self.send_response(status)
+        # tapipy only parses responses whose content type is exactly application/json --
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        parts = urlsplit(self.path)
+        try:
+            body = self.read_body()
+        except ValueError:
+            return self.send_result(400, 'Invalid JSON body.')
+        if parts.path.startswith('/_standin/'):
+            return self.admin(method, parts.path, body)
+        params = {name: values[0] for name, values in parse_qs(parts.query).items()}
+        for route_method, pattern, endpoint, upstream, handler, args in ROUTES:
+            match = pattern.match(parts.path)
+            if route_method != method or not match:
+                continue
+            error_status = self.state.faults[upstream].apply()
+            self.state.record(endpoint, error=bool(error_status))
+            if error_status:
+                return self.send_result(error_status, f'Injected {upstream} error.')
+            arguments = {'body': body, 'params': params}
+            status, message, result = getattr(self.state, handler)(*[arguments[arg] for arg in args],
+                                                                   **match.groupdict())
+            return self.send_result(status, message, result)
+        self.send_result(404, f'No stand-in endpoint for {method} {parts.path}.')
+
+    def admin(self, method, path, body):
+        if method == 'GET' and path == '/_standin/stats':
+            return self.send_result(200, 'Stand-in stats.', self.state.stats())
+        if method == 'PUT' and path == '/_standin/faults':
+            try:
+                for upstream, settings in body.items():
+                    self.state.faults[upstream].update(**settings)
+            except (KeyError, TypeError, ValueError) as e:
+                return self.send_result(400, f'Invalid faults: {e}; upstreams are {", ".join(UPSTREAMS)}.')
+            return self.send_result(200, 'Faults updated.', self.state.stats()['faults'])
+        self.send_result(404, f'No stand-in endpoint for {method} {path}.')
+
+
+def make_server(state, host='127.0.0.1', port=8900, verbose=False):
+    """
+    Create the stand-in HTTP server for `state`; call serve_forever() on the result, e.g., in a thread.
+    """
+    handler = type('BoundStandInHandler', (StandInHandler,), {'state': state, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def parse_upstream_settings(values, name):
+    """
+    Parse `upstream=value` arguments into a dict.
+    """
+    settings = {}
+    for value in values or []:
+        upstream, _, setting = value.partition('=')
+        if upstream not in UPSTREAMS or not setting:
+            raise argparse.ArgumentTypeError(f'invalid {name} "{value}"; expected <upstream>=<value> with upstream '
+                                             f'one of {", ".join(UPSTREAMS)}.')
+        settings[upstream] = setting
+    return settings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the SK, Tenants API and site-router.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--site-id', default='loadtest')
+    parser.add_argument('--tenants', nargs='+', default=['admin', 'dev'],
+                        help='the tenants of the site; the first is the site admin tenant.')
+    parser.add_argument('--service-password', default='loadtest', help='the password accepted for every service.')
+    parser.add_argument('--role-members', nargs='+', default=['loadtest', 'tokens'],
+                        help='the users that are members of every role.')
+    parser.add_argument('--latency', action='append', metavar='UPSTREAM=SECONDS[:JITTER]',
+                        help='mean (and standard deviation of the) latency added to the calls to an upstream.')
+    parser.add_argument('--error-rate', action='append', metavar='UPSTREAM=FRACTION',
+                        help='fraction of the calls to an upstream that fail.')
+    parser.add_argument('--error-status', action='append', metavar='UPSTREAM=STATUS',
+                        help='status code of the injected errors (500 by default).')
+    parser.add_argument('--write-config', metavar='PATH', help='write a Tokens API config for the stand-in to PATH.')
+    parser.add_argument('--verbose', action='store_true', help='log every request.')
+    args = parser.parse_args(argv)
+
+    state = StandInState(base_url=f'http://{args.host}:{args.port}',
+                         site_id=args.site_id,
+                         tenant_ids=args.tenants,
+                         service_password=args.service_password,
+                         role_members=args.role_members)
+    try:
+        for upstream, value in parse_upstream_settings(args.latency, 'latency').items():
+            latency, _, jitter = value.partition(':')
+            state.faults[upstream].update(latency=latency, jitter=jitter or 0)
+        for upstream, value in parse_upstream_settings(args.error_rate, 'error rate').items():
+            state.faults[upstream].update(error_rate=value)
+        for upstream, value in parse_upstream_settings(args.error_status, 'error status').items():
+            state.faults[upstream].update(error_status=value)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+    if args.write_config:
+        with open(args.write_config, 'w') as f:
+            json.dump(state.tokens_config(), f, indent=2)
+        print(f"wrote the Tokens API config to {args.write_config}.")
+
+    server = make_server(state, args.host, args.port, args.verbose)
+    print(f"stand-in serving site {args.site_id} (tenants: {', '.join(args.tenants)}) at {state.base_url}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
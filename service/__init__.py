@@ -1,16 +1,34 @@
+import datetime
+import os
+
 from tapisservice.tenants import TenantCache
 from tapisservice.config import conf
 from tapisservice import errors
-from flask import Flask
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
-from tapisservice.logs import get_logger
+from service.keys import signing_keys, SUPPORTED_ALGORITHMS
+from service.metrics import time_phase
+
+from service.logs import get_logger
 logger = get_logger(__name__)
 
 
 class TokensTenants(TenantCache):
 
+    def __init__(self, load=True):
+        """
+        :param load: (bool) whether to retrieve the tenants now. When False, the cache starts empty and the tenants
+                     are retrieved by the first call to reload_tenants() (done by create_app()).
+        """
+        if load:
+            super().__init__()
+            return
+        self.primary_site = None
+        self.service_running_at_primary_site = None
+        self.update_tenant_cache_timedelta = datetime.timedelta(seconds=90)
+        self.tenants = {}
+
     def extend_tenant(self, t):
         """
         Add the private key and token metadata to the tenant description
@@ -18,26 +36,30 @@ class TokensTenants(TenantCache):
         :return:
         """
         # if conf.use_sk is true, we need to get the PKs from the security kernel, but in order to do that we must have
-        # a working tapipy client, which isn't created until the auth module initializes. However,
+        # a working tapipy client, which isn't created until create_app() initializes the auth module. However,
         # in order to create the tapipy client, we need a private key for at least the site admin tenant so
         # that we can sign a service token for it.
         # Therefore, tokens API requires the private key for its tenant to be injected into the container,
         # and here we set that private key.
 
         # the name of the attribute that has the private key for the site admin tenant is: site_admin_privatekey        
-        logger.debug(f"top of extend_tenant for tenant: {t.tenant_id}")
+        logger.debug("top of extend_tenant for tenant: %s", t.tenant_id)
         tenant_id = t.tenant_id
         # Tokens API never serves tenants owned at a different site:
         if not t.site_id == conf.service_site_id:
-            logger.debug(f"skipping tenant_id: {tenant_id} as it is owned by site {t.site_id} and this tokens is serving site {conf.service_site_id}.")
+            logger.debug("skipping tenant_id: %s as it is owned by site %s and this tokens is serving site %s.",
+                         tenant_id, t.site_id, conf.service_site_id)
             return t
         # if this is not a tenant that this tokens is supposed to serve, then just return immediately
         if not conf.tenants[0] == "*":
             if not tenant_id in conf.tenants:
-                logger.debug(f"skipping tenant_id: {tenant_id} as it is not in the list of tenants.")
+                logger.debug("skipping tenant_id: %s as it is not in the list of tenants.", tenant_id)
                 return t
+        # if the signing key registry already has a key for this tenant (e.g., one retrieved from the SK), keep
+        # using it; otherwise, a tenant cache reload would silently revert the tenant to the site admin key.
+        registry_key = signing_keys.get_pem(tenant_id)
         try:
-            t.private_key = conf.site_admin_privatekey
+            t.private_key = registry_key or conf.site_admin_privatekey
         except Exception as e:
             msg = f"Tokens could not get the private key attribute from the conf object. "\
                      "It was looking for an attribute called site_admin_privatekey. Here is the conf object: {conf}."
@@ -47,38 +69,72 @@ class TokensTenants(TenantCache):
         # a "*" and we need to know all the tenants we are actually serving:
         if not tenant_id in conf.tenants:
             conf.tenants.append(tenant_id)        
+        # the JWT signing algorithm for the tenant; the tenant's signing key must be of the matching type.
+        t.signing_alg = self.get_signing_alg(tenant_id)
+        if not registry_key and not conf.use_sk:
+            # without the SK, the tenant signs with the site admin key; parse it now, so that a key that does not
+            # match the tenant's signing algorithm fails the start up with a clear error instead of the first request.
+            signing_keys.set_key(tenant_id, t.private_key, t.signing_alg)
         t.access_token_ttl = conf.dev_default_access_token_ttl
         t.refresh_token_ttl = conf.dev_default_refresh_token_ttl
         return t
 
+    def get_signing_alg(self, tenant_id):
+        """
+        Returns the JWT signing algorithm configured for a tenant. Tenants not listed in the
+        tenant_signing_algorithms config use the default_signing_algorithm.
+        """
+        alg = conf.tenant_signing_algorithms.get(tenant_id, conf.default_signing_algorithm)
+        if alg not in SUPPORTED_ALGORITHMS:
+            msg = f"Invalid signing algorithm {alg} configured for tenant {tenant_id}; " \
+                  f"supported algorithms: {SUPPORTED_ALGORITHMS}"
+            logger.error(msg)
+            raise errors.ServiceConfigError(msg)
+        return alg
+
     def get_tenant_signing_keys_from_sk(self, t, tenant_id):
         """
         Retrieve the signing key for a tenant from the SK. This is used at service start up from within
         the auth.py module, once the tapipy client (t) is created.
         """
-        logger.debug(f"top of get_tenant_signing_keys_from_sk for tenant_id: {tenant_id}")
+        private_key, public_key, _ = self.read_tenant_signing_key_from_sk(t, tenant_id)
+        return private_key, public_key
+
+    def read_tenant_signing_key_from_sk(self, t, tenant_id):
+        """
+        Retrieve the signing key for a tenant from the SK, with the version of its secret, which increases every time
+        the key is rotated.
+        :return: (private key, public key, version)
+        """
+        logger.debug("top of read_tenant_signing_key_from_sk for tenant_id: %s", tenant_id)
         try:
-            result = t.sk.readSecret(secretType='jwtsigning',
-                                     secretName='keys',
-                                     tenant=tenant_id,
-                                     user='tokens',
-                                     _tapis_set_x_headers_from_service=True)
+            with time_phase('sk', upstream='sk'):
+                result = t.sk.readSecret(secretType='jwtsigning',
+                                         secretName='keys',
+                                         tenant=tenant_id,
+                                         user='tokens',
+                                         _tapis_set_x_headers_from_service=True)
         except Exception as e:
-            logger.error(f"Error from SK trying to read tenant signing key for tenant {tenant_id}; exception: {e}")
+            logger.error("Error from SK trying to read tenant signing key for tenant %s; exception: %s", tenant_id, e)
             raise e
-        logger.debug(f"returning signing key for tenant_id: {tenant_id}")
-        return result.secretMap.privateKey, result.secretMap.publicKey
-
+        logger.debug("returning signing key for tenant_id: %s", tenant_id)
+        version = getattr(getattr(result, 'metadata', None), 'version', None)
+        if not version:
+            # without a version, rotations of the key cannot be propagated to the other workers; see
+            # service.key_propagation.
+            logger.debug("the SK returned no version for the signing key of tenant %s.", tenant_id)
+            version = 0
+        return result.secretMap.privateKey, result.secretMap.publicKey, version
 
-# singleton with all tenants data and reload capabilities, etc.
-tenants = TokensTenants()
 
-logger.debug(f"Inside tokens.__init__, got tenants; tenants.get_tenants().keys(): {tenants.get_tenants().keys()}")
+# singleton with all tenants data and reload capabilities, etc. The tenants are retrieved by create_app() (see
+# service/factory.py), not when the package is imported.
+tenants = TokensTenants(load=False)
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = conf.sql_db_url
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+# the database objects are bound to the flask app by create_app(); the schema is managed by the Alembic migrations in
+# service/migrations --
+db = SQLAlchemy()
+migrate = Migrate(directory=os.path.join(os.path.dirname(__file__), 'migrations'))
 
 
 def create_initial_roles():
@@ -1,30 +1,5 @@
-from tapisservice.tapisflask.utils import TapisApi, handle_error, flask_errors_dict
-from tapisservice.tapisflask.resources import HelloResource, ReadyResource
+from service.factory import create_app
 
-from service.auth import authn_and_authz
-from service.controllers import TokensResource, SigningKeysResource, RevokeTokensResource
-
-from service import app, db
-
-# authentication and authorization ---
-@app.before_request
-def authnz_for_authenticator():
-    authn_and_authz()
-
-# flask restful API object ----
-api = TapisApi(app, errors=flask_errors_dict)
-
-# Set up error handling
-api.handle_error = handle_error
-api.handle_exception = handle_error
-api.handle_user_exception = handle_error
-
-# Add resources
-
-# Health-checks
-api.add_resource(ReadyResource, '/v3/tokens/ready')
-api.add_resource(HelloResource, '/v3/tokens/hello')
-
-api.add_resource(TokensResource, '/v3/tokens')
-api.add_resource(RevokeTokensResource, '/v3/tokens/revoke')
-api.add_resource(SigningKeysResource, '/v3/tokens/keys')
+# the Tokens API flask app, for WSGI servers and the tests (e.g., service.api:app). To control when the start up
+# happens, e.g., to pass config overrides, use service.factory.create_app() instead.
+app = create_app()
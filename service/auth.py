@@ -1,16 +1,28 @@
+import hashlib
+import json
+import os
+import requests
 import tapipy
+import threading
+import time
 import uuid
+from jwt.utils import base64url_decode
+from tapisservice import auth
 from tapisservice.auth import get_service_tapis_client 
 from tapisservice.tapisflask.auth import authentication, resolve_tenant_id_for_request
 from tapisservice.config import conf
 from tapisservice import errors as common_errors
 from flask import g, request
-from service.errors import InvalidTokenClaimsError
+from service.errors import InvalidTokenClaimsError, SigningUnavailableError
 from service.models import AccessTokenData, TapisAccessToken
 from service import tenants
+from service.caches import TTLCache
+from service.keys import signing_keys, generate_keypair
+from service.metrics import time_phase
+from service.startup import StartupReport, run_for_tenants
 
 # get the logger instance -
-from tapisservice.logs import get_logger
+from service.logs import get_logger
 logger = get_logger(__name__)
 
 logger.debug("top of auth.py")
@@ -22,39 +34,64 @@ SERVICE_TOKEN_TTL = 60*60*24*365*10
 ROLE = 'tenant_definition_updater'
 
 
-def get_tokens_tapis_client():
+def get_service_token(tenant_id):
+    """
+    Generate and sign the Tokens API's own service token for a tenant.
+    """
+    logger.debug("generating a service token for tenant %s.", tenant_id)
+    try:
+        target_site_id = tenants.get_tenant_config(tenant_id=tenant_id).site_id
+    except Exception as e:
+        logger.error("was unable to retrieve config for tenant %s; failed to generate a token.", tenant_id)
+        raise common_errors.BaseTapyException(f"Got exception computing target site id; e:{e}")
+    # minimal data needed to create an access token:
+    token_data = AccessTokenData(jti=uuid.uuid4(),
+                                 token_tenant_id=conf.service_tenant_id,
+                                 token_username=conf.service_name,
+                                 account_type='service')
+    # override some defaults --
+    token_data.access_token_ttl = SERVICE_TOKEN_TTL
+    token_data.target_site_id = target_site_id
+    token_data = TapisAccessToken.get_derived_values(token_data)
+    access_token = TapisAccessToken(**token_data)
+    access_token.sign_token()
+    # create the "access_token" attribute pointing to the raw JWT just as tapipy does
+    # in its get_tokens() methods
+    access_token.access_token = access_token.jwt
+    logger.debug("token for tenant id %s created. ", tenant_id)
+    return access_token
+
+
+def run_startup_phase(fn, tenant_ids, phase, report=None, commit=None):
+    """
+    Run one per-tenant start up phase concurrently, with the configured parallelism, timeout and retries, and
+    raise if any tenant failed. See run_for_tenants() for `commit`.
+    :return: dict mapping tenant_id to the result of fn for the tenant.
+    """
+    results, failures = run_for_tenants(fn, tenant_ids, phase, report,
+                                        max_workers=conf.startup_max_workers,
+                                        timeout=conf.startup_tenant_timeout,
+                                        retries=conf.startup_tenant_retries,
+                                        commit=commit)
+    if failures:
+        for tenant_id, e in failures.items():
+            logger.error("%s failed for tenant %s; e: %s", phase, tenant_id, e)
+        raise next(iter(failures.values()))
+    return results
+
+
+def get_tokens_tapis_client(report=None):
     """
     Instantiates and returns a tapis client for the Tokens service by generating the service tokens
     using the private key associated with the admin tenant.
     """
     # generate our own service tokens ---
-    # minimal data needed to create an access token:
-    base_token_data = AccessTokenData(jti=uuid.uuid4(),
-                                      token_tenant_id=conf.service_tenant_id,
-                                      token_username=conf.service_name,
-                                      account_type='service')
-    # override some defaults --
-    base_token_data.access_token_ttl = SERVICE_TOKEN_TTL
     # set up the service tokens object: dictionary mapping of tenant_id to token data for all
     # tenants the Tokens API will need to interact with.
-    service_tokens = {t: {} for t in tenants.get_site_admin_tenants_for_service()}
-    logger.debug(f"Starting to generate signed tokens for the following tenant ids: {service_tokens.keys()}")
-    for tenant_id in service_tokens.keys():
-        logger.debug(f"generating a service token for tenant {tenant_id}.")
-        try:
-            target_site_id = tenants.get_tenant_config(tenant_id=tenant_id).site_id
-        except Exception as e:
-            logger.error(f"was unable to retrieve config for tenant {tenant_id}; failed to generate a token.")
-            raise common_errors.BaseTapyException(f"Got exception computing target site id; e:{e}")
-        base_token_data.target_site_id = target_site_id
-        token_data = TapisAccessToken.get_derived_values(base_token_data)
-        access_token = TapisAccessToken(**token_data)
-        access_token.sign_token()
-        # create the "access_token" attribute pointing to the raw JWT just as tapipy does
-        # in its get_tokens() methods
-        access_token.access_token = access_token.jwt
-        service_tokens[tenant_id]['access_token'] = access_token
-        logger.debug(f"token for tenant id {tenant_id} created. ")
+    tenant_ids = tenants.get_site_admin_tenants_for_service()
+    logger.debug("Starting to generate signed tokens for the following tenant ids: %s", tenant_ids)
+    tokens = run_startup_phase(get_service_token, tenant_ids, 'service_tokens', report)
+    service_tokens = {tenant_id: {'access_token': tokens[tenant_id]} for tenant_id in tenant_ids}
 
     our_admin_jwt = service_tokens[conf.service_tenant_id]['access_token'].access_token
     # use the convenience function from the common package to generate a service client
@@ -69,29 +106,228 @@ def get_tokens_tapis_client():
     return t
 
 
-def get_signing_keys_for_all_tenants_from_sk():
+def load_signing_key_from_sk(tenant_id):
     """
-    Retrieve all signing keys for all tenants served by this Tokens API.
-    This function is called at service start up.
+    Retrieve the signing key for one tenant from the SK and load it into the signing key registry.
     """
-    logger.debug('top of get_signing_keys_for_all_tenants_from_sk; retrieving tenant signing keys.')
+    store_signing_key(tenant_id, read_signing_key_from_sk(tenant_id))
+
+
+def read_signing_key_from_sk(tenant_id):
+    """
+    Retrieve the signing key for one tenant from the SK, without loading it.
+    :return: (private key, version)
+    """
+    logger.debug("retrieving signing key for tenant %s", tenant_id)
+    private_key, _, version = tenants.read_tenant_signing_key_from_sk(t, tenant_id)
+    return private_key, version
+
+
+def store_signing_key(tenant_id, signing_key):
+    """
+    Load a signing key returned by read_signing_key_from_sk() into the signing key registry and the tenant.
+    """
+    private_key, version = signing_key
+    # parse the key into the registry first so that the tenant is never left with a PEM the registry
+    # has not loaded --
+    signing_keys.set_key(tenant_id, private_key, tenants.get_signing_alg(tenant_id), version)
+    tenants.get_tenant_config(tenant_id=tenant_id).private_key = private_key
+
+
+def store_missing_signing_key(tenant_id, signing_key):
+    """
+    Load a signing key into the registry unless a key for the tenant was loaded in the meantime (e.g., on first use
+    or by a rotation).
+    """
+    if signing_keys.get_version(tenant_id) is None:
+        store_signing_key(tenant_id, signing_key)
+
+
+def get_site_tenant_ids():
+    """
+    Return the ids of all tenants owned by the site this Tokens API serves.
+    """
+    tenant_ids = []
     for _id, tenant in tenants.tenants.items():
         # need to check if this is a tenant this Tokens API serves:
         if not tenant.site_id == conf.service_site_id:
-            logger.debug(f"skipping tenant_id {tenant.tenant_id} as it is owned by site {tenant.site_id} and this tokens"
-                         f"API is serving site {conf.service_site_id}.")
+            logger.debug("skipping tenant_id %s as it is owned by site %s and this tokens"
+                         "API is serving site %s.", tenant.tenant_id, tenant.site_id, conf.service_site_id)
             continue
-        logger.debug(f"retrieving signing key for tenant {tenant.tenant_id}")
-        tenant.private_key, _ = tenants.get_tenant_signing_keys_from_sk(t, tenant.tenant_id)
+        tenant_ids.append(tenant.tenant_id)
+    return tenant_ids
+
+
+def get_signing_keys_for_all_tenants_from_sk(report=None):
+    """
+    Retrieve all signing keys for all tenants served by this Tokens API.
+    This function is called at service start up; the keys are retrieved concurrently (see the startup_* configs).
+    """
+    logger.debug('top of get_signing_keys_for_all_tenants_from_sk; retrieving tenant signing keys.')
+    run_startup_phase(read_signing_key_from_sk, get_site_tenant_ids(), 'signing_keys', report,
+                      commit=store_signing_key)
+
+
+def lazy_load_signing_key(tenant_id):
+    """
+    Loader for lazy signing key loading: retrieves a tenant's key from the SK the first time it is needed.
+    Errors are raised as a SigningUnavailableError, so the request gets a 503 and the load is tried again on the next
+    request.
+    """
+    try:
+        load_signing_key_from_sk(tenant_id)
+    except Exception as e:
+        raise SigningUnavailableError(msg=f"Could not retrieve the signing key for tenant {tenant_id}; "
+                                          f"please try again later. Details: {e}")
 
 
-# the tapis client used by the tokens API --
-t = get_tokens_tapis_client()
-logger.debug("got tapipy client for tokens.")
-# use tapipy client to get the signing keys from the SK at start up...
-if conf.use_sk:
-    logger.debug("Retrieving signing keys for all tenants from SK...")
-    get_signing_keys_for_all_tenants_from_sk()
+def enable_lazy_signing_keys():
+    """
+    Switch the signing key registry to lazy loading from the SK and start a background thread that warms the keys
+    of all tenants served by this Tokens API.
+    """
+    # the registry may hold keys for the site admin tenants parsed from the site_admin_privatekey config while
+    # generating our service tokens; drop them so that the tenants' SK keys are loaded, as in eager mode.
+    for key in signing_keys.keys():
+        signing_keys.remove_key(key.tenant_id)
+    signing_keys.set_loader(lazy_load_signing_key, prefetch_workers=conf.startup_max_workers)
+
+    start_signing_key_warmer()
+
+
+def start_signing_key_warmer():
+    """
+    Start a background thread that loads the keys of all tenants served by this Tokens API that are not loaded yet.
+    """
+    def warm():
+        report = StartupReport()
+        with report.phase('signing_keys_warmer'):
+            tenant_ids = [tenant_id for tenant_id in get_site_tenant_ids()
+                          if signing_keys.get_version(tenant_id) is None]
+            _, failures = run_for_tenants(read_signing_key_from_sk, tenant_ids, 'signing_keys_warmer', report,
+                                          max_workers=conf.startup_max_workers,
+                                          timeout=conf.startup_tenant_timeout,
+                                          retries=conf.startup_tenant_retries,
+                                          commit=store_missing_signing_key)
+        if failures:
+            logger.error("signing key warmer could not load the keys for tenants: %s; they "
+                         "will be loaded on first use.", list(failures.keys()))
+        report.log()
+
+    threading.Thread(target=warm, name='signing-key-warmer', daemon=True).start()
+
+
+# the tapis client used by the tokens API; created by init_service_client(), called from create_app() --
+t = None
+
+
+def init_service_client(report=None):
+    """
+    Generate the Tokens API's service tokens and create its tapipy client. Called once, at start up, by create_app().
+    """
+    global t
+    t = get_tokens_tapis_client(report)
+    logger.debug("got tapipy client for tokens.")
+    return t
+
+
+def init_signing_keys(report=None):
+    """
+    Use the tapipy client to get the signing keys from the SK at start up, or, in lazy mode, on first use.
+    Called once, at start up, by create_app(), after init_service_client().
+    """
+    if not conf.use_sk:
+        return
+    if conf.signing_key_loading == 'lazy':
+        logger.debug("Loading signing keys from SK on demand; starting the signing key warmer...")
+        enable_lazy_signing_keys()
+    else:
+        logger.debug("Retrieving signing keys for all tenants from SK...")
+        get_signing_keys_for_all_tenants_from_sk(report)
+
+
+def init_caches():
+    """
+    Size the role membership and service password caches from the service config. Called by create_app(), after
+    any config overrides are applied; until then, the caches are disabled.
+    """
+    role_members_cache.configure(maxsize=conf.role_cache_max_size, ttl=conf.role_cache_ttl)
+    service_password_cache.configure(maxsize=conf.service_password_cache_max_size,
+                                     ttl=conf.service_password_cache_ttl)
+    service_password_negative_cache.configure(maxsize=conf.service_password_cache_max_size,
+                                              ttl=conf.service_password_negative_cache_ttl)
+
+
+def post_fork():
+    """
+    Re-create the network state of the tapipy client in a forked worker process. The client's HTTP connection pool
+    must not be shared with the parent; the tokens and tenant data it holds are read-only and are kept.
+    tapipy sends every request through the client's requests_session attribute, so replacing it is enough.
+    """
+    if t:
+        t.requests_session = requests.Session()
+
+
+# SK role membership cache
+# ------------------------
+
+# maps (tenant_id, role_name) -> (frozenset of usernames in the role, time the members were retrieved); sized by
+# init_caches() --
+role_members_cache = TTLCache('role_members', maxsize=0, ttl=0)
+
+
+def user_has_role(tenant_id, role_name, username):
+    """
+    Checks whether `username` is in the SK role `role_name` in `tenant_id`, using the role membership cache.
+    Members found in a cached entry are trusted for role_cache_ttl seconds. A user NOT found in a cached entry is
+    only denied if the entry is younger than role_cache_negative_ttl; otherwise the members are retrieved from the
+    SK again, so that users recently added to a role are picked up quickly.
+    Exceptions from the SK are not cached and are raised to the caller.
+    :return: (bool)
+    """
+    key = (tenant_id, role_name)
+    # an entry that does not have the user and is older than role_cache_negative_ttl is a miss --
+    entry = role_members_cache.get(key, valid=lambda cached: username in cached[0]
+                                   or time.monotonic() - cached[1] < conf.role_cache_negative_ttl)
+    if entry:
+        return username in entry[0]
+    logger.debug("calling SK to get users with role: %s in tenant: %s...", role_name, tenant_id)
+    with time_phase('sk', upstream='sk'):
+        names = frozenset(t.sk.getUsersWithRole(tenant=tenant_id, roleName=role_name).names)
+    role_members_cache.set(key, (names, time.monotonic()))
+    return username in names
+
+
+def invalidate_role_cache(tenant_id=None, role_name=None):
+    """
+    Invalidate cached role memberships: for a single role if both tenant_id and role_name are passed, for all roles
+    in a tenant if only tenant_id is passed, or the whole cache otherwise.
+    :return: (int) the number of entries removed.
+    """
+    if tenant_id and role_name:
+        return role_members_cache.invalidate(key=(tenant_id, role_name))
+    if tenant_id:
+        return role_members_cache.invalidate(match=lambda k: k[0] == tenant_id)
+    return role_members_cache.invalidate()
+
+
+# Service password cache
+# ----------------------
+
+# verified service credentials, keyed by (tenant_id, username, password digest). the digest is a PBKDF2 hash of the
+# password salted with a random, per-process salt; plaintext passwords are never stored. valid and invalid
+# credentials are kept in separate caches so that invalid ones can expire sooner. sized by init_caches() --
+service_password_cache = TTLCache('service_passwords', maxsize=0, ttl=0)
+service_password_negative_cache = TTLCache('service_passwords_negative', maxsize=0, ttl=0)
+_service_password_salt = os.urandom(16)
+
+
+def get_service_password_cache_key(tenant_id, username, password):
+    digest = hashlib.pbkdf2_hmac('sha256',
+                                 password.encode('utf-8'),
+                                 _service_password_salt + f'{tenant_id}:{username}'.encode('utf-8'),
+                                 conf.service_password_cache_iterations)
+    return tenant_id, username, digest
 
 
 # Authentication and Authorization
@@ -104,9 +340,9 @@ def authn_and_authz():
     """
     # first check whether the request is even a valid
     if hasattr(request, 'url_rule'):
-        logger.debug("request.url_rule: {}".format(request.url_rule))
+        logger.debug("request.url_rule: %s", request.url_rule)
         if hasattr(request.url_rule, 'rule'):
-            logger.debug("url_rule.rule: {}".format(request.url_rule.rule))
+            logger.debug("url_rule.rule: %s", request.url_rule.rule)
         else:
             logger.info("url_rule has no rule.")
             raise common_errors.BaseTapisError(
@@ -122,8 +358,14 @@ def authn_and_authz():
         if 'Authorization' in request.headers and 'X-Tapis-Token' in request.headers:
             raise common_errors.BaseTapisError("Invalid request: both X-Tapis-Token and HTTP Basic Auth headers set; please set only one.")
 
-        # first check if this is a request to update the token signing keys
-        if 'tokens/keys' in request.url_rule.rule:
+        # the metrics are public only if the deployment keeps the endpoint from being reached from outside --
+        if 'tokens/metrics' in request.url_rule.rule and conf.metrics_public:
+            return True
+
+        # first check if this is a request to update the token signing keys (or to change the request profiling or
+        # read the metrics, which require the same role)
+        if 'tokens/keys' in request.url_rule.rule or 'tokens/profiling' in request.url_rule.rule \
+                or 'tokens/metrics' in request.url_rule.rule:
             # check for a Tapis token
             logger.debug("request to update token signing keys, looking for a tapis token..")
             authentication()
@@ -133,15 +375,19 @@ def authn_and_authz():
             # later, we also check that the tenant_id in the payload either matches g.tenant_id or that it is the
             # admin tenant for the site owning the tenant in the payload. (see check_authz_private_keypair() below)
             try:
-                users = t.sk.getUsersWithRole(roleName=ROLE, tenant=g.tenant_id)
+                has_role = user_has_role(g.tenant_id, ROLE, g.username)
             except Exception as e:
                 msg = f'Got an error calling the SK. Exception: {e}'
                 logger.error(msg)
                 raise common_errors.PermissionsError(
                     msg=f'Could not verify permissions with the Security Kernel; additional info: {e}')
-            logger.debug(f"got users: {users}; checking if {g.username} is in role {ROLE}.")
-            if g.username not in users.names:
-                logger.info(f"user {g.username} was not in role {ROLE}. raising permissions error.")
+            logger.debug("checked if %s is in role %s: %s.", g.username, ROLE, has_role)
+            if not has_role:
+                logger.info("user %s was not in role %s. raising permissions error.", g.username, ROLE)
+                if 'tokens/profiling' in request.url_rule.rule:
+                    raise common_errors.PermissionsError(msg='Not authorized to change the request profiling.')
+                if 'tokens/metrics' in request.url_rule.rule:
+                    raise common_errors.PermissionsError(msg='Not authorized to read the metrics.')
                 raise common_errors.PermissionsError(msg='Not authorized to modify the tenant signing keys.')
             return True
 
@@ -152,12 +398,24 @@ def authn_and_authz():
             try:
                 token_str = request.get_json().get('token')
             except Exception as e:
-                logger.info(f"Got exception trying to parse JSON from request; e: {e}; type(e):{type(e)}")
+                logger.info("Got exception trying to parse JSON from request; e: %s; type(e):%s", e, type(e))
                 raise common_errors.AuthenticationError('Unable to parse message payload; is it JSON?')
             # for now, we allow any site to revoke any token. we can revisit this in the future
             return True
 
 
+        # next, check whether this is a request to generate a batch of tokens. the caller is authenticated once
+        # here; each token request in the batch is authorized individually by the controller, using
+        # authorize_token_request(), so that one unauthorized item does not fail the entire batch.
+        if 'tokens/batch' in request.url_rule.rule:
+            parts = get_basic_auth_parts()
+            if parts:
+                resolve_tenant_id_for_request()
+            else:
+                logger.debug("did not get parts for batch request, checking for tapis token..")
+                authentication()
+            return True
+
         # otherwise, this is a request to create a token (either with a service account/password (POST) or with a
         # refresh token (PUT).
         if request.method == 'POST': # note: PUT (i.e. refresh) does NOT require additional auth
@@ -166,8 +424,9 @@ def authn_and_authz():
             try:
                 tenant_id = request.get_json().get('token_tenant_id')
                 username = request.get_json().get('token_username')
+                account_type = request.get_json().get('account_type')
             except Exception as e:
-                logger.info(f"Got exception trying to parse JSON from request; e: {e}; type(e):{type(e)}")
+                logger.info("Got exception trying to parse JSON from request; e: %s; type(e):%s", e, type(e))
                 raise common_errors.AuthenticationError('Unable to parse message payload; is it JSON?')
             # check for basic auth header:
             parts = get_basic_auth_parts()
@@ -175,66 +434,87 @@ def authn_and_authz():
                 # note that we cannot call the authentication() function in this case because there is not a token header.
                 # still, we need to resolve the tenant_id for the request
                 resolve_tenant_id_for_request()
-                if not username == parts['username']:
-                    raise common_errors.AuthenticationError('Invalid POST data -- username does not match auth header.')
-                if not tenant_id:
-                    raise common_errors.AuthenticationError('Invalid POST data -- tenant_id missing from POST data.')
-                # do basic auth with SK and tapis client.
-                logger.debug("got parts, checking service password..")
-                check_service_password(tenant_id, parts['username'], parts['password'])
-                logger.debug("password was valid.")
-                return True
             else:
                 # check for a Tapis token -- this call should put username and tenant on the g object
                 logger.debug("did not get parts, checking for tapis token..")
                 authentication()
-                # if this is a request from a service to generate a token for itself, we do not need to check
-                # the SK role.
-                if username == g.username and tenant_id == g.tenant_id:
-                    return True
-
-                # otherwise, this is a request to generate a token for a subject other than the service, so we need 
-                # to check with SK that the service is authorized for the action. Token generation is controlled by a
-                # specific role corresponding to the tenant that the caller is trying to create the token in.
-
-                # note: we do not allow generating tokens of type "user" in the site-admin tenant
-                try:
-                    account_type = request.get_json().get('account_type')
-                except Exception as e:
-                    logger.info(f"Got exception trying to parse JSON from Tapis token request; e: {e}; type(e):{type(e)}")
-                    raise common_errors.AuthenticationError('Unable to parse message payload; is it JSON?') 
-                if not account_type == 'service' and tenant_id == conf.service_tenant_id:
-                    raise common_errors.AuthenticationError('Invalid request -- only service tokens can be generated in the site-admin tenant.')
-                
-                try:
-                    tenant_id = request.get_json().get('token_tenant_id')
-                except Exception as e:
-                    logger.info(f"Got exception trying to parse JSON from Tapis token request; e: {e}; type(e):{type(e)}")
-                    raise common_errors.AuthenticationError('Unable to parse message payload; is it JSON?')
-                # the role_name includes the tenant that the caller is trying to create the token in.
-                role_name = f'{tenant_id}_token_generator'
-                try:
-                    # the role itself lives in the admin tenant for the site where tokens lives. the caller (which
-                    # should be a service account),
-                    try:
-                        admin_tenant = g.tenant_id
-                    except Exception as e:
-                        msg = f"got exception trying to check the service token's tenant_id; exception: {e}."
-                        logger.error(msg)
-                        raise common_errors.AuthenticationError("Unable to validate the tenant_id on the provided JWT.")
-                    logger.debug(f"calling SK to check for role: {role_name} in tenant: {admin_tenant}...")
-                    users = t.sk.getUsersWithRole(tenant=admin_tenant, roleName=role_name)
-                except Exception as e:
-                    msg = f'Got an error calling the SK to get users with role {role_name}. Exception: {e}'
-                    logger.error(msg)
-                    raise common_errors.PermissionsError(
-                        msg=f'Could not verify permissions with the Security Kernel; additional info: {e}')
-                if g.username not in users.names:
-                    logger.info(f"user {g.username} was not in role {role_name} in tenant {admin_tenant}. "
-                                f"DENYING request and raising permissions error.")
-                    raise common_errors.PermissionsError(msg=f'Not authorized to generate tokens in tenant {tenant_id}.')
-                logger.debug(f"user {g.username} WAS fond in role {role_name} in tenant {admin_tenant}. APPROVING request.")
-                return True
+            return authorize_token_request(tenant_id, username, account_type, parts)
+
+
+def authorize_token_request(tenant_id, username, account_type, parts=None, checked=None):
+    """
+    Checks whether the (already authenticated) caller is authorized to generate a token for `username` in
+    `tenant_id`. Raises an AuthenticationError or PermissionsError if not.
+    :param tenant_id: (str) the token_tenant_id of the token request.
+    :param username: (str) the token_username of the token request.
+    :param account_type: (str) the account_type of the token request.
+    :param parts: (dict) the HTTP Basic Auth parts, as returned by get_basic_auth_parts(), or None if the caller
+                  authenticated with a Tapis token.
+    :param checked: (dict) optional memo of the SK checks already made for this request, so that a batch of token
+                    requests makes only one SK call per distinct (tenant, role) or (tenant, username) pair.
+    :return: True
+    """
+    if checked is None:
+        checked = {}
+    if parts:
+        if not username == parts['username']:
+            raise common_errors.AuthenticationError('Invalid POST data -- username does not match auth header.')
+        if not tenant_id:
+            raise common_errors.AuthenticationError('Invalid POST data -- tenant_id missing from POST data.')
+        # do basic auth with SK and tapis client.
+        key = ('password', tenant_id, parts['username'])
+        if key not in checked:
+            logger.debug("got parts, checking service password..")
+            try:
+                check_service_password(tenant_id, parts['username'], parts['password'])
+                checked[key] = None
+            except common_errors.BaseTapisError as e:
+                checked[key] = e
+        if checked[key]:
+            raise checked[key]
+        logger.debug("password was valid.")
+        return True
+
+    # if this is a request from a service to generate a token for itself, we do not need to check
+    # the SK role.
+    if username == g.username and tenant_id == g.tenant_id:
+        return True
+
+    # otherwise, this is a request to generate a token for a subject other than the service, so we need
+    # to check with SK that the service is authorized for the action. Token generation is controlled by a
+    # specific role corresponding to the tenant that the caller is trying to create the token in.
+
+    # note: we do not allow generating tokens of type "user" in the site-admin tenant
+    if not account_type == 'service' and tenant_id == conf.service_tenant_id:
+        raise common_errors.AuthenticationError('Invalid request -- only service tokens can be generated in the site-admin tenant.')
+
+    # the role_name includes the tenant that the caller is trying to create the token in.
+    role_name = f'{tenant_id}_token_generator'
+    # the role itself lives in the admin tenant for the site where tokens lives. the caller (which
+    # should be a service account),
+    try:
+        admin_tenant = g.tenant_id
+    except Exception as e:
+        msg = f"got exception trying to check the service token's tenant_id; exception: {e}."
+        logger.error(msg)
+        raise common_errors.AuthenticationError("Unable to validate the tenant_id on the provided JWT.")
+    key = ('role', admin_tenant, role_name)
+    if key not in checked:
+        try:
+            checked[key] = user_has_role(admin_tenant, role_name, g.username)
+        except Exception as e:
+            msg = f'Got an error calling the SK to get users with role {role_name}. Exception: {e}'
+            logger.error(msg)
+            checked[key] = common_errors.PermissionsError(
+                msg=f'Could not verify permissions with the Security Kernel; additional info: {e}')
+    if isinstance(checked[key], Exception):
+        raise checked[key]
+    if not checked[key]:
+        logger.info("user %s was not in role %s in tenant %s. "
+                    "DENYING request and raising permissions error.", g.username, role_name, admin_tenant)
+        raise common_errors.PermissionsError(msg=f'Not authorized to generate tokens in tenant {tenant_id}.')
+    logger.debug("user %s WAS fond in role %s in tenant %s. APPROVING request.", g.username, role_name, admin_tenant)
+    return True
 
 
 def get_basic_auth_parts():
@@ -255,7 +535,7 @@ def get_basic_auth_parts():
             return {'username': auth.username,
                     'password': auth.password}
         except Exception as e:
-            logger.error(f"Got exception trying to retrieve the username and password from the headers. e: {e}")
+            logger.error("Got exception trying to retrieve the username and password from the headers. e: %s", e)
             raise common_errors.AuthenticationError('Unable to parse HTTP Basic Authorization header.')
     return None
 
@@ -269,7 +549,7 @@ def check_service_password(tenant_id, username, password):
     # if conf.use_allservices_password:
     #     secret_name = 'password'
     #     # secret_name = f'{tenant_id}+allservices+password'
-    logger.debug(f"top of check_service_password: tenant_id: {tenant_id}; username: {username}")
+    logger.debug("top of check_service_password: tenant_id: %s; username: %s", tenant_id, username)
     # we only allow use of the "allservices_password" configuration in develop --
     if conf.use_allservices_password and "develop" in conf.primary_site_admin_tenant_base_url:
         logger.info("allowing check of the allservices_password")
@@ -277,28 +557,102 @@ def check_service_password(tenant_id, username, password):
             logger.info("allservices_password was correct; issuing token.")
             return True
         else:
-            logger.debug(f"allservices_password was incorrect; password passed: {password}; "
-                         f"actual: {conf.allservices_password}")
+            # note: neither the password passed nor the allservices_password is ever logged --
+            logger.debug("allservices_password was incorrect for service %s.", username)
+
+    cache_key = None
+    if service_password_cache.enabled or service_password_negative_cache.enabled:
+        cache_key = get_service_password_cache_key(tenant_id, username, password)
+        if service_password_cache.get(cache_key):
+            logger.debug("service password found in the verified credential cache.")
+            return True
+        failure_msg = service_password_negative_cache.get(cache_key)
+        if failure_msg:
+            logger.debug("service password found in the invalid credential cache.")
+            raise common_errors.AuthenticationError(msg=failure_msg)
 
     try:
-        result = t.sk.validateServicePassword(secretType='service',
-                                              secretName= 'password',
-                                              tenant=tenant_id,
-                                              user=username,
-                                              password=password,
-                                              _tapis_set_x_headers_from_service=True)
+        # an invalid password is not an error calling the SK --
+        with time_phase('sk', upstream='sk', expected=tapipy.errors.InvalidInputError):
+            result = t.sk.validateServicePassword(secretType='service',
+                                                  secretName= 'password',
+                                                  tenant=tenant_id,
+                                                  user=username,
+                                                  password=password,
+                                                  _tapis_set_x_headers_from_service=True)
     except tapipy.errors.InvalidInputError as e:
-        logger.info(f"Got InvalidInputError trying to check service password inside SK secretMap. Exception: {e}")
-        raise common_errors.AuthenticationError(msg='Invalid service account/password combination. Service account may not be registered with SK.')
+        logger.info("Got InvalidInputError trying to check service password inside SK secretMap. Exception: %s", e)
+        msg = 'Invalid service account/password combination. Service account may not be registered with SK.'
+        if cache_key:
+            service_password_negative_cache.set(cache_key, msg)
+        raise common_errors.AuthenticationError(msg=msg)
     except Exception as e:
-        logger.debug(f"got exception from call to validateServicePassword; e: {e}; type(e): {type(e)}")
+        logger.debug("got exception from call to validateServicePassword; e: %s; type(e): %s", e, type(e))
         if type(e) == common_errors.AuthenticationError:
             raise e
-        logger.error(f"Got exception trying to check the service {username}'s password with SK. Exception: {e}")
+        logger.error("Got exception trying to check the service %s's password with SK. Exception: %s", username, e)
         raise common_errors.AuthenticationError(msg='Tokens API got an error trying to contact SK to validate service secret.')
     if not result.isAuthorized:
-        logger.debug(f"got isAuthorized==False from call to validateServicePassword. Full result: {result}")
-        raise common_errors.AuthenticationError(msg='Tokens API got isAuthorized=False from SK.')
+        logger.debug("got isAuthorized==False from call to validateServicePassword. Full result: %s", result)
+        msg = 'Tokens API got isAuthorized=False from SK.'
+        if cache_key:
+            service_password_negative_cache.set(cache_key, msg)
+        raise common_errors.AuthenticationError(msg=msg)
+    if cache_key:
+        service_password_cache.set(cache_key, True)
+
+
+def validate_refresh_token(token_str):
+    """
+    Validates a refresh token and returns its claims; the token is rejected early if it is not a refresh token.
+    See validate_token_locally().
+    :param token_str: (str) the raw refresh token.
+    :return: dict of claims.
+    """
+    return validate_token_locally(token_str, token_type='refresh')
+
+
+def validate_token_locally(token_str, token_type=None):
+    """
+    Validates a Tapis token and returns its claims. Tokens for the tenants served by this Tokens API were signed by
+    this Tokens API, so they are verified locally with the public key derived from the tenant's signing key, after
+    parsing the token once. Tokens for other tenants are validated with the generic tapisservice validate_token().
+    Raises an AuthenticationError if the token is not valid and unexpired, or if token_type is passed and the
+    token's tapis/token_type claim does not match it.
+    :param token_str: (str) the raw token.
+    :param token_type: (str) the required token type ('access' or 'refresh'), or None to accept either.
+    :return: dict of claims.
+    """
+    try:
+        signing_input, _, signature_segment = token_str.rpartition('.')
+        header_segment, _, payload_segment = signing_input.partition('.')
+        header = json.loads(base64url_decode(header_segment))
+        claims = json.loads(base64url_decode(payload_segment))
+        signature = base64url_decode(signature_segment)
+        tenant_id = claims.get('tapis/tenant_id')
+        alg = header.get('alg')
+    except Exception as e:
+        logger.debug("got exception trying to parse the token; e: %s", e)
+        raise common_errors.AuthenticationError("Could not parse the Tapis token.")
+    if token_type and not claims.get('tapis/token_type') == token_type:
+        raise common_errors.AuthenticationError(f"Invalid Tapis token; the token is not a {token_type} token.")
+    if tenant_id not in conf.tenants:
+        logger.debug("tenant %s is not served by this Tokens API; using the generic token validation.", tenant_id)
+        return auth.validate_token(token_str)
+    try:
+        key = signing_keys.get_key(tenants.get_tenant_config(tenant_id=tenant_id))
+    except Exception as e:
+        logger.error("could not get the signing key for tenant %s; e: %s", tenant_id, e)
+        raise common_errors.AuthenticationError("Unable to process Tapis token; unexpected tenant_id.")
+    # the alg header must match the tenant's algorithm; never let the token choose how it is verified.
+    if not alg == key.alg:
+        raise common_errors.AuthenticationError("Invalid Tapis token.")
+    if not key.algorithm.verify(signing_input.encode('utf-8'), key.public_key, signature):
+        raise common_errors.AuthenticationError("Invalid Tapis token.")
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        raise common_errors.AuthenticationError("Invalid Tapis token; the token has expired.")
+    return claims
 
 
 def check_extra_claims(extra_claims):
@@ -332,27 +686,27 @@ def check_authz_private_keypair(tenant_id):
       3). the token's tenant_id claim is for the admin tenant for the site owning the tenant_id being updated.
     """
     # first check if the tenant_id is a tenant that this Tokens API handles
-    logger.debug(f"top of check_authz_private_keypair for: {tenant_id}")
+    logger.debug("top of check_authz_private_keypair for: %s", tenant_id)
     # note that the tenant_id here could be for a tenant in status DRAFT or INACTIVE and therefore will not
     # be in the tenant cache. we have to go directly to the tenants API for to get the description for this tenant.
     request_tenant = t.tenants.get_tenant(tenant_id=tenant_id)
     site_id_for_request = request_tenant.site_id
-    logger.debug(f"request_tenant: {request_tenant}; site_id_for_request: {site_id_for_request}")
+    logger.debug("request_tenant: %s; site_id_for_request: %s", request_tenant.tenant_id, site_id_for_request)
     if not conf.service_site_id == site_id_for_request:
-        logger.info(f"the request was for a site {site_id_for_request} that does not match the site for this Tokens"
-                    f"API ({conf.service_site_id}. the request is not authorized.")
+        logger.info("the request was for a site %s that does not match the site for this Tokens"
+                    "API (%s. the request is not authorized.", site_id_for_request, conf.service_site_id)
         raise common_errors.AuthenticationError(msg=f'Invalid tenant_id ({tenant_id}) provided. This tenant belongs to'
                                                     f'site {site_id_for_request} but this Tokens API serves site'
                                                     f'{conf.service_site_id}.')
     # if the tenant_id of the access token matched the tenant_id the request is trying to update, the request is
     # authorized
     if g.tenant_id == tenant_id:
-        logger.debug(f"token's tenant {g.tenant_id} matched. request authorized.")
+        logger.debug("token's tenant %s matched. request authorized.", g.tenant_id)
         return True
     # the rest of the checks are only for service tokens; if token was a user token, the request is not authorized:
     if not g.account_type == 'service':
-        logger.info(f"the request was for a different tenant {tenant_id} than the token's tenant_id ({g.tenant_id}) and"
-                    f"the token was not s service token. the request is not authorized.")
+        logger.info("the request was for a different tenant %s than the token's tenant_id (%s) and"
+                    "the token was not s service token. the request is not authorized.", tenant_id, g.tenant_id)
         raise common_errors.AuthenticationError(msg=f'Invalid tenant_id ({tenant_id}) provided. The token provided '
                                                     f'belongs to the {g.tenant_id} tenant but the request is trying to'
                                                     f'update the {tenant_id} tenant. Only service accounts can update'
@@ -362,35 +716,80 @@ def check_authz_private_keypair(tenant_id):
     # to check this, get the site associated with the token:
     token_tenant = tenants.get_tenant_config(tenant_id=g.tenant_id)
     site_id_for_token = token_tenant.site_id
-    logger.debug(f"site_id_for_token: {site_id_for_token}")
+    logger.debug("site_id_for_token: %s", site_id_for_token)
     if site_id_for_request == site_id_for_token:
-        logger.debug(f"token's site {site_id_for_token} matched tenant's site. request authorized.")
+        logger.debug("token's site %s matched tenant's site. request authorized.", site_id_for_token)
         return True
-    logger.info(f"token site {site_id_for_token} did NOT match tenant's site ({site_id_for_request})")
+    logger.info("token site %s did NOT match tenant's site (%s)", site_id_for_token, site_id_for_request)
     raise common_errors.AuthenticationError(msg=f'Invalid tenant_id ({tenant_id}) provided. This tenant belongs to'
                                                 f'site {site_id_for_request} but the Tapis token passed in the'
                                                 f'X-Tapis-Token header is for site {site_id_for_token}. Services'
                                                 f'can only update tenants at their site.')
 
 
-def generate_private_keypair_in_sk(tenant_id):
+def generate_private_keypair_in_sk(tenant_id, alg=None):
     """
     Generate a public/private key pair using SK for tenant_id. Returns the private key and the
-    public key.
+    public key. The key type matches the signing algorithm configured for the tenant (or `alg`, if passed): the
+    SK generates RS256 key pairs itself; EC (ES256) and Ed25519 (EdDSA) key pairs are generated here and stored
+    in the SK.
+    """
+    private_key, public_key, _ = rotate_private_keypair_in_sk(tenant_id, alg)
+    return private_key, public_key
+
+
+def rotate_private_keypair_in_sk(tenant_id, alg=None):
     """
-    logger.debug(f"top of generate_private_keypair_in_sk for tenant_id: {tenant_id}")
+    Generate a new public/private key pair for tenant_id in the SK (see generate_private_keypair_in_sk()) and read it
+    back. A key pair generated here must be the one the SK returns: anything else means the SK did not store it as
+    the tenant's jwtsigning secret, and the error is raised instead of reporting the old key as the new one.
+    :return: (private key, public key, version) as read from the SK.
+    """
+    if not alg:
+        alg = tenants.get_signing_alg(tenant_id)
+    written = write_private_keypair_in_sk(tenant_id, alg)
+    private_key, public_key, version = tenants.read_tenant_signing_key_from_sk(t, tenant_id)
+    if written and not written == (private_key, public_key):
+        logger.error("the jwtsigning secret the SK returned for tenant %s is not the %s key pair just written to it; "
+                     "the signing key was not rotated.", tenant_id, alg)
+        raise common_errors.DAOError(msg='The SK did not store the new signing key; the signing key was not changed. '
+                                         'Please contact the system administrators.', code=500)
+    return private_key, public_key, version
+
+
+def write_private_keypair_in_sk(tenant_id, alg=None):
+    """
+    Generate a new public/private key pair for tenant_id and store it in the SK, without reading it back; see
+    generate_private_keypair_in_sk(). Errors from the SK are raised.
+    :return: the (private key, public key) written, or None when the SK generates the key pair (RS256).
+    """
+    logger.debug("top of write_private_keypair_in_sk for tenant_id: %s", tenant_id)
+    if not alg:
+        alg = tenants.get_signing_alg(tenant_id)
+    if alg == 'RS256':
+        # these static data values instruct the SK to generate the key pair for us ---
+        written = None
+        data = {'key': 'privateKey',
+                'value': '<generate-secret>'}
+    else:
+        # the key pair is stored under the same names the SK uses for the key pairs it generates, so that
+        # readSecret returns it in the same secretMap attributes; rotate_private_keypair_in_sk() checks it does.
+        written = generate_keypair(alg)
+        data = {'privateKey': written[0],
+                'publicKey': written[1]}
     try:
         # note: writeSecret does not return the signing key generated; for that we have to
         # call readSecret
-        t.sk.writeSecret(secretType='jwtsigning',
-                         secretName='keys',
-                         tenant=tenant_id,
-                         user='tokens',
-                         # these static data values instruct the SK to generate the key pair for us ---
-                         data={'key': 'privateKey',
-                               'value': '<generate-secret>'}
-                         )
+        with time_phase('sk', upstream='sk'):
+            t.sk.writeSecret(secretType='jwtsigning',
+                             secretName='keys',
+                             tenant=tenant_id,
+                             user='tokens',
+                             data=data
+                             )
     except Exception as e:
-        logger.error(f"Error from SK trying to generate key pair; exception: {e}")
-    logger.info(f"new jwtsigning secret generated in SK for tenant id: {tenant_id}")
-    return tenants.get_tenant_signing_keys_from_sk(t, tenant_id)
+        logger.error("Error from SK trying to generate key pair; exception: %s", e)
+        raise common_errors.DAOError(msg='Unable to generate the new signing key in the SK; the signing key was not '
+                                         'changed. Please try again later.', code=500)
+    logger.info("new %s jwtsigning secret generated in SK for tenant id: %s", alg, tenant_id)
+    return written
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+
+from service.metrics import metrics
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+class TTLCache(object):
+    """
+    A small thread-safe in-process cache with a per-entry time-to-live and least-recently-used eviction once
+    `maxsize` entries are stored. Each entry may override the cache's default ttl, which is used, for example,
+    to keep negative results for a shorter time than positive ones.
+    A ttl (or maxsize) of 0 disables the cache: set() is a no-op and get() always misses.
+    """
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # maps key -> (expires_at, value), in least- to most-recently used order
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # counters --
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        metrics.register_cache(name, self)
+
+    def configure(self, maxsize, ttl):
+        """
+        Change the size and default ttl of the cache, dropping its entries.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._data.clear()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None, valid=None):
+        """
+        Return the value stored for `key`, or `default` if there is no unexpired entry.
+        :param valid: optional function of the value; an entry it rejects is kept, but counted as a miss, and
+                      `default` is returned.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            if valid is not None and not valid(entry[1]):
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Store `value` for `key`, expiring after `ttl` seconds (the cache default if not passed).
+        """
+        if not self.enabled:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None, match=None):
+        """
+        Remove entries from the cache: the entry for `key`, if passed; otherwise all entries whose key satisfies
+        the function `match`, if passed; otherwise all entries.
+        :return: (int) the number of entries removed.
+        """
+        with self._lock:
+            if key is not None:
+                return 1 if self._data.pop(key, None) else 0
+            if match is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            keys = [k for k in self._data if match(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        Return the cache counters as a dictionary.
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -1,28 +1,36 @@
-import copy
 from email import header
 import resource
 import traceback
 import uuid
-import json
 from flask import Flask
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from flask import request
+from flask import request, Response
 from flask_restful import Resource
-import requests
-from openapi_core import openapi_request_validator
-from openapi_core.contrib.flask import FlaskOpenAPIRequest
 from tapisservice.config import conf
-from tapisservice import auth, errors
+from tapisservice import errors
 from tapisservice.tapisflask import utils
 
-from service.auth import check_extra_claims, check_authz_private_keypair, generate_private_keypair_in_sk, t
-from service.models import TapisAccessToken, TapisRefreshToken
-from service import tenants
+from service.auth import check_extra_claims, check_authz_private_keypair, rotate_private_keypair_in_sk, \
+    authorize_token_request, get_basic_auth_parts, validate_refresh_token, validate_token_locally
+from service.errors import SigningUnavailableError
+from service.models import ACCESS_TOKEN_CLAIM, INITIAL_TTL_CLAIM, TapisAccessToken, TapisRefreshToken
+from service import auth, tenants
+from service.idempotency import token_responses
+from service.key_propagation import key_propagator
+from service.keys import signing_keys
+from service.ledger import ledger
+from service.metrics import metrics, time_phase
+from service.profiling import RequestProfiler
+from service.refresh_store import is_compact_refresh_token, refresh_token_store
+from service.revocation import revocation_index, site_router
+from service.validation import new_token_request_validator, refresh_token_request_validator, \
+    revoke_token_request_validator, revoke_tokens_batch_request_validator, new_signing_keys_request_validator, \
+    profiling_request_validator
 
 
 # get the logger instance -
-from tapisservice.logs import get_logger
+from service.logs import get_logger
 logger = get_logger(__name__)
 
 
@@ -32,57 +40,22 @@ class TokensResource(Resource):
     """
     def post(self):
         logger.debug("top of POST /tokens")
-        try:
-            # This is a decently ugly hack.
-            # Issue:
-            # Spec declares createToken claims as an free object. https://github.com/python-openapi/openapi-core/issues/430
-            # This unfortunately does not validate properly.
-            # Solution Attempts:
-            # - Move to 0.16.1 as it's fixed. Dataclasses are tossed for models and the validated object would not be accessible
-            #   in the way we currently use it. validated.body would be validated['body']. I don't wanna break the codebases.
-            # - 0.17.0 also has issues. New is 0.18.0, I haven't tried it yet. Could be a solution.
-            # - We could also just not validate the claims object. Nah.
-            # Solution:
-            # Pop claims from the request object, validate, then put it back in. This is what we're doing.
-            # To note:
-            # - Modifying request.data or request.json does nothing as FlaskOpenAPIRequest.super() runs request.get_data(as_text=True)
-            #   and that reads unbuffered data. I attempted to override this function, but it's essential to the request object.
-            # - End solution was to override FlaskOpenAPIRequest.body to return request.data.
-            # - Meaning we pop claims, and add them back to the validated object afterwards in order to make no changes to any other code.
-
-            # Override body to return request.data
-            @property
-            def custom_body(self, *args, **kwargs):
-                return self.request.data
-            FlaskOpenAPIRequest.body = custom_body
-
-            # Regular logic
-            # Pop claims and set request.data to data without claims
-            request_json_without_claims = copy.deepcopy(request.json)
-            popped_claims = None
-            if 'claims' in request_json_without_claims:
-                popped_claims = request_json_without_claims.get('claims')
-                del request_json_without_claims['claims']
-            request.data = json.dumps(request_json_without_claims)
-
-            # debug logs
-            # logger.debug(f"request.json: {request.json}")
-            # logger.debug(f"request.popped: {request.json.get('claims')}")
-            # logger.debug(f"request.data: {request.data}")
-
-            validated = openapi_request_validator.validate(utils.spec, FlaskOpenAPIRequest(request))
+        # the request body is validated in a single pass over the parsed JSON, including the free-form claims
+        # object, by a validator compiled from the OpenAPI spec at start up.
+        validated_body = new_token_request_validator.validate_request()
+        # the response of an earlier request with the same Idempotency-Key, or of an identical earlier request when
+        # token reuse is enabled, is returned instead of signing new tokens -
+        result = token_responses.get_or_generate(validated_body, TokensResource.generate_tokens)
+        logger.debug("returning token response")
+        return utils.ok(result=result, msg="Token generation successful.")
 
-            # Add claims back in
-            logger.debug(f"validated: {validated}")
-            if popped_claims:
-                validated.body.claims = popped_claims
-        except Exception as e:
-            logger.error(f"Got exception trying to validate request: {e}")
-            raise errors.ResourceError(msg=f'Invalid POST data: {e}.')
-        
-        if validated.errors:
-            raise errors.ResourceError(msg=f'Invalid POST data: {validated.errors}.')
-        validated_body = validated.body
+    @classmethod
+    def generate_tokens(cls, validated_body):
+        """
+        Generate a signed access token, and optionally a refresh token, for a validated NewTokenRequest body.
+        :param validated_body: the validated NewTokenRequest body
+        :return: dict with the serialized access_token (and refresh_token, if requested).
+        """
         try:
             token_tenant_id = validated_body.token_tenant_id
         except:
@@ -90,28 +63,29 @@ class TokensResource(Resource):
         if validated_body.account_type == 'service':
             if not hasattr(validated_body, 'target_site_id'):
                 raise errors.ResourceError(msg="Invalid POST data: target_site_id required for creating tokens of type 'service'.")
-        logger.debug(f"got token_tenant_id: {token_tenant_id}")
+        logger.debug("got token_tenant_id: %s", token_tenant_id)
         if not token_tenant_id in conf.tenants:
             raise errors.ResourceError(msg=f'Invalid POST data: token_tenant_id ({token_tenant_id}) is not served by this Tokens API. tenants served: {conf.tenants}')
         # this raises an exception if the claims are invalid -
         if hasattr(validated_body, 'claims'):
-            check_extra_claims(request.json.get('claims'))
-            # set it to the raw request's claims object which is an arbitrary python dictionary
-            validated_body.claims = request.json.get('claims')
-        logger.debug(f"got validated_body claims")
+            check_extra_claims(validated_body.claims)
+        logger.debug("got validated_body claims")
         try:
             token_data = TapisAccessToken.get_derived_values(validated_body)
         except Exception as e:
-            logger.error(f"Got exception trying to compute get_derived_values() for validated body; e: {e}")
+            logger.error("Got exception trying to compute get_derived_values() for validated body; e: %s", e)
             raise errors.AuthenticationError("Unable to create token. Please contact system administrator.")
         access_token = TapisAccessToken(**token_data)
         logger.debug("access token created")
         try:
             access_token.sign_token()
+        except SigningUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Got exception trying to sign token! Exception: {e}")
+            logger.error("Got exception trying to sign token! Exception: %s", e)
             raise errors.AuthenticationError("Unable to sign token. Please contact system administrator.")
         logger.debug("access token signed")
+        ledger.add_token('issue', access_token)
         result = {'access_token': access_token.serialize}
 
         # refresh token --
@@ -121,48 +95,50 @@ class TokensResource(Resource):
                 token_data['refresh_token_ttl'] = validated_body.refresh_token_ttl
             
             refresh_token = TokensResource.get_refresh_from_access_token_data(token_data, access_token)
+            ledger.add_token('issue', refresh_token)
             result['refresh_token'] = refresh_token.serialize
             logger.debug("refresh token generated ")
-        logger.debug("returning token response")
-        return utils.ok(result=result, msg="Token generation successful.")
+        return result
 
     def put(self):
         logger.debug("top of  PUT /tokens")
-        validated = openapi_request_validator.validate(utils.spec, FlaskOpenAPIRequest(request))
-        if validated.errors:
-            raise errors.ResourceError(msg=f'Invalid PUT data: {validated.errors}.')
-        refresh_token = validated.body.refresh_token
-        logger.debug(f"type(refresh_token) = {type(refresh_token)}")
+        validated_body = refresh_token_request_validator.validate_request()
+        refresh_token = getattr(validated_body, 'refresh_token', None)
+        logger.debug("type(refresh_token) = %s", type(refresh_token))
         try:
-            refresh_token_data = auth.validate_token(refresh_token)
+            with time_phase('validate_refresh_token'):
+                refresh_token_data = validate_refresh_token(refresh_token)
         except errors.AuthenticationError:
             raise errors.ResourceError(msg=f'Invalid PUT data: {request}.')
+        # revoked refresh tokens cannot be used to generate new tokens --
+        with time_phase('revocation_check'):
+            revoked = revocation_index.is_revoked(refresh_token_data.get('jti'))
+        if revoked:
+            logger.info("refresh token %s has been revoked.", refresh_token_data.get('jti'))
+            raise errors.ResourceError(msg='Invalid PUT data: the refresh token has been revoked.')
+
+        # the original access_token data and initial ttl are within the decoded refresh_token or, for compact refresh
+        # tokens, in the refresh token store -
+        if is_compact_refresh_token(refresh_token_data):
+            stored = refresh_token_store.get(refresh_token_data.get('jti'))
+            if not stored:
+                raise errors.ResourceError(msg='Invalid PUT data: the refresh token is unknown or has expired.')
+            access_token_data, initial_ttl = stored
+        else:
+            access_token_data = refresh_token_data[ACCESS_TOKEN_CLAIM]
+            initial_ttl = refresh_token_data[INITIAL_TTL_CLAIM]
 
-        # get the original access_token data from within the decoded refresh_token
-        token_data = refresh_token_data['tapis/access_token']
-        token_data.pop('tapis/token_type')
-        token_data['exp'] = TapisAccessToken.compute_exp(token_data['ttl'])
-        token_data['jti'] = str(uuid.uuid4())
-        # create a dictionary of data that can be used to instantiate access and refresh tokens; the constructors
-        # require variable names that do not include the Tapis prefix, so we need to remove that -
-        new_token_data = { 'jti': token_data.pop('jti'),
-                           'iss': token_data.pop('iss'),
-                           'sub': token_data.pop('sub'),
-                           'tenant_id': token_data.pop('tapis/tenant_id'),
-                           'username': token_data.pop('tapis/username'),
-                           'account_type': token_data.pop('tapis/account_type'),
-                           'ttl': token_data.pop('ttl'),
-                           'exp': token_data.pop('exp'),
-                           'delegation': token_data.pop('tapis/delegation'),
-                           'delegation_sub': token_data.pop('tapis/delegation_sub', None),
-                           'extra_claims': token_data
-                           }
+        # create a dictionary of data that can be used to instantiate access and refresh tokens from the original
+        # access_token data -
+        new_token_data = TapisAccessToken.get_data_from_refresh_claims(access_token_data)
         access_token = TapisAccessToken(**new_token_data)
         access_token.sign_token()
 
-        # add the original refresh token's initial_ttl claim as the ttl for the new refresh token
-        new_token_data['refresh_token_ttl'] = refresh_token_data['tapis/initial_ttl']
+        # add the original refresh token's initial_ttl as the ttl for the new refresh token
+        new_token_data['refresh_token_ttl'] = initial_ttl
         refresh_token = TokensResource.get_refresh_from_access_token_data(new_token_data, access_token)
+        ledger.add_token('refresh', access_token)
+        ledger.add_token('refresh', refresh_token)
         result = {'access_token': access_token.serialize,
                   'refresh_token': refresh_token.serialize
                   }
@@ -172,71 +148,135 @@ class TokensResource(Resource):
     def get_refresh_from_access_token_data(cls, token_data, access_token):
         """
         Generate a refresh token from access token data as a dictionary and the access_token object. 
-        :param token_data: dict
+        :param token_data: dict; only its refresh_token_ttl, if any, is used.
         :param access_token: TapisAccessToken
         :return: TapisRefreshToken, signed
         """
         logger.debug("top of get_refresh_from_access_token_data()")
-        logger.debug(f"token_data:{token_data}; access_token: {access_token}")
+        # note: the token data and the signed access token are not logged, since they include the raw JWT --
+        logger.debug("generating the refresh token for access token %s", access_token.jti)
         # refresh tokens have all the same attributes as the associated access token (and same values)
-        # except that refresh tokens do not have `delegation`, `target_site`, or any extra claims, 
+        # except that refresh tokens do not have `delegation`, `target_site`, or any extra claims,
         # they have a different JTI, and they do have an `access_token` attr:
-        token_data.pop('delegation')
-        token_data.pop('target_site_id', None)
-        token_data['access_token'] = access_token.claims_to_dict()
-        token_data['access_token'].pop('exp')
-        token_data.pop('delegation_sub', None)
-        token_data.pop('extra_claims', None)
-        # record the requested ttl for the token so that we can use it to generate a token of equal length
-        # at refresh
-        token_data['access_token']['ttl'] = token_data['ttl']        
-        refresh_token_data = TapisRefreshToken.get_derived_values(token_data)
-        logger.debug(f"instantiating refresh token with refresh_token_data: {refresh_token_data}")
-        refresh_token = TapisRefreshToken(**refresh_token_data)
+        refresh_token = TapisRefreshToken.from_access_token(access_token, token_data.get('refresh_token_ttl'))
         refresh_token.sign_token()
+        if refresh_token.compact:
+            refresh_token_store.save(refresh_token)
         return refresh_token
 
 
+class TokensBatchResource(Resource):
+    """
+    Generate many Tapis tokens in a single request.
+    """
+    def post(self):
+        logger.debug("top of POST /tokens/batch")
+        try:
+            token_requests = request.get_json().get('tokens')
+        except Exception as e:
+            logger.info("Got exception trying to parse JSON from request; e: %s; type(e):%s", e, type(e))
+            raise errors.ResourceError(msg='Invalid POST data: unable to parse message payload; is it JSON?')
+        if not isinstance(token_requests, list) or not token_requests:
+            raise errors.ResourceError(msg='Invalid POST data: tokens must be a non-empty list of token requests.')
+        if len(token_requests) > conf.max_batch_tokens:
+            raise errors.ResourceError(msg=f'Invalid POST data: at most {conf.max_batch_tokens} tokens can be '
+                                           f'requested in a single batch; got {len(token_requests)}.')
+        # the caller was authenticated in authn_and_authz; each item is authorized here. the SK checks made for one
+        # item are recorded in `checked` and reused for every other item with the same (tenant, role) or
+        # (tenant, username) pair.
+        parts = get_basic_auth_parts()
+        checked = {}
+        results = []
+        errors_count = 0
+        for token_request in token_requests:
+            try:
+                validated_body = new_token_request_validator.validate(token_request)
+                if conf.use_sk:
+                    authorize_token_request(getattr(validated_body, 'token_tenant_id', None),
+                                            getattr(validated_body, 'token_username', None),
+                                            getattr(validated_body, 'account_type', None),
+                                            parts,
+                                            checked)
+                result = TokensResource.generate_tokens(validated_body)
+                results.append({'status': 'success', 'result': result})
+            except errors.BaseTapisError as e:
+                errors_count += 1
+                results.append({'status': 'error', 'code': e.code, 'message': e.msg})
+            except Exception as e:
+                # an unexpected error (e.g., while deriving the claims or signing) fails only its own item --
+                logger.error("unexpected error generating token %s of the batch; e: %s; type(e): %s",
+                             len(results), e, type(e))
+                errors_count += 1
+                results.append({'status': 'error', 'code': 500,
+                                'message': 'Unable to generate the token; please contact the system administrators.'})
+        logger.debug("batch complete; %s requests, %s errors.", len(results), errors_count)
+        return utils.ok(result=results,
+                        msg="Batch token generation complete.",
+                        metadata={'total': len(results), 'errors': errors_count})
+
+
 class RevokeTokensResource(Resource):
     """
     Revoke a Tapis JWT.
     """
     def post(self):
         logger.debug("top of POST /tokens/revoke")
-        validated = openapi_request_validator.validate(utils.spec, FlaskOpenAPIRequest(request))
-        if validated.errors:
-            raise errors.ResourceError(msg=f'Invalid POST data: {validated.errors}.')
-        validated_body = validated.body
-        token_str = validated.body.token
+        validated_body = revoke_token_request_validator.validate_request()
+        token_str = getattr(validated_body, 'token', None)
         try:
-            token_data = auth.validate_token(token_str)
+            token_data = validate_token_locally(token_str)
         except errors.AuthenticationError as e:
             raise errors.ResourceError(msg=f'Invalid POST data; could not validate the token: debug data: {e}.')
         # call the site-router to add the token to the revocation table
-        # we always call the site-router located at our site and with the X-Tapis-Tenant and User
-        # headers set to ourselves (tokens api)
-        url = f'{t.base_url}/v3/site-router/tokens/revoke'
-        request_tenant_id = conf.service_tenant_id
-        request_user = conf.service_name
-        try:
-            service_token =  t.service_tokens[request_tenant_id]['access_token'].access_token
-        except Exception as e:
-            logger.error(f"Could not get the token's service access token; details: {e}")
-            raise errors.ResourceError(msg='Service error revoking token: contact service admins.')
-        headers = {
-            'X-Tapis-Tenant': request_tenant_id, 
-            'X-Tapis-User': request_user,
-            'X-Tapis-Token': service_token,
-        }
-        try:
-            rsp = requests.post(url, headers=headers, json={"token": token_str})
-            rsp.raise_for_status()
-        except Exception as e:
-            logger.info(f"Got exception in call to site-router; exception: {e}")
-            raise errors.ResourceError(msg=f'Error contacting Tapis to revoke token; details: {e}')
+        site_router.revoke(token_str)
+        revocation_index.add(token_data.get('jti'), token_data.get('exp'))
+        ledger.add_claims('revoke', token_data)
+        if is_compact_refresh_token(token_data):
+            refresh_token_store.delete(token_data.get('jti'))
         return utils.ok(result='', msg=f"Token {token_data['jti']} has been revoked.")
 
 
+class RevokeTokensBatchResource(Resource):
+    """
+    Revoke many Tapis JWTs in a single request.
+    """
+    def post(self):
+        logger.debug("top of POST /tokens/revoke/batch")
+        validated_body = revoke_tokens_batch_request_validator.validate_request()
+        token_strs = validated_body.tokens
+        if len(token_strs) > conf.max_batch_revocations:
+            raise errors.ResourceError(msg=f'Invalid POST data: at most {conf.max_batch_revocations} tokens can be '
+                                           f'revoked in a single batch; got {len(token_strs)}.')
+        # validate all tokens first (locally, no network), then send the valid ones to the site-router concurrently
+        results = []
+        valid = []
+        for token_str in token_strs:
+            try:
+                token_data = validate_token_locally(token_str)
+            except errors.AuthenticationError as e:
+                results.append({'status': 'error', 'code': 400,
+                                'message': f'Could not validate the token: debug data: {e}.'})
+                continue
+            result = {'status': 'success', 'jti': token_data.get('jti')}
+            results.append(result)
+            valid.append((result, token_str, token_data))
+        if valid:
+            failures = site_router.revoke_many([token_str for _, token_str, _ in valid])
+            for (result, _, token_data), failure in zip(valid, failures):
+                if failure:
+                    result.update({'status': 'error', 'code': failure.code, 'message': failure.msg})
+                else:
+                    revocation_index.add(result['jti'], token_data.get('exp'))
+                    ledger.add_claims('revoke', token_data)
+                    if is_compact_refresh_token(token_data):
+                        refresh_token_store.delete(result['jti'])
+        errors_count = len([r for r in results if r['status'] == 'error'])
+        logger.debug("batch revocation complete; %s tokens, %s errors.", len(results), errors_count)
+        return utils.ok(result=results,
+                        msg="Batch token revocation complete.",
+                        metadata={'total': len(results), 'errors': errors_count})
+
+
 class SigningKeysResource(Resource):
     """
     Generate a new public/private key pair for token signatures.
@@ -244,31 +284,74 @@ class SigningKeysResource(Resource):
 
     def put(self):
         logger.debug("top of  PUT /tokens/keys")
-        validated = openapi_request_validator.validate(utils.spec, FlaskOpenAPIRequest(request))
-        if validated.errors:
-            raise errors.ResourceError(msg=f'Invalid PUT data: {validated.errors}.')
-        tenant_id = validated.body.tenant_id
-        logger.debug(f"calling check_authz_private_keypair with tenant_id {tenant_id}")
+        validated_body = new_signing_keys_request_validator.validate_request()
+        try:
+            tenant_id = validated_body.tenant_id
+        except AttributeError:
+            raise errors.ResourceError(msg='Invalid PUT data: tenant_id is required.')
+        logger.debug("calling check_authz_private_keypair with tenant_id %s", tenant_id)
         check_authz_private_keypair(tenant_id)
         logger.debug("returned from check_authz_private_keypair; updating keys...")
-        private_key, public_key = generate_private_keypair_in_sk(tenant_id)
+        alg = tenants.get_signing_alg(tenant_id)
+        private_key, public_key, version = rotate_private_keypair_in_sk(tenant_id, alg)
         # update the tenant definition with the new public key
-        logger.debug(f"making request to update tenant {tenant_id} with new public key.")
+        logger.debug("making request to update tenant %s with new public key.", tenant_id)
         try:
-            t.tenants.update_tenant(tenant_id=tenant_id, public_key=public_key)
+            auth.t.tenants.update_tenant(tenant_id=tenant_id, public_key=public_key)
         except Exception as e:
-            logger.error(f"Got exception trying to update tenant with new public key. Tenants API"
-                         f"and SK are now out of sync!! SHOULD BE LOOKED AT IMMEDIATELY. "
-                         f"Exception: {e}")
+            logger.error("Got exception trying to update tenant with new public key. Tenants API"
+                         "and SK are now out of sync!! SHOULD BE LOOKED AT IMMEDIATELY. "
+                         "Exception: %s", e)
             raise errors.ResourceError(msg=f'Unable to update tenant definition with new public key'
                                            f'Please contact system administrators.')
-        logger.info(f"tenant {tenant_id} has been updated with the new public key.")
+        logger.info("tenant %s has been updated with the new public key.", tenant_id)
         # update token's tenant cache with this private key for signing:
         logger.debug("updating token cache...")
+        # parse and swap in the new key in the signing key registry before updating the tenant cache --
+        signing_keys.set_key(tenant_id, private_key, alg, version)
+        # tokens signed with the old key are no longer valid --
+        token_responses.invalidate_tenant(tenant_id)
+        # the tenant's role memberships are retrieved from the SK again, so that a change to the tenant's roles made
+        # along with a key rotation is not hidden by the role cache --
+        auth.invalidate_role_cache(tenant_id)
         for t_id, tenant in tenants.tenants.items():
             if t_id == tenant_id:
                 tenant.private_key = private_key
+        # the other workers and replicas load the new key from the SK when they receive its version --
+        key_propagator.publish(tenant_id, version)
         result = {'public_key': public_key}
         return utils.ok(result=result, msg="Tenant signing keys update successful.")
 
 
+class MetricsResource(Resource):
+    """
+    Request, phase, token issuance, upstream error and cache metrics for this process, in the Prometheus text format.
+    """
+    def get(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# samples requests to profile; configured from the profiling_* configs by init() --
+profiler = RequestProfiler()
+
+
+def init():
+    """
+    Configure the request profiler from the service config. Called by create_app(), after any config overrides are
+    applied.
+    """
+    profiler.configure(sample_rate=conf.profiling_sample_rate,
+                       directory=conf.profiling_dir,
+                       dump_every=conf.profiling_dump_every)
+
+
+class ProfilingResource(Resource):
+    """
+    Change the fraction of requests profiled by this process, optionally for a limited time. Requires the same role
+    as updating the tenant signing keys. The change is not propagated: the other worker processes and replicas keep
+    their sample rate, which is why the result includes the pid of the process that was changed.
+    """
+    def post(self):
+        validated_body = profiling_request_validator.validate_request()
+        profiler.set_sample_rate(validated_body.sample_rate, getattr(validated_body, 'duration', None))
+        return utils.ok(result=profiler.stats(), msg="Profiling updated.")
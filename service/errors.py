@@ -5,3 +5,7 @@ class InvalidTokenClaimsError(BaseTapisError):
     pass
 
 
+class SigningUnavailableError(BaseTapisError):
+    """The signing engine is at capacity or unavailable; the request can be retried."""
+    def __init__(self, msg=None, code=503):
+        super().__init__(msg=msg, code=code)
@@ -0,0 +1,177 @@
+import time
+
+from flask import Flask, g, request
+from tapisservice.config import conf
+from tapisservice.tapisflask.utils import TapisApi, handle_error, flask_errors_dict
+from tapisservice.tapisflask.resources import HelloResource, ReadyResource
+
+from service import auth, tenants, db, migrate, signing
+from service.controllers import TokensResource, TokensBatchResource, SigningKeysResource, RevokeTokensResource, \
+    RevokeTokensBatchResource, MetricsResource, ProfilingResource, profiler, init as init_profiler
+from service import logs
+from service.idempotency import init as init_token_responses
+from service.key_propagation import key_propagator, init as init_key_propagator
+from service.keys import signing_keys
+from service.ledger import ledger, init as init_ledger
+from service.metrics import time_phase, request_duration, requests_in_flight, request_timings
+from service.profiling import format_server_timing
+from service.refresh_store import refresh_token_store, init as init_refresh_token_store
+from service.revocation import revocation_index, site_router, init as init_revocation
+from service.startup import StartupReport
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+def create_app(config=None):
+    """
+    Create the Tokens API flask app. Importing the service package does not retrieve the tenants, service tokens or
+    signing keys of the Tokens API (tapisservice, which it imports, does build its own tenant cache from the Tenants
+    API at import); all of the start up work happens here, in explicit phases:
+      1) config: apply the `config` overrides, if any, and configure the caches, signing engine, revocation index,
+         ledger and the other service objects from the resulting config.
+      2) tenants: retrieve the tenants from the Tenants API.
+      3) client: generate the service tokens and create the tapipy client.
+      4) signing_keys: retrieve the tenant signing keys from the SK (or start lazy loading; see signing_key_loading).
+      5) app: build the flask app and register the routes, and start the ledger writer and refresh token purger.
+    A timing report for the phases is logged at the end.
+    With a pre-fork server, call create_app() once in the parent (e.g., gunicorn --preload) so that workers share
+    the tenants and the parsed signing keys copy-on-write, and call post_fork() in each worker.
+    :param config: optional dict of config values overriding those of the service config file.
+    :return: the flask app.
+    """
+    report = StartupReport()
+    with report.phase('config'):
+        if config:
+            conf.update(config)
+        init_components()
+    with report.phase('tenants'):
+        tenants.reload_tenants()
+        logger.debug("got tenants; tenants.tenants.keys(): %s", tenants.tenants.keys())
+    with report.phase('service_tokens'):
+        t = auth.init_service_client(report)
+        site_router.set_base_url(t.base_url)
+    with report.phase('signing_keys'):
+        auth.init_signing_keys(report)
+        # seed the revocation index from the shared revocation file, if there is one, and keep it in sync --
+        revocation_index.sync()
+        revocation_index.start()
+        # receive the keys rotated by the other workers and replicas --
+        key_propagator.start()
+    with report.phase('app'):
+        app = build_app()
+        ledger.start(app)
+        if conf.compact_refresh_tokens:
+            refresh_token_store.start(app)
+    report.log()
+    return app
+
+
+def init_components():
+    """
+    Configure the service objects that are created when their module is imported (with default settings) from the
+    service config, so that they see the config overrides passed to create_app().
+    """
+    logs.init()
+    auth.init_caches()
+    signing.init()
+    init_revocation()
+    init_profiler()
+    init_ledger()
+    init_refresh_token_store()
+    init_token_responses()
+    init_key_propagator()
+
+
+def build_app():
+    """
+    Build the flask app: the database objects, the authentication hook and the API resources.
+    """
+    app = Flask('service')
+    app.config['SQLALCHEMY_DATABASE_URI'] = conf.sql_db_url
+    db.init_app(app)
+    # the tables of the refresh token store and the issuance ledger are created by the migrations in service/migrations,
+    # which are applied before the service is started (make migrate.upgrade), not here --
+    migrate.init_app(app, db)
+
+    # request metrics, profiling and debug log sampling; registered first, so that authn_and_authz is included ---
+    @app.before_request
+    def start_request_metrics():
+        logs.sample_request_debug()
+        g.profile = profiler.start()
+        g.request_start = time.perf_counter()
+        g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+        requests_in_flight.inc(g.metrics_route, request.method)
+        if conf.server_timing_enabled:
+            request_timings.set([])
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start' in g:
+            elapsed = time.perf_counter() - g.request_start
+            request_duration.observe(g.metrics_route, request.method, response.status_code, value=elapsed)
+            timings = request_timings.get()
+            if timings is not None:
+                response.headers['Server-Timing'] = format_server_timing(timings, total=elapsed)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        if 'metrics_route' in g:
+            requests_in_flight.dec(g.metrics_route, request.method)
+        request_timings.set(None)
+        logs.debug_sampled.set(True)
+        if g.get('profile'):
+            profiler.stop(g.profile)
+
+    # authentication and authorization ---
+    @app.before_request
+    def authnz_for_authenticator():
+        with time_phase('authn_and_authz'):
+            auth.authn_and_authz()
+
+    # flask restful API object ----
+    api = TapisApi(app, errors=flask_errors_dict)
+
+    # Set up error handling
+    api.handle_error = handle_error
+    api.handle_exception = handle_error
+    api.handle_user_exception = handle_error
+
+    # Add resources
+
+    # Health-checks
+    api.add_resource(ReadyResource, '/v3/tokens/ready')
+    api.add_resource(HelloResource, '/v3/tokens/hello')
+
+    api.add_resource(TokensResource, '/v3/tokens')
+    api.add_resource(TokensBatchResource, '/v3/tokens/batch')
+    api.add_resource(RevokeTokensResource, '/v3/tokens/revoke')
+    api.add_resource(RevokeTokensBatchResource, '/v3/tokens/revoke/batch')
+    api.add_resource(SigningKeysResource, '/v3/tokens/keys')
+    api.add_resource(MetricsResource, '/v3/tokens/metrics')
+    api.add_resource(ProfilingResource, '/v3/tokens/profiling')
+    return app
+
+
+def post_fork(server=None, worker=None):
+    """
+    Re-create the network clients and background threads (including the log writer) in a worker process forked from
+    the process that called create_app(). The tenants and the parsed signing keys are left as they are and shared
+    with the parent copy-on-write. The signature matches gunicorn's post_fork server hook, so a gunicorn config file can use:
+
+        from service.factory import post_fork
+    """
+    logs.post_fork()
+    auth.post_fork()
+    site_router.post_fork()
+    revocation_index.post_fork()
+    signing_keys.post_fork()
+    ledger.post_fork()
+    refresh_token_store.post_fork()
+    key_propagator.post_fork()
+    if conf.use_sk and conf.signing_key_loading == 'lazy':
+        # keys the parent had not loaded yet are warmed in each worker --
+        auth.start_signing_key_warmer()
+    logger.info("Tokens API worker initialized after fork.")
@@ -0,0 +1,192 @@
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import threading
+import time
+
+from flask import request
+from tapisservice.config import conf
+from tapisservice import errors
+
+from service.caches import TTLCache
+from service.ledger import get_caller
+from service.revocation import revocation_index
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+
+
+def request_digest(validated_body, caller):
+    """
+    A canonical hash of a validated token request and its caller: two requests have the same digest when the same
+    caller asks for the same token, whatever the order of the properties in the request JSON.
+    """
+    canonical = json.dumps([caller, vars(validated_body)], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CachedTokenResponse(object):
+    """
+    The result of a token request, as returned by TokensResource.generate_tokens(), with the exp of each token.
+    """
+    __slots__ = ('digest', 'result', 'exps')
+
+    def __init__(self, digest, result):
+        self.digest = digest
+        self.result = result
+        self.exps = {name: datetime.datetime.fromisoformat(token['expires_at']).timestamp()
+                     for name, token in result.items()}
+
+    def remaining(self, now):
+        """
+        The remaining lifetime of the shortest lived token of the response, in seconds.
+        """
+        return min(self.exps.values()) - now
+
+    def revoked(self):
+        return any(revocation_index.is_revoked(token['jti']) for token in self.result.values())
+
+    def fresh_result(self, now):
+        """
+        The result, with the expires_in of each token set to its remaining lifetime.
+        """
+        return {name: dict(token, expires_in=max(0, int(self.exps[name] - now)))
+                for name, token in self.result.items()}
+
+
+class TokenResponseCache(object):
+    """
+    Returns the signed tokens of an earlier token request instead of signing new ones, in two cases:
+      - idempotent requests: a request with an Idempotency-Key header gets the response of the earlier request of
+        the same caller with the same key, for up to `idempotency_key_ttl` seconds. Reusing a key for a different
+        request is an error.
+      - token reuse (opt-in, when `reuse_max_age` is not 0): a request gets the response of an earlier identical
+        request (same validated body, same caller; see request_digest()) made at most `reuse_max_age` seconds
+        ago, as long as its tokens have more than `reuse_min_remaining` seconds left.
+    Both stores are bounded LRU caches with a per-entry ttl, which never exceeds the lifetime of the tokens, and
+    keyed by the token tenant, so that rotating the tenant's signing key can drop its entries. Revoked tokens are
+    never returned. The expires_in of the returned tokens is their remaining lifetime.
+
+    Requests with the same Idempotency-Key are single-flight (see get_or_generate()). The caches are in-process: each
+    worker process has its own, so a request handled by a different worker or replica than the earlier one with the
+    same key gets new tokens.
+    """
+    def __init__(self, maxsize=0, idempotency_key_ttl=0, reuse_max_age=0, reuse_min_remaining=300):
+        self.idempotency_keys = TTLCache('idempotency_keys', maxsize=maxsize, ttl=idempotency_key_ttl)
+        self.reusable_tokens = TTLCache('reusable_tokens', maxsize=maxsize, ttl=reuse_max_age)
+        self.reuse_min_remaining = reuse_min_remaining
+        # the requests in progress for an idempotency key, as a map of (tenant_id, caller, key) -> Future --
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, idempotency_key_ttl, reuse_max_age, reuse_min_remaining):
+        """
+        Change the size and ttls of the caches, dropping their entries.
+        """
+        self.idempotency_keys.configure(maxsize=maxsize, ttl=idempotency_key_ttl)
+        self.reusable_tokens.configure(maxsize=maxsize, ttl=reuse_max_age)
+        self.reuse_min_remaining = reuse_min_remaining
+
+    def get_or_generate(self, validated_body, generate):
+        """
+        Return the response of an earlier request for the current request (see get()), or generate a new one with
+        `generate(validated_body)` and store it. Requests with the same Idempotency-Key (from the same caller, for the
+        same tenant) are single-flight: while one of them is in progress, the others wait for it and then get its
+        tokens from the cache, instead of signing their own. If it fails, the next one generates the tokens.
+        :return: the result.
+        """
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER) if self.idempotency_keys.enabled else None
+        if not idempotency_key:
+            return self._get_or_generate(validated_body, generate)
+        flight = (getattr(validated_body, 'token_tenant_id', None), get_caller(), idempotency_key)
+        while True:
+            with self._lock:
+                future = self._inflight.get(flight)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    self._inflight[flight] = future
+                    break
+            future.result()
+        try:
+            return self._get_or_generate(validated_body, generate)
+        finally:
+            with self._lock:
+                self._inflight.pop(flight, None)
+            future.set_result(None)
+
+    def _get_or_generate(self, validated_body, generate):
+        result, digest = self.get(validated_body)
+        if result is None:
+            result = generate(validated_body)
+            self.set(validated_body, digest, result)
+        return result
+
+    def get(self, validated_body):
+        """
+        Look up the response of an earlier request for the current request.
+        :return: (result, digest): the result to return, or None if a new token must be generated, and the digest of
+                 the request, to pass to set().
+        """
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER) if self.idempotency_keys.enabled else None
+        if not idempotency_key and not self.reusable_tokens.enabled:
+            return None, None
+        caller = get_caller()
+        digest = request_digest(validated_body, caller)
+        tenant_id = getattr(validated_body, 'token_tenant_id', None)
+        now = time.time()
+        if idempotency_key:
+            cached = self.idempotency_keys.get((tenant_id, caller, idempotency_key))
+            if cached:
+                if not cached.digest == digest:
+                    raise errors.ResourceError(msg=f'Invalid POST data: the {IDEMPOTENCY_KEY_HEADER} has already been '
+                                                   f'used for a different token request.', code=422)
+                if not cached.revoked():
+                    return cached.fresh_result(now), digest
+        if self.reusable_tokens.enabled:
+            cached = self.reusable_tokens.get((tenant_id, digest))
+            if cached and cached.remaining(now) > self.reuse_min_remaining and not cached.revoked():
+                return cached.fresh_result(now), digest
+        return None, digest
+
+    def set(self, validated_body, digest, result):
+        """
+        Store the result of the current request.
+        """
+        if digest is None:
+            return
+        cached = CachedTokenResponse(digest, result)
+        tenant_id = getattr(validated_body, 'token_tenant_id', None)
+        remaining = cached.remaining(time.time())
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if idempotency_key and self.idempotency_keys.enabled:
+            self.idempotency_keys.set((tenant_id, get_caller(), idempotency_key), cached,
+                                      ttl=min(self.idempotency_keys.ttl, remaining))
+        reuse_ttl = min(self.reusable_tokens.ttl, remaining - self.reuse_min_remaining)
+        if reuse_ttl > 0:
+            self.reusable_tokens.set((tenant_id, digest), cached, ttl=reuse_ttl)
+
+    def invalidate_tenant(self, tenant_id):
+        """
+        Drop the entries of a tenant, e.g., when its signing key is rotated.
+        """
+        return (self.idempotency_keys.invalidate(match=lambda key: key[0] == tenant_id) +
+                self.reusable_tokens.invalidate(match=lambda key: key[0] == tenant_id))
+
+
+# singleton cache of token responses, used by POST /v3/tokens; disabled until configured by init().
+token_responses = TokenResponseCache()
+
+
+def init():
+    """
+    Configure the token response cache from the service config. Called by create_app(), after any config overrides
+    are applied.
+    """
+    token_responses.configure(maxsize=conf.token_response_cache_max_size,
+                              idempotency_key_ttl=conf.idempotency_key_ttl,
+                              reuse_max_age=conf.token_reuse_max_age,
+                              reuse_min_remaining=conf.token_reuse_min_remaining)
@@ -0,0 +1,310 @@
+"""
+Propagation of rotated signing keys to every worker and replica of the Tokens API.
+
+When a tenant's signing key is rotated (PUT /v3/tokens/keys), the worker handling the request loads the new key and
+publishes the tenant id and the new key's version, the version of the key's secret in the SK, on a key channel. The
+other workers and replicas receive the message and, in a background thread, load the key from the SK if its version is
+newer than theirs; requests keep being signed with the old key until the new one is loaded, and never wait on the SK.
+Only versions travel on the channel, never key material.
+
+Channels (the key_channel config):
+  - "none": no propagation (the default).
+  - "directory": a directory shared by the workers (and, on a shared volume, the replicas), with one file per tenant
+    holding its latest version, polled every key_channel_poll_interval seconds.
+  - "local": an in-process stand-in for a pub/sub backend, delivering messages to the subscribers of this process.
+  - "package.module:Class": a custom pub/sub backend, implementing the KeyChannel interface.
+"""
+import concurrent.futures
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from tapisservice.config import conf
+
+from service import auth
+from service.idempotency import token_responses
+from service.keys import signing_keys
+from service.metrics import Counter, metrics
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+key_versions_published = metrics.add(Counter('tokens_key_versions_published_total',
+                                             'Signing key versions published on the key channel.'))
+key_versions_loaded = metrics.add(Counter('tokens_key_versions_loaded_total',
+                                          'Signing keys loaded from the SK after a newer version was received on the '
+                                          'key channel.',
+                                          labels=('tenant_id',)))
+key_version_load_failures = metrics.add(Counter('tokens_key_version_load_failures_total',
+                                                'Signing key versions received on the key channel that could not be '
+                                                'loaded from the SK.',
+                                                labels=('tenant_id',)))
+
+
+class KeyChannel(object):
+    """
+    Interface of the key channels: publish() sends a (tenant_id, version) message to every subscriber, including
+    those of other processes, and start() subscribes `callback`, a function of (tenant_id, version), to the messages.
+    Callbacks must not block; the KeyPropagator's callback only schedules the key load.
+    """
+    def publish(self, tenant_id, version):
+        raise NotImplementedError
+
+    def start(self, callback):
+        raise NotImplementedError
+
+    def post_fork(self):
+        """
+        Re-create the channel's threads and connections in a forked worker process.
+        """
+        pass
+
+    def stop(self):
+        pass
+
+
+class LocalKeyChannel(KeyChannel):
+    """
+    In-process stand-in for a pub/sub backend: messages are delivered, synchronously, to the subscribers of every
+    LocalKeyChannel of this process. Used for tests and single-process deployments, and as a template for pub/sub
+    backends.
+    """
+    _subscribers = []
+    _lock = threading.Lock()
+
+    def publish(self, tenant_id, version):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(tenant_id, version)
+
+    def __init__(self):
+        self._callback = None
+
+    def start(self, callback):
+        self._callback = callback
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def stop(self):
+        with self._lock:
+            if self._callback in self._subscribers:
+                self._subscribers.remove(self._callback)
+
+
+class DirectoryKeyChannel(KeyChannel):
+    """
+    Key channel over a shared directory: publish() atomically replaces the tenant's file, <tenant_id>.json, with its
+    new version, and a background thread checks the directory for changed files every `poll_interval` seconds, so
+    that subscribers receive a new version at most `poll_interval` seconds after it was published.
+    """
+    def __init__(self, path, poll_interval=2):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._callback = None
+        self._thread = None
+        self._stopped = threading.Event()
+        # file name -> mtime of the files already read
+        self._seen = {}
+
+    def publish(self, tenant_id, version):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tenant_id': tenant_id, 'version': version}, f)
+        os.replace(tmp_path, os.path.join(self.path, f'{tenant_id}.json'))
+
+    def start(self, callback):
+        self._callback = callback
+        self._start_watcher()
+
+    def _start_watcher(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name='key-channel-watcher', daemon=True)
+        self._thread.start()
+
+    def post_fork(self):
+        if self._callback:
+            self._start_watcher()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            self.poll()
+            self._stopped.wait(self.poll_interval)
+
+    def poll(self):
+        """
+        Deliver the versions of the files that changed since the last poll.
+        """
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.endswith('.json') or entry.name.startswith('.'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime_ns
+                if self._seen.get(entry.name) == mtime:
+                    continue
+                with open(entry.path, 'r') as f:
+                    message = json.load(f)
+                self._seen[entry.name] = mtime
+                self._callback(message['tenant_id'], message['version'])
+            except Exception as e:
+                logger.error("could not read key channel file %s; e: %s", entry.path, e)
+
+
+class KeyPropagator(object):
+    """
+    Publishes the versions of the keys rotated by this worker and loads, in a background thread, the keys rotated by
+    other workers. A received version is loaded only if it is newer than the registry's, with one load in progress per
+    tenant at a time. The SK can briefly return the previous version of the key after a rotation; the load is then
+    retried, up to `retries` times, every `retry_delay` seconds.
+    """
+    def __init__(self, channel=None, retries=5, retry_delay=1):
+        self.configure(channel, retries, retry_delay)
+        self._lock = threading.Lock()
+        # tenant_id -> the highest version received and not loaded yet
+        self._pending = {}
+        self._pool = None
+
+    def configure(self, channel, retries=5, retry_delay=1):
+        """
+        Set the key channel and the retries of the loads; called before the propagator is started.
+        """
+        self.channel = channel
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def start(self):
+        if not self.channel:
+            return
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='key-propagation')
+        self.channel.start(self.on_version)
+        logger.info("signing key propagation started with the %s.", type(self.channel).__name__)
+
+    def stop(self):
+        """
+        Unsubscribe from the key channel and stop the loads once the scheduled ones are done.
+        """
+        if not self._pool:
+            return
+        self.channel.stop()
+        self._pool.shutdown(wait=False)
+
+    def post_fork(self):
+        if not self._pool:
+            return
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='key-propagation')
+        self.channel.post_fork()
+
+    def publish(self, tenant_id, version):
+        """
+        Publish the new version of a tenant's key. Errors are logged, not raised: the key has been rotated in the SK
+        either way, and the other workers load it when they restart.
+        """
+        if not self.channel:
+            return
+        if not version:
+            # the other workers only load versions newer than theirs, so an unknown version (0) would never be loaded --
+            logger.error("the SK returned no version for the new signing key of tenant %s, so it cannot be published; "
+                         "other workers will keep signing with the old key until they restart.", tenant_id)
+            return
+        try:
+            self.channel.publish(tenant_id, version)
+            key_versions_published.inc()
+        except Exception as e:
+            logger.error("could not publish version %s of the signing key of tenant %s; other workers will keep "
+                         "signing with the old key. e: %s", version, tenant_id, e)
+
+    def on_version(self, tenant_id, version):
+        """
+        Channel callback: schedule the load of a tenant's key if `version` is newer than the one in the registry.
+        """
+        if not conf.use_sk:
+            return
+        current = signing_keys.get_version(tenant_id)
+        # keys that are not loaded yet are loaded, at their latest version, when first used --
+        if current is None or version <= current:
+            return
+        with self._lock:
+            scheduled = tenant_id in self._pending
+            if scheduled and version <= self._pending[tenant_id]:
+                return
+            self._pending[tenant_id] = version
+        if not scheduled:
+            logger.info("received version %s of the signing key of tenant %s; loading it.", version, tenant_id)
+            self._pool.submit(self.load, tenant_id)
+
+    def load(self, tenant_id):
+        """
+        Load a tenant's key from the SK until the registry has the latest version received.
+        """
+        attempts = 0
+        while True:
+            with self._lock:
+                version = self._pending[tenant_id]
+            try:
+                auth.load_signing_key_from_sk(tenant_id)
+            except Exception as e:
+                logger.error("could not load the signing key of tenant %s from the SK; e: %s", tenant_id, e)
+            loaded = signing_keys.get_version(tenant_id)
+            if loaded is not None and loaded >= version:
+                with self._lock:
+                    # a newer version may have been received during the load --
+                    if self._pending[tenant_id] <= loaded:
+                        del self._pending[tenant_id]
+                        break
+                continue
+            attempts += 1
+            if attempts > self.retries:
+                key_version_load_failures.inc(tenant_id)
+                logger.error("gave up loading version %s of the signing key of tenant %s; the SK has version %s.",
+                             version, tenant_id, loaded)
+                with self._lock:
+                    del self._pending[tenant_id]
+                return
+            time.sleep(self.retry_delay)
+        key_versions_loaded.inc(tenant_id)
+        # tokens signed with the old key are no longer valid --
+        token_responses.invalidate_tenant(tenant_id)
+        logger.info("loaded version %s of the signing key of tenant %s.", loaded, tenant_id)
+
+
+def get_key_channel():
+    """
+    Build the key channel selected by the key_channel config, or return None when key propagation is disabled.
+    """
+    channel = conf.key_channel
+    if not channel or channel == 'none':
+        return None
+    if channel == 'directory':
+        return DirectoryKeyChannel(conf.key_channel_dir, poll_interval=conf.key_channel_poll_interval)
+    if channel == 'local':
+        return LocalKeyChannel()
+    module_name, _, class_name = channel.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# singleton key propagator; configured by init() and started by create_app().
+key_propagator = KeyPropagator()
+
+
+def init():
+    """
+    Configure the key propagator from the service config. Called by create_app(), after any config overrides are
+    applied.
+    """
+    key_propagator.configure(get_key_channel(),
+                             retries=conf.key_fetch_retries,
+                             retry_delay=conf.key_fetch_retry_delay)
@@ -0,0 +1,268 @@
+import concurrent.futures
+import hashlib
+import json
+import threading
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519, rsa
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_encode
+from tapisservice import errors
+
+from service.metrics import metrics
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+# JWT signing algorithms the Tokens API can sign with. The algorithm is configured per tenant; see the
+# tenant_signing_algorithms config.
+SUPPORTED_ALGORITHMS = ('RS256', 'ES256', 'EdDSA')
+
+# the private key types each algorithm signs with, and a description of them for error messages --
+KEY_TYPES = {'RS256': ((rsa.RSAPrivateKey,), 'an RSA private key'),
+             'ES256': ((ec.EllipticCurvePrivateKey,), 'an EC P-256 private key'),
+             'EdDSA': ((ed25519.Ed25519PrivateKey, ed448.Ed448PrivateKey), 'an Ed25519 or Ed448 private key')}
+
+
+def check_key_type(tenant_id, private_key, alg):
+    """
+    Raise a ServiceConfigError if a parsed private key cannot sign tokens with `alg`, e.g., the RSA
+    site_admin_privatekey for a tenant configured for ES256.
+    """
+    key_types, description = KEY_TYPES[alg]
+    if isinstance(private_key, key_types) \
+            and not (alg == 'ES256' and not isinstance(private_key.curve, ec.SECP256R1)):
+        return
+    msg = f"The signing key of tenant {tenant_id} is not {description}, so it cannot sign {alg} tokens; the " \
+          f"tenant's signing key must match its signing algorithm (see tenant_signing_algorithms)."
+    logger.error(msg)
+    raise errors.ServiceConfigError(msg)
+
+
+class SigningKey(object):
+    """
+    A tenant's signing key, held both as the PEM string (as stored in the SK/config) and as the parsed
+    `cryptography` key object used to actually sign tokens. Instances are never mutated after creation; the
+    registry replaces the whole object when a key changes.
+    """
+    def __init__(self, tenant_id, private_key_pem, alg='RS256', version=0):
+        self.tenant_id = tenant_id
+        self.alg = alg
+        # the version of the key's secret in the SK, which increases with every rotation; 0 when unknown (e.g., keys
+        # from the config).
+        self.version = version
+        self.private_key_pem = private_key_pem
+        # identifies the key material, so that processes holding a parsed copy of the key (e.g., the signing pool
+        # workers) can be sent this id instead of the PEM.
+        self.key_id = hashlib.sha256(private_key_pem.encode('utf-8')).hexdigest()
+        # parse the PEM the way PyJWT would have (as an unencrypted PEM private key), so that signing with the key
+        # object is equivalent to passing the PEM string to jwt.encode, and check that it matches the algorithm
+        # before PyJWT does, for a clearer error.
+        self.algorithm = get_default_algorithms()[alg]
+        try:
+            private_key = serialization.load_pem_private_key(private_key_pem.encode('utf-8'), password=None)
+        except Exception as e:
+            msg = f"Could not parse the signing key of tenant {tenant_id} as a PEM private key; e: {e}"
+            logger.error(msg)
+            raise errors.ServiceConfigError(msg)
+        check_key_type(tenant_id, private_key, alg)
+        self.private_key = self.algorithm.prepare_key(private_key)
+        # the public key is derived from the private key, so tokens signed by this Tokens API can be verified
+        # locally without the tenant's public key from the Tenants API.
+        self.public_key = self.private_key.public_key()
+        # the base64url JWT header of the tokens signed with this key, serialized the way PyJWT does (sorted keys,
+        # compact separators). It only depends on the tenant's key and algorithm, so it is built once, here, instead
+        # of for every token; see service.signing.encode_token().
+        self.header_segment = base64url_encode(json.dumps({'alg': alg, 'typ': 'JWT'}, separators=(',', ':'),
+                                                          sort_keys=True).encode('utf-8'))
+
+
+class SigningKeyRegistry(object):
+    """
+    Per-tenant registry of parsed signing keys. Keys are parsed once, when they are set, instead of on every call
+    to TapisToken.sign_token(). Lookups are lock-free dictionary reads; updates build the new SigningKey object
+    first and then swap it in under a lock, so readers always see either the old key or the new key.
+    """
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+        # lazy loading: the function that loads a tenant's key into the registry, and the in-flight loads, as a
+        # map of tenant_id -> Future
+        self._loader = None
+        self._inflight = {}
+        self._prefetch_pool = None
+        # counters --
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.loads = 0
+        self.load_failures = 0
+
+    def set_key(self, tenant_id, private_key_pem, alg='RS256', version=0):
+        """
+        Parse and store the signing key for a tenant, replacing any existing key.
+        :param tenant_id: (str) the tenant id.
+        :param private_key_pem: (str) the private key, in PEM format.
+        :param alg: (str) the JWT signing algorithm the key is used with.
+        :param version: (int) the version of the key in the SK, if known.
+        :return: SigningKey
+        """
+        key = SigningKey(tenant_id, private_key_pem, alg, version)
+        with self._lock:
+            self._keys[tenant_id] = key
+            self.reloads += 1
+        logger.debug("signing key for tenant %s loaded into the registry.", tenant_id)
+        return key
+
+    def get_key(self, tenant):
+        """
+        Return the SigningKey for a tenant object (as returned by the tenant cache). If the registry does not yet
+        have a key for the tenant, the key is loaded with the loader when lazy loading is enabled (see set_loader());
+        otherwise, it is parsed from the tenant's private_key attribute and stored.
+        :param tenant: a tenant object from the TokensTenants cache.
+        :return: SigningKey
+        """
+        key = self._keys.get(tenant.tenant_id)
+        if key:
+            self.hits += 1
+            return key
+        self.misses += 1
+        if self._loader:
+            return self.load(tenant.tenant_id)
+        return self.set_key(tenant.tenant_id, tenant.private_key, getattr(tenant, 'signing_alg', 'RS256'))
+
+    def set_loader(self, loader, prefetch_workers=4):
+        """
+        Enable lazy loading: keys missing from the registry are loaded on first use by calling `loader(tenant_id)`,
+        which must load the tenant's key with set_key().
+        :param loader: function taking a tenant id.
+        :param prefetch_workers: (int) the number of threads used by prefetch().
+        """
+        self._loader = loader
+        self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_workers,
+                                                                    thread_name_prefix='signing-key-load')
+
+    def load(self, tenant_id):
+        """
+        Load the key for a tenant with the loader, unless the registry already has it. Loads are single-flight:
+        concurrent calls for the same tenant wait on the one load in progress and get its result (or its exception).
+        Failed loads are not cached; the next call tries again.
+        :return: SigningKey
+        """
+        with self._lock:
+            key = self._keys.get(tenant_id)
+            if key:
+                return key
+            future = self._inflight.get(tenant_id)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._inflight[tenant_id] = future
+        if not owner:
+            return future.result()
+        try:
+            self._loader(tenant_id)
+            key = self._keys[tenant_id]
+            self.loads += 1
+            future.set_result(key)
+        except Exception as e:
+            self.load_failures += 1
+            logger.error("could not load the signing key for tenant %s; e: %s", tenant_id, e)
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(tenant_id, None)
+        return future.result()
+
+    def prefetch(self, tenant_id):
+        """
+        Start loading the key for a tenant in the background, if lazy loading is enabled and the registry does not
+        have it yet, so that the load overlaps with the rest of the request. Does not wait for the load.
+        """
+        if not self._loader or tenant_id in self._keys or tenant_id in self._inflight:
+            return
+        self._prefetch_pool.submit(self._prefetch, tenant_id)
+
+    def post_fork(self):
+        """
+        Reset the lazy loading state in a forked worker process: threads (and loads in flight in them) do not survive
+        a fork, so the in-flight loads are dropped and the prefetch pool is re-created. Loaded keys are kept.
+        """
+        self._lock = threading.Lock()
+        self._inflight = {}
+        if self._loader:
+            self._prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._prefetch_pool._max_workers,
+                                                                        thread_name_prefix='signing-key-load')
+
+    def _prefetch(self, tenant_id):
+        try:
+            self.load(tenant_id)
+        except Exception:
+            # already logged by load(); the request that needs the key will try again.
+            pass
+
+    def get_pem(self, tenant_id):
+        """
+        Return the PEM for a tenant's signing key, or None if the registry does not have a key for the tenant.
+        """
+        key = self._keys.get(tenant_id)
+        if key:
+            return key.private_key_pem
+        return None
+
+    def get_version(self, tenant_id):
+        """
+        Return the version of a tenant's signing key, or None if the registry does not have a key for the tenant.
+        """
+        key = self._keys.get(tenant_id)
+        if key:
+            return key.version
+        return None
+
+    def keys(self):
+        """
+        Return a list of all SigningKey objects currently in the registry.
+        """
+        return list(self._keys.values())
+
+    def remove_key(self, tenant_id):
+        with self._lock:
+            self._keys.pop(tenant_id, None)
+
+    def stats(self):
+        """
+        Return the registry counters as a dictionary.
+        """
+        return {'tenants': len(self._keys),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'loads': self.loads,
+                'load_failures': self.load_failures}
+
+
+def generate_keypair(alg):
+    """
+    Generate a new private/public key pair for one of the elliptic curve algorithms. (RS256 key pairs are generated
+    by the SK.)
+    :param alg: (str) ES256 or EdDSA.
+    :return: (private_key, public_key) as PEM strings.
+    """
+    if alg == 'ES256':
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    elif alg == 'EdDSA':
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Cannot generate a key pair for algorithm {alg}.")
+    private_pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                            format=serialization.PrivateFormat.PKCS8,
+                                            encryption_algorithm=serialization.NoEncryption())
+    public_pem = private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                                       format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_pem.decode('utf-8'), public_pem.decode('utf-8')
+
+
+# singleton registry of signing keys for all tenants served by this Tokens API.
+signing_keys = SigningKeyRegistry()
+metrics.register_cache('signing_keys', signing_keys)
@@ -0,0 +1,221 @@
+import atexit
+import queue
+import threading
+import time
+
+from flask import g, has_request_context, request
+from tapisservice.config import conf
+
+from service import db
+from service.metrics import Counter, metrics
+from service.models import ACCOUNT_TYPE_CLAIM, TENANT_ID_CLAIM, TOKEN_TYPE_CLAIM, IssuanceRecord
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+ledger_records_written = metrics.add(Counter('tokens_ledger_records_written_total',
+                                             'Issuance ledger records written to the database.'))
+ledger_records_dropped = metrics.add(Counter('tokens_ledger_records_dropped_total',
+                                             'Issuance ledger records dropped because the ledger queue was full.'))
+ledger_records_failed = metrics.add(Counter('tokens_ledger_records_failed_total',
+                                            'Issuance ledger records lost because writing them to the database '
+                                            'failed.'))
+ledger_queue_full = metrics.add(Counter('tokens_ledger_queue_full_total',
+                                        'Times a request found the ledger queue full and had to wait '
+                                        '(ledger_enqueue_timeout) or drop its record.'))
+
+# put on the queue to stop the writer --
+_STOP = object()
+
+
+def get_caller():
+    """
+    Returns the authenticated caller of the current request, as username@tenant_id: the user of the Tapis token or
+    of the HTTP Basic Auth header. None outside of a request, or for unauthenticated requests (e.g., refreshes).
+    """
+    if not has_request_context():
+        return None
+    username = g.get('username')
+    if username:
+        return f"{username}@{g.get('tenant_id')}"
+    if request.authorization and request.authorization.username:
+        return f"{request.authorization.username}@{g.get('request_tenant_id')}"
+    return None
+
+
+class IssuanceLedger(object):
+    """
+    Audit trail of the tokens issued, refreshed and revoked, in the token_ledger table of the Tokens API database.
+
+    Requests do not write to the database: they put a record on a bounded queue (at most `queue_size` records) and
+    a background thread writes the records in multi-row inserts of up to `batch_size` rows, at the latest
+    `flush_interval` seconds after the first record of a batch was queued. When the queue is full, requests wait up
+    to `enqueue_timeout` seconds for room (0, the default, does not wait) and then drop the record; both are
+    counted, as are the records lost to failed writes, so that gaps in the ledger are visible in the metrics.
+    """
+    def __init__(self, enabled=False, queue_size=10000, batch_size=500, flush_interval=1.0, enqueue_timeout=0):
+        self.configure(enabled, queue_size, batch_size, flush_interval, enqueue_timeout)
+        self._queue = None
+        self._thread = None
+        self._engine = None
+
+    def configure(self, enabled=False, queue_size=10000, batch_size=500, flush_interval=1.0, enqueue_timeout=0):
+        """
+        Set the ledger's config; called before the ledger is started.
+        """
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+
+    def start(self, app):
+        """
+        Start the writer, using the database engine of `app`. Does nothing when the ledger is not enabled.
+        """
+        if not self.enabled or self._thread:
+            return
+        with app.app_context():
+            self._engine = db.engine
+        self._start_writer()
+        atexit.register(self.stop)
+
+    def _start_writer(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run, name='token-ledger-writer', daemon=True)
+        self._thread.start()
+
+    def post_fork(self):
+        """
+        Start a new writer in a worker process forked from the process that started the ledger; the writer's thread
+        does not survive the fork, and the database connections are not shared with the parent.
+        """
+        if not self._thread:
+            return
+        self._engine.dispose(close=False)
+        self._start_writer()
+
+    def stop(self, timeout=5):
+        """
+        Write the queued records and stop the writer.
+        """
+        if not self._thread or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error("could not stop the ledger writer; the queued records are lost.")
+            return
+        self._thread.join(timeout)
+
+    def add_token(self, event, token):
+        """
+        Record an event ('issue' or 'refresh') for a signed TapisToken. Does nothing unless the ledger was started.
+        """
+        if self._queue is None:
+            return
+        self._enqueue({'event': event,
+                       'jti': token.jti,
+                       'sub': token.sub,
+                       'tenant_id': token.tenant_id,
+                       'account_type': token.account_type,
+                       'token_type': token.token_type,
+                       'exp': int(token.exp.timestamp()),
+                       'created': int(time.time()),
+                       'caller': get_caller()})
+
+    def add_claims(self, event, claims):
+        """
+        Record an event ('revoke') for a token, from its verified claims.
+        """
+        if self._queue is None:
+            return
+        self._enqueue({'event': event,
+                       'jti': claims.get('jti'),
+                       'sub': claims.get('sub'),
+                       'tenant_id': claims.get(TENANT_ID_CLAIM),
+                       # refresh tokens do not have an account type claim --
+                       'account_type': claims.get(ACCOUNT_TYPE_CLAIM),
+                       'token_type': claims.get(TOKEN_TYPE_CLAIM),
+                       'exp': claims.get('exp'),
+                       'created': int(time.time()),
+                       'caller': get_caller()})
+
+    def _enqueue(self, record):
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            ledger_queue_full.inc()
+        if self.enqueue_timeout > 0:
+            try:
+                self._queue.put(record, timeout=self.enqueue_timeout)
+                return
+            except queue.Full:
+                pass
+        ledger_records_dropped.inc()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                record = self._queue.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                # the batch is due --
+                record = None
+            if record is _STOP:
+                self.flush(batch)
+                return
+            if record is not None:
+                batch.append(record)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (record is None or len(batch) >= self.batch_size):
+                self.flush(batch)
+                batch = []
+                deadline = None
+
+    def flush(self, records):
+        """
+        Write `records` to the database in one multi-row insert.
+        """
+        if not records:
+            return
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(IssuanceRecord.__table__.insert(), records)
+        except Exception as e:
+            ledger_records_failed.inc(amount=len(records))
+            logger.error("could not write %s records to the issuance ledger; e: %s", len(records), e)
+            return
+        ledger_records_written.inc(amount=len(records))
+
+    @staticmethod
+    def find_by_sub(sub, tenant_id=None):
+        """
+        Look up the ledger records of a subject (e.g., to revoke all of its tokens), newest first. Must be called in an
+        app context.
+        :return: list of IssuanceRecord.
+        """
+        query = IssuanceRecord.query.filter_by(sub=sub)
+        if tenant_id:
+            query = query.filter_by(tenant_id=tenant_id)
+        return query.order_by(IssuanceRecord.id.desc()).all()
+
+
+# singleton ledger; configured by init(), and the writer is started, and the table created, by build_app() when
+# ledger_enabled is set.
+ledger = IssuanceLedger()
+
+
+def init():
+    """
+    Configure the ledger from the service config. Called by create_app(), after any config overrides are applied.
+    """
+    ledger.configure(enabled=conf.ledger_enabled,
+                     queue_size=conf.ledger_queue_size,
+                     batch_size=conf.ledger_batch_size,
+                     flush_interval=conf.ledger_flush_interval,
+                     enqueue_timeout=conf.ledger_enqueue_timeout)
@@ -0,0 +1,272 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import threading
+
+from tapisservice.config import conf
+from tapisservice.logs import get_logger as get_tapis_logger
+
+from service.metrics import Counter, metrics
+
+REDACTED = '<redacted>'
+
+# structured fields that are never written to the logs --
+SECRET_FIELDS = frozenset(('password', 'allservices_password', 'private_key', 'privateKey', 'site_admin_privatekey',
+                           'jwt', 'token', 'access_token', 'refresh_token', 'secret', 'secretMap'))
+
+# key material and token strings that made it into a formatted message anyway: PEM blocks and JWTs
+_SECRET_PATTERN = re.compile(r'-----BEGIN [A-Z ]+-----.*?-----END [A-Z ]+-----'
+                             r'|eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*', re.S)
+
+log_records_dropped = metrics.add(Counter('tokens_log_records_dropped_total',
+                                          'Log records dropped because the log queue was full.'))
+
+# whether the debug records of the current request are written; see sample_request_debug()
+debug_sampled = contextvars.ContextVar('debug_sampled', default=True)
+
+
+def redact(text):
+    """
+    Replace the PEM blocks and JWTs in `text`.
+    """
+    return _SECRET_PATTERN.sub(REDACTED, text)
+
+
+def sample_request_debug():
+    """
+    Decide whether the debug records of the current request are written, keeping a fraction log_debug_sample_rate of
+    the requests. All of the debug records of a sampled request are written, so that its trace is complete. Called at
+    the start of each request.
+    """
+    rate = conf.log_debug_sample_rate
+    debug_sampled.set(rate >= 1 or random.random() < rate)
+
+
+class StructuredMessage(object):
+    """
+    The message of a structured event, formatted as "event name=value ..." only if the record is written.
+    """
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.event] + [f'{name}={value}' for name, value in self.fields.items()])
+
+
+class TokensLogger(logging.LoggerAdapter):
+    """
+    The logger used by the service modules. Debug records are skipped, before any formatting, in requests that were
+    not sampled (see sample_request_debug()), and event() logs structured events. Messages should pass their
+    arguments %-style, e.g., logger.debug("got tenant: %s", tenant_id), so that they are only formatted when the
+    record is written.
+    """
+    def __init__(self, logger):
+        super().__init__(logger, {})
+
+    def process(self, msg, kwargs):
+        # keep the caller's extra --
+        return msg, kwargs
+
+    def isEnabledFor(self, level):
+        if level <= logging.DEBUG and not debug_sampled.get():
+            return False
+        return self.logger.isEnabledFor(level)
+
+    def event(self, level, event, **fields):
+        """
+        Log a structured event with `fields`. Fields named in SECRET_FIELDS are redacted. With the json log format,
+        the fields are written as attributes of the record.
+        """
+        if not self.isEnabledFor(level):
+            return
+        fields = {name: REDACTED if name in SECRET_FIELDS else value for name, value in fields.items()}
+        self.logger.log(level, StructuredMessage(event, fields), extra={'event': event, 'fields': fields},
+                        stacklevel=2)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the fields of structured events as attributes.
+    """
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage(),
+                'location': f'{record.pathname}:{record.lineno}'}
+        if hasattr(record, 'event'):
+            data['event'] = record.event
+            data.update({name: value for name, value in record.fields.items() if name not in data})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Formats the message of the records that are written and redacts the key material and tokens in it.
+    """
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+# formats the exceptions of the records put on the log queue --
+_exception_formatter = logging.Formatter()
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records on the log queue for the background writer, which writes them with `handlers`, the handlers the
+    logger had before. The message is formatted in the calling thread, so that it reflects the values at the time of
+    the call; writing it happens in the background. Records are dropped, and counted, when the queue is full, instead
+    of blocking the request.
+    """
+    def __init__(self, log_queue, handlers):
+        super().__init__(log_queue)
+        self.handlers = handlers
+
+    def prepare(self, record):
+        """
+        Copy the record with its message formatted, and its exception formatted into exc_text, so that the handlers
+        in the background (e.g., the JsonFormatter) still see the exception separately from the message. (The
+        default prepare() folds the traceback into the message.)
+        """
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = redact(_exception_formatter.formatException(record.exc_info))
+            # the traceback keeps the frames of the calling thread alive; it is not needed once formatted --
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((self.handlers, record))
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """
+    Background thread writing the queued records with the handlers they were queued for.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+
+    def handle(self, item):
+        handlers, record = item
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+_lock = threading.Lock()
+_writer = None
+_queue_handlers = []
+# the loggers created before init(), configured by it; loggers created after it are configured when created --
+_pending_loggers = []
+_initialized = False
+
+
+def get_logger(name):
+    """
+    Returns the logger for a service module: the tapisservice logger, with its messages redacted. Once init() has
+    run, its records are written by a background thread when log_async is true, and as JSON when log_format is "json".
+    """
+    logger = get_tapis_logger(name)
+    with _lock:
+        if not any(isinstance(f, RedactingFilter) for f in logger.filters):
+            logger.addFilter(RedactingFilter())
+            if _initialized:
+                _configure(logger)
+            else:
+                _pending_loggers.append(logger)
+    return TokensLogger(logger)
+
+
+def init():
+    """
+    Configure the handlers of the service loggers from the log_format and log_async configs. Called by create_app(),
+    after any config overrides are applied; until then, records are written by the tapisservice handlers, in the
+    calling thread. The handlers are only configured once.
+    """
+    global _initialized
+    with _lock:
+        _initialized = True
+        while _pending_loggers:
+            _configure(_pending_loggers.pop(0))
+
+
+def _configure(logger):
+    """
+    Set the formatter of the handlers of `logger` and route its records to the background writer, as configured.
+    Called with the lock held.
+    """
+    handlers = list(logger.handlers)
+    if conf.log_format == 'json':
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    # loggers without handlers of their own (tapisservice only adds handlers to a logger when none of its ancestors
+    # has any) propagate their records to the ancestor's queue handler --
+    if conf.log_async and handlers:
+        _route_to_writer(logger, handlers)
+
+
+def _route_to_writer(logger, handlers):
+    """
+    Replace the handlers of `logger` with a handler putting its records on the log queue. Called with the lock held.
+    """
+    global _writer
+    if _writer is None:
+        _writer = LogWriter(queue.Queue(conf.log_queue_size))
+        _writer.start()
+        atexit.register(stop)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    queue_handler = LogQueueHandler(_writer.queue, handlers)
+    _queue_handlers.append(queue_handler)
+    logger.addHandler(queue_handler)
+
+
+def stop():
+    """
+    Write the queued records and stop the background writer.
+    """
+    if _writer is None or _writer._thread is None:
+        return
+    try:
+        _writer.stop()
+    except queue.Full:
+        # the queue is still full; the remaining records are lost --
+        pass
+
+
+def post_fork():
+    """
+    Start a new background writer in a worker process forked from the process that created the loggers; the
+    writer's thread does not survive the fork.
+    """
+    global _lock, _writer
+    _lock = threading.Lock()
+    if _writer is None:
+        return
+    _writer = LogWriter(queue.Queue(conf.log_queue_size))
+    for queue_handler in _queue_handlers:
+        queue_handler.queue = _writer.queue
+    _writer.start()
@@ -0,0 +1,211 @@
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric(object):
+    """
+    Base class for the metrics: a name, help text and label names, and the per label-values samples. Each update holds
+    the metric's lock only for a dictionary lookup and an addition, so the metrics can be left on in production.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            samples = list(self._samples.items())
+        for values, sample in samples:
+            lines.extend(self.render_sample(values, sample))
+        return lines
+
+    def render_sample(self, values, sample):
+        return [f'{self.name}{_format_labels(self.labels, values)} {sample}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._samples[values] = self._samples.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._samples[values] = self._samples.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value):
+        with self._lock:
+            self._samples[values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *values, value):
+        # find the bucket outside of the lock; buckets are stored non-cumulatively and summed when rendered.
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            sample = self._samples.get(values)
+            if sample is None:
+                # [counts per bucket (the last one is +Inf), sum]
+                sample = self._samples[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            sample[0][index] += 1
+            sample[1] += value
+
+    def render_sample(self, values, sample):
+        counts, total = sample
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, ("le", bound))} {cumulative}')
+        labels = _format_labels(self.labels, values)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of the Tokens API, rendered in the Prometheus text exposition format by render().
+    Caches are registered with register_cache() and their stats() are read when the metrics are rendered.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.caches = {}
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_cache(self, name, cache):
+        """
+        Report the hits, misses, size and hit ratio of `cache`, an object with a stats() method returning a dict with
+        'hits' and 'misses' and, optionally, 'size'.
+        """
+        self.caches[name] = cache
+
+    def render_caches(self):
+        lines = ['# HELP tokens_cache_hits_total Cache lookups that found an entry.',
+                 '# TYPE tokens_cache_hits_total counter']
+        misses = ['# HELP tokens_cache_misses_total Cache lookups that did not find an entry.',
+                  '# TYPE tokens_cache_misses_total counter']
+        ratios = ['# HELP tokens_cache_hit_ratio Fraction of cache lookups that found an entry.',
+                  '# TYPE tokens_cache_hit_ratio gauge']
+        sizes = ['# HELP tokens_cache_size Number of entries in the cache.',
+                 '# TYPE tokens_cache_size gauge']
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            labels = f'{{cache="{name}"}}'
+            lookups = stats['hits'] + stats['misses']
+            lines.append(f'tokens_cache_hits_total{labels} {stats["hits"]}')
+            misses.append(f'tokens_cache_misses_total{labels} {stats["misses"]}')
+            ratios.append(f'tokens_cache_hit_ratio{labels} {stats["hits"] / lookups if lookups else 0.0}')
+            if 'size' in stats:
+                sizes.append(f'tokens_cache_size{labels} {stats["size"]}')
+        return lines + misses + ratios + sizes
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.extend(self.render_caches())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+request_duration = metrics.add(Histogram('tokens_request_duration_seconds',
+                                         'Latency of requests to the Tokens API.',
+                                         labels=('route', 'method', 'status')))
+requests_in_flight = metrics.add(Gauge('tokens_requests_in_flight',
+                                       'Requests currently being handled.',
+                                       labels=('route', 'method')))
+phase_duration = metrics.add(Histogram('tokens_phase_duration_seconds',
+                                       'Time spent in each phase of request handling.',
+                                       labels=('phase',)))
+tokens_issued = metrics.add(Counter('tokens_issued_total',
+                                    'Tokens signed, by tenant, account type and token type.',
+                                    labels=('tenant_id', 'account_type', 'token_type')))
+upstream_errors = metrics.add(Counter('tokens_upstream_errors_total',
+                                      'Failed calls to other services (sk, site_router).',
+                                      labels=('upstream',)))
+
+
+# the (phase, seconds) timings of the current request, when they are being collected for its Server-Timing header
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def time_phase(phase, upstream=None, expected=()):
+    """
+    Context manager recording the time spent in a phase. When `upstream` is set, an exception raised in the phase is
+    also counted as an error calling that service, unless it is an instance of `expected` (e.g., the service
+    rejecting invalid input).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        if upstream and not isinstance(e, expected):
+            upstream_errors.inc(upstream)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        phase_duration.observe(phase, value=seconds)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((phase, seconds))
+
+
+def timed(phase, upstream=None):
+    """
+    Decorator recording the time spent in a function as a phase; see time_phase().
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_phase(phase, upstream):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
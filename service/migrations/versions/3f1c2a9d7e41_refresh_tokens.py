@@ -0,0 +1,36 @@
+"""refresh token store
+
+Revision ID: 3f1c2a9d7e41
+Revises: 
+Create Date: 2026-10-17 21:46:39.072604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7e41'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('refresh_tokens',
+    sa.Column('jti', sa.String(length=64), nullable=False),
+    sa.Column('tenant_id', sa.String(length=50), nullable=False),
+    sa.Column('initial_ttl', sa.Integer(), nullable=False),
+    sa.Column('access_token', sa.JSON(), nullable=False),
+    sa.Column('exp', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('jti')
+    )
+    with op.batch_alter_table('refresh_tokens', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_refresh_tokens_exp'), ['exp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('refresh_tokens', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_refresh_tokens_exp'))
+
+    op.drop_table('refresh_tokens')
@@ -1,15 +1,85 @@
 import datetime
-import jwt
+import logging
+import sys
 import uuid
 
+from tapisservice.config import conf
 from tapisservice.errors import DAOError
 
-from service import tenants, errors
+from service import tenants, errors, db
+from service.keys import signing_keys, SUPPORTED_ALGORITHMS
+from service.metrics import timed, tokens_issued
+from service import signing
 
 # get the logger instance -
-from tapisservice.logs import get_logger
+from service.logs import get_logger
 logger = get_logger(__name__)
 
+# non-standard claims are namespaced with the following text -
+NAMESPACE_PRETEXT = 'tapis/'
+
+# the namespaced claim names, interned once so that they are not built again for every token -
+TENANT_ID_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}tenant_id')
+TOKEN_TYPE_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}token_type')
+DELEGATION_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}delegation')
+DELEGATION_SUB_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}delegation_sub')
+USERNAME_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}username')
+ACCOUNT_TYPE_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}account_type')
+TARGET_SITE_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}target_site')
+INITIAL_TTL_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}initial_ttl')
+ACCESS_TOKEN_CLAIM = sys.intern(f'{NAMESPACE_PRETEXT}access_token')
+
+# claims templates, keyed by (token_type, tenant_id, iss, account_type, compact); see get_claims_template()
+_claims_templates = {}
+
+
+def get_claims_template(token_type, tenant_id, iss, account_type, compact=False):
+    """
+    Returns the claims template for a type of token issued to an account type in a tenant: a dict with every claim
+    of the token, in order, with the claims shared by all such tokens filled in and the others set to None. Tokens
+    copy their template and set the remaining claims, instead of building the dict, and its keys, for every token.
+    The template must not be modified.
+    :param compact: (bool) for refresh tokens, whether the token is a compact refresh token.
+    """
+    key = (token_type, tenant_id, iss, account_type, compact)
+    template = _claims_templates.get(key)
+    if template is None:
+        if token_type == 'access':
+            template = {'jti': None,
+                        'iss': iss,
+                        'sub': None,
+                        TENANT_ID_CLAIM: tenant_id,
+                        TOKEN_TYPE_CLAIM: token_type,
+                        DELEGATION_CLAIM: None,
+                        DELEGATION_SUB_CLAIM: None,
+                        USERNAME_CLAIM: None,
+                        ACCOUNT_TYPE_CLAIM: account_type,
+                        'exp': None}
+        elif compact:
+            # compact refresh tokens only identify the refresh token; the claims of the access token are kept in
+            # the refresh token store (see service/refresh_store.py).
+            template = {'jti': None,
+                        'iss': iss,
+                        'sub': None,
+                        TENANT_ID_CLAIM: tenant_id,
+                        TOKEN_TYPE_CLAIM: token_type,
+                        'exp': None}
+        else:
+            template = {'jti': None,
+                        'iss': iss,
+                        'sub': None,
+                        # we store the initial ttl on a refresh token because, when using the refresh operation, a
+                        # new refresh token with the same ttl will be created.
+                        INITIAL_TTL_CLAIM: None,
+                        TENANT_ID_CLAIM: tenant_id,
+                        TOKEN_TYPE_CLAIM: token_type,
+                        # NOTE: we intentionally do not include the username and account_type claims, as the refresh
+                        #       token should not be honored by services as an access token.
+                        'exp': None,
+                        ACCESS_TOKEN_CLAIM: None}
+        _claims_templates[key] = template
+    return template
+
 
 class AccessTokenData(object):
     """
@@ -25,31 +95,23 @@ class AccessTokenData(object):
 class TapisToken(object):
     """
     Tapis tokens are not persisted to the database but are processed in similar ways to other models.
-    This class collects common attributes and methods for both access and refresh tokens.
+    This class collects common attributes and methods for both access and refresh tokens. Many tokens are created
+    per second, so the token classes use __slots__ instead of an instance dict.
     """
     # header ----
     typ = 'JWT'
-    alg = None
-
-    # claims ----
-    jti = None
-    iss = None
-    sub = None
-    token_type = None
-    tenant_id = None
-    username = None
-    account_type = None
-    exp = None
-
-    # non-standard claims are namespaced with the following text -
-    NAMESPACE_PRETEXT = 'tapis/'
-
-    def __init__(self, jti, iss, sub, token_type, tenant_id, username, account_type, ttl, exp, extra_claims=None, alg='RS256'):
+
+    NAMESPACE_PRETEXT = NAMESPACE_PRETEXT
+
+    __slots__ = ('alg', 'ttl', 'jti', 'iss', 'sub', 'token_type', 'tenant_id', 'username', 'account_type', 'exp',
+                 'extra_claims', 'jwt', 'claims')
+
+    def __init__(self, jti, iss, sub, token_type, tenant_id, username, account_type, ttl, exp, extra_claims=None, alg=None):
         # header -----
-        self.typ = TapisToken.typ
+        # when alg is None, the tenant's configured signing algorithm is used; it is set when the token is signed.
         self.alg = alg
-        if not self.alg == 'RS256':
-            raise
+        if self.alg and self.alg not in SUPPORTED_ALGORITHMS:
+            raise errors.InvalidTokenClaimsError(f"Unsupported signing algorithm: {self.alg}.")
 
         # input metadata ----
         self.ttl = ttl
@@ -65,20 +127,36 @@ class TapisToken(object):
         self.exp = exp
         self.extra_claims = extra_claims
 
-        # derived attributes
-        self.expires_at = self.exp.isoformat()
-
-        # raw jwt ----
+        # raw jwt, and the claims it was signed with ----
         self.jwt = None
+        self.claims = None
+
+    @property
+    def expires_at(self):
+        return self.exp.isoformat()
 
+    @timed('sign_token')
     def sign_token(self):
         """
         Sign the token using the private key associated with the tenant.
         :return:
         """
         tenant = tenants.get_tenant_config(self.tenant_id)
-        private_key = tenant.private_key
-        self.jwt = jwt.encode(self.claims_to_dict(), private_key, algorithm=self.alg)
+        # use the parsed key object from the registry so the PEM is not deserialized on every call --
+        key = signing_keys.get_key(tenant)
+        if not self.alg:
+            self.alg = key.alg
+        elif not self.alg == key.alg:
+            raise errors.InvalidTokenClaimsError(f"Cannot sign a {self.alg} token for tenant {self.tenant_id}; "
+                                                 f"the tenant's signing key is for {key.alg}.")
+        # the signing engine (in-process or pooled, see the signing_engine config) does the private key operation --
+        claims = self.claims_to_dict()
+        self.jwt = signing.signer.sign(claims, key)
+        # kept so that the refresh token for this token does not build them again -
+        self.claims = claims
+        tokens_issued.inc(self.tenant_id, self.account_type, self.token_type)
+        logger.event(logging.DEBUG, 'token_signed', token_type=self.token_type, jti=self.jti, tenant_id=self.tenant_id,
+                     username=self.username, account_type=self.account_type, alg=self.alg, ttl=self.ttl)
         return self.jwt
 
     @classmethod
@@ -115,8 +193,8 @@ class TapisAccessToken(TapisToken):
     """
     Adds attributes and methods specific to access tokens.
     """
-    delegation = None
-    delegation_sub = None
+    # access_token is the raw JWT, set on the service tokens the Tokens API creates for itself, as tapipy expects -
+    __slots__ = ('delegation', 'delegation_sub', 'target_site_id', 'access_token')
 
     # these are the standard Tapis access token claims and cannot appear in the extra_claims parameter -
     standard_tapis_access_claims = ('jti', 'iss', 'sub', 'tenant', 'target_site', 'username', 'account_type', 'exp')
@@ -128,33 +206,29 @@ class TapisAccessToken(TapisToken):
         self.delegation_sub = delegation_sub
         self.target_site_id = target_site_id
         self.extra_claims = extra_claims
-
+        self.access_token = None
 
     def claims_to_dict(self):
         """
         Returns a dictionary of claims.
         :return:
         """
-        d = {
-            'jti': self.jti,
-            'iss': self.iss,
-            'sub': self.sub,
-            f'{TapisToken.NAMESPACE_PRETEXT}tenant_id': self.tenant_id,
-            f'{TapisToken.NAMESPACE_PRETEXT}token_type': self.token_type,
-            f'{TapisToken.NAMESPACE_PRETEXT}delegation': self.delegation,
-            f'{TapisToken.NAMESPACE_PRETEXT}delegation_sub': self.delegation_sub,
-            f'{TapisToken.NAMESPACE_PRETEXT}username': self.username,
-            f'{TapisToken.NAMESPACE_PRETEXT}account_type': self.account_type,
-            'exp': self.exp,
-        }
+        d = get_claims_template('access', self.tenant_id, self.iss, self.account_type).copy()
+        d['jti'] = self.jti
+        d['sub'] = self.sub
+        d[DELEGATION_CLAIM] = self.delegation
+        d[DELEGATION_SUB_CLAIM] = self.delegation_sub
+        d[USERNAME_CLAIM] = self.username
+        d['exp'] = self.exp
         if self.target_site_id:
-            d[f'{TapisToken.NAMESPACE_PRETEXT}target_site'] = self.target_site_id
+            d[TARGET_SITE_CLAIM] = self.target_site_id
         if self.extra_claims:
             d.update(self.extra_claims)
         return d
 
 
     @classmethod
+    @timed('get_derived_values')
     def get_derived_values(cls, data):
         """
         Computes derived values for the access token from input and defaults.
@@ -168,7 +242,7 @@ class TapisAccessToken(TapisToken):
                       'account_type': data.account_type,
                       }
         except KeyError as e:
-            logger.error(f"Missing required token attribute; KeyError: {e}")
+            logger.error("Missing required token attribute; KeyError: %s", e)
             raise DAOError("Missing required token attribute.")
 
         # service tokens must also have a target_site claim:
@@ -184,6 +258,9 @@ class TapisAccessToken(TapisToken):
         # compute the subject from the parts
         result['sub'] = TapisToken.compute_sub(result['tenant_id'], result['username'])
         tenant = tenants.get_tenant_config(result['tenant_id'])
+        # with lazy signing key loading, start loading the tenant's key now so it is ready by the time
+        # the token is signed --
+        signing_keys.prefetch(tenant.tenant_id)
         # derive the issuer from the associated config for the tenant.
         result['iss'] = tenant.token_service
 
@@ -202,7 +279,7 @@ class TapisAccessToken(TapisToken):
                 delegation_tenant_id = data.delegation_sub_tenant_id
                 delegation_username = data.delegation_sub_username
             except (AttributeError, KeyError) as e:
-                logger.error(f"Missing required delegation token attribute; KeyError: {e}")
+                logger.error("Missing required delegation token attribute; KeyError: %s", e)
                 raise DAOError("Missing required delegation token attribute; both delegation_sub_tenant_id and "
                                "delegation_sub_username are required when generating a delegation token.")
             result['delegation_sub'] = TapisToken.compute_sub(delegation_tenant_id, delegation_username)
@@ -211,48 +288,137 @@ class TapisAccessToken(TapisToken):
             result['extra_claims'] = data.claims
         return result
 
+    # claims of the access token embedded in a refresh token that are not carried over as extra claims when the
+    # access token is rebuilt from it -
+    refresh_rebuilt_claims = frozenset(('jti', 'iss', 'sub', 'exp', 'ttl', TOKEN_TYPE_CLAIM, TENANT_ID_CLAIM,
+                                        USERNAME_CLAIM, ACCOUNT_TYPE_CLAIM, DELEGATION_CLAIM, DELEGATION_SUB_CLAIM))
+
+    @classmethod
+    def get_data_from_refresh_claims(cls, access_token_claims):
+        """
+        Computes the data for a new access token from the access token claims embedded in a refresh token (the
+        tapis/access_token claim). The new token gets a new jti and an exp computed from the original ttl; all
+        other claims, including any extra claims, are carried over.
+        :param access_token_claims: dict
+        :return: dict (result)
+        """
+        ttl = access_token_claims['ttl']
+        return {'jti': str(uuid.uuid4()),
+                'iss': access_token_claims['iss'],
+                'sub': access_token_claims['sub'],
+                'tenant_id': access_token_claims[TENANT_ID_CLAIM],
+                'username': access_token_claims[USERNAME_CLAIM],
+                'account_type': access_token_claims[ACCOUNT_TYPE_CLAIM],
+                'ttl': ttl,
+                'exp': TapisToken.compute_exp(ttl),
+                'delegation': access_token_claims[DELEGATION_CLAIM],
+                'delegation_sub': access_token_claims.get(DELEGATION_SUB_CLAIM),
+                'extra_claims': {k: v for k, v in access_token_claims.items()
+                                 if k not in cls.refresh_rebuilt_claims}
+                }
+
 
 class TapisRefreshToken(TapisToken):
     """
     Adds attributes and methods specific to refresh tokens.
     """
-    access_token = None
+    # access_token is the claims of the access token the refresh token was issued with. compact refresh tokens do
+    # not include them in their claims; they are saved in the refresh token store instead.
+    __slots__ = ('access_token', 'compact')
 
-    def __init__(self, jti, iss, sub, tenant_id, username, account_type, ttl, exp, access_token):
+    def __init__(self, jti, iss, sub, tenant_id, username, account_type, ttl, exp, access_token, compact=False):
         super().__init__(jti, iss, sub, 'refresh', tenant_id, username, account_type, ttl, exp, None)
         self.access_token = access_token
+        self.compact = compact
 
     @classmethod
-    def get_derived_values(cls, data):
-        result = data
-        result['jti'] = str(uuid.uuid4())
-        refresh_token_ttl = result.pop('refresh_token_ttl', None)
+    def from_access_token(cls, access_token, refresh_token_ttl=None, compact=None):
+        """
+        Create the refresh token for a signed access token, in one pass over the claims the access token was signed
+        with. The refresh token has all the same attributes as the access token (and same values), except that it has
+        a different jti and ttl and it has the access token's claims, without exp and with its ttl, as its
+        access_token attribute.
+        :param access_token: TapisAccessToken, signed
+        :param refresh_token_ttl: the requested ttl of the refresh token; the tenant's default is used if not set.
+        :param compact: (bool) whether to create a compact refresh token; defaults to the compact_refresh_tokens
+                        config.
+        :return: TapisRefreshToken, not signed
+        """
+        access_token_claims = (access_token.claims or access_token.claims_to_dict()).copy()
+        del access_token_claims['exp']
+        # record the requested ttl for the token so that we can use it to generate a token of equal length
+        # at refresh
+        access_token_claims['ttl'] = access_token.ttl
         if not refresh_token_ttl or refresh_token_ttl <= 0:
-            tenant = tenants.get_tenant_config(result['tenant_id'])
-            refresh_token_ttl = tenant.refresh_token_ttl
-        result['ttl'] = refresh_token_ttl
-        result['exp'] = TapisToken.compute_exp(refresh_token_ttl)
-        return result
+            refresh_token_ttl = tenants.get_tenant_config(access_token.tenant_id).refresh_token_ttl
+        return cls(jti=str(uuid.uuid4()),
+                   iss=access_token.iss,
+                   sub=access_token.sub,
+                   tenant_id=access_token.tenant_id,
+                   username=access_token.username,
+                   account_type=access_token.account_type,
+                   ttl=refresh_token_ttl,
+                   exp=TapisToken.compute_exp(refresh_token_ttl),
+                   access_token=access_token_claims,
+                   compact=conf.compact_refresh_tokens if compact is None else compact)
 
     def claims_to_dict(self):
         """
         Returns a dictionary of claims.
         :return:
         """
-        d = {
-            'jti': self.jti,
-            'iss': self.iss,
-            'sub': self.sub,
-            # we store the initial ttl on a refresh token because, when using the refresh operation, a new
-            # refresh token with the same ttl will be created.
-            f'{TapisToken.NAMESPACE_PRETEXT}initial_ttl': self.ttl,
-            f'{TapisToken.NAMESPACE_PRETEXT}tenant_id': self.tenant_id,
-            f'{TapisToken.NAMESPACE_PRETEXT}token_type': self.token_type,
-            # NOTE: we intentionally do not include these claims, as the refresh token should not be
-            #       honored by services as an access token.
-            # 'username': self.username,
-            # 'account_type': self.account_type,
-            'exp': self.exp,
-            f'{TapisToken.NAMESPACE_PRETEXT}access_token': self.access_token
-        }
+        d = get_claims_template('refresh', self.tenant_id, self.iss, self.account_type, self.compact).copy()
+        d['jti'] = self.jti
+        d['sub'] = self.sub
+        if self.compact:
+            d['exp'] = self.exp
+            return d
+        d[INITIAL_TTL_CLAIM] = self.ttl
+        d['exp'] = self.exp
+        d[ACCESS_TOKEN_CLAIM] = self.access_token
         return d
+
+
+class RefreshTokenRecord(db.Model):
+    """
+    The access token data of a compact refresh token, saved in the refresh token store when the refresh token is
+    issued and read when it is used. Records are purged once the refresh token has expired.
+    """
+    __tablename__ = 'refresh_tokens'
+
+    jti = db.Column(db.String(64), primary_key=True)
+    tenant_id = db.Column(db.String(50), nullable=False)
+    # the refresh token's ttl, reused for the refresh tokens issued when it is used
+    initial_ttl = db.Column(db.Integer, nullable=False)
+    # the access token's claims, without exp and with its ttl, as in the tapis/access_token claim
+    access_token = db.Column(db.JSON, nullable=False)
+    # the refresh token's exp, in seconds since the epoch
+    exp = db.Column(db.Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'{self.jti}; tenant: {self.tenant_id}; exp: {self.exp}'
+
+
+class IssuanceRecord(db.Model):
+    """
+    An entry of the token issuance ledger: a token issued (by POST /v3/tokens or the batch endpoint), issued by a
+    refresh (PUT /v3/tokens) or revoked. Written in batches by the ledger writer; see service/ledger.py.
+    """
+    __tablename__ = 'token_ledger'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # one of 'issue', 'refresh' or 'revoke'
+    event = db.Column(db.String(10), nullable=False)
+    jti = db.Column(db.String(64), nullable=False, index=True)
+    sub = db.Column(db.String(200), index=True)
+    tenant_id = db.Column(db.String(50))
+    account_type = db.Column(db.String(20))
+    token_type = db.Column(db.String(10))
+    # the token's exp and the time of the event, in seconds since the epoch
+    exp = db.Column(db.Integer)
+    created = db.Column(db.Integer, nullable=False)
+    # the authenticated caller (username@tenant_id), when the request had one
+    caller = db.Column(db.String(200))
+
+    def __repr__(self):
+        return f'{self.event} {self.jti}; sub: {self.sub}; caller: {self.caller}'
@@ -0,0 +1,126 @@
+import cProfile
+import os
+import pstats
+import random
+import threading
+import time
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+def format_server_timing(timings, total=None):
+    """
+    Format phase timings as a Server-Timing header value. Phases recorded more than once in a request (e.g., several SK
+    calls) are summed, and keep the order in which they first occurred.
+    :param timings: list of (phase, seconds).
+    :param total: optional total request time, in seconds.
+    :return: (str) e.g., "validation;dur=0.41, sign_token;dur=2.03, total;dur=3.12"
+    """
+    durations = {}
+    for phase, seconds in timings:
+        durations[phase] = durations.get(phase, 0) + seconds
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in durations.items())
+
+
+class RequestProfiler(object):
+    """
+    Profiles a random sample of requests with cProfile and aggregates the profiles into one pstats file per process,
+    `<directory>/tokens-<pid>.prof`, which can be loaded with pstats or tools such as snakeviz.
+    The sample rate is set from the profiling_sample_rate config and can be changed at run time, optionally for a
+    limited time, with set_sample_rate() (see POST /v3/tokens/profiling). Only one request is profiled at a time; requests
+    sampled while another is being profiled are skipped.
+    """
+    def __init__(self, sample_rate=0, directory='/tmp/tokens-profiles', dump_every=100):
+        self.configure(sample_rate, directory, dump_every)
+        self._active = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = None
+        # counters --
+        self.profiled = 0
+        self.skipped = 0
+        self.dumps = 0
+
+    def configure(self, sample_rate, directory, dump_every):
+        """
+        Set the configured sample rate, the directory the profiles are written to and how often they are written.
+        """
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.dump_every = dump_every
+        # when the rate was set for a limited time, the time it reverts to the configured rate, and that rate
+        self.until = None
+        self.default_sample_rate = sample_rate
+
+    def set_sample_rate(self, sample_rate, duration=None):
+        """
+        Change the sample rate, for `duration` seconds if passed, or until changed again.
+        """
+        self.sample_rate = sample_rate
+        self.until = time.time() + duration if duration else None
+        logger.info("request profiling sample rate set to %s for %s seconds.", sample_rate, duration or 'unlimited')
+
+    def start(self):
+        """
+        Start profiling the current request if it is sampled.
+        :return: the cProfile.Profile to pass to stop(), or None if the request is not profiled.
+        """
+        if self.until and time.time() > self.until:
+            self.sample_rate = self.default_sample_rate
+            self.until = None
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        if not self._active.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:
+            logger.info("could not start profiling the request; e: %s", e)
+            self._active.release()
+            return None
+        return profile
+
+    def stop(self, profile):
+        """
+        Stop profiling a request and add its profile to the aggregate, writing the aggregate to disk every
+        `dump_every` profiled requests.
+        """
+        profile.disable()
+        self._active.release()
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+            if self.profiled % self.dump_every == 0:
+                self.dump()
+
+    def dump(self):
+        """
+        Write the aggregated profile to disk. Called with the stats lock held.
+        """
+        if self._stats is None:
+            return
+        path = os.path.join(self.directory, f'tokens-{os.getpid()}.prof')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._stats.dump_stats(path)
+            self.dumps += 1
+            logger.info("wrote the aggregated profile of %s requests to %s.", self.profiled, path)
+        except Exception as e:
+            logger.error("could not write the aggregated profile to %s; e: %s", path, e)
+
+    def stats(self):
+        return {'pid': os.getpid(),
+                'sample_rate': self.sample_rate,
+                'until': self.until,
+                'profiled': self.profiled,
+                'skipped': self.skipped,
+                'dumps': self.dumps,
+                'directory': self.directory}
@@ -0,0 +1,171 @@
+import threading
+import time
+
+from sqlalchemy import delete, select
+from tapisservice.config import conf
+from tapisservice.errors import DAOError
+
+from service import db
+from service.metrics import metrics, time_phase
+from service.models import ACCESS_TOKEN_CLAIM, TOKEN_TYPE_CLAIM, RefreshTokenRecord
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+def is_compact_refresh_token(claims):
+    """
+    Whether a set of verified token claims is that of a compact refresh token, i.e., a refresh token whose access
+    token data is in the refresh token store instead of its tapis/access_token claim.
+    """
+    return claims.get(TOKEN_TYPE_CLAIM) == 'refresh' and ACCESS_TOKEN_CLAIM not in claims
+
+
+class RefreshTokenStore(object):
+    """
+    Server-side store of the access token data of compact refresh tokens (see the compact_refresh_tokens config), in
+    the refresh_tokens table of the Tokens API database. A compact refresh token only carries its jti, sub, tenant
+    and exp; the claims of the access tokens generated from it are saved here, keyed by its jti, when it is issued.
+
+    Records are purged once the refresh token has expired, off the request path: every `purge_interval` seconds, a
+    background thread deletes the expired records, using the index on exp, in deletes of at most `purge_batch_size`
+    rows each. Since the database is shared by all workers and replicas, deleting a record (e.g., when the refresh
+    token is revoked) prevents the refresh token from being used anywhere.
+    """
+    def __init__(self, purge_interval=300, purge_batch_size=1000):
+        self.configure(purge_interval, purge_batch_size)
+        self._engine = None
+        self._thread = None
+        self._stopped = threading.Event()
+        # counters --
+        self.hits = 0
+        self.misses = 0
+        self.saves = 0
+        self.purged = 0
+
+    def configure(self, purge_interval=300, purge_batch_size=1000):
+        """
+        Set the purge interval and batch size; called before the purger is started.
+        """
+        self.purge_interval = purge_interval
+        self.purge_batch_size = purge_batch_size
+
+    def start(self, app):
+        """
+        Start the background thread purging the expired records, using the database engine of `app`.
+        """
+        with app.app_context():
+            self._engine = db.engine
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='refresh-token-purger', daemon=True)
+        self._thread.start()
+
+    def post_fork(self):
+        """
+        Drop the database connections inherited by a worker process forked from the process that started the purger.
+        The purger is not restarted in the worker: the parent's purger keeps purging the (shared) table for all of its
+        workers.
+        """
+        if self._engine:
+            self._engine.dispose(close=False)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.purge_interval):
+            self.purge()
+
+    def save(self, refresh_token):
+        """
+        Save the access token data of a compact refresh token.
+        :param refresh_token: TapisRefreshToken, signed.
+        """
+        record = RefreshTokenRecord(jti=refresh_token.jti,
+                                    tenant_id=refresh_token.tenant_id,
+                                    initial_ttl=refresh_token.ttl,
+                                    access_token=refresh_token.access_token,
+                                    exp=int(refresh_token.exp.timestamp()))
+        try:
+            with time_phase('refresh_token_store'):
+                db.session.add(record)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("could not save refresh token %s to the refresh token store; e: %s", refresh_token.jti, e)
+            raise DAOError(msg='Unable to save the refresh token; please retry the request.', code=500)
+        self.saves += 1
+
+    def get(self, jti):
+        """
+        Look up the access token data of a compact refresh token.
+        :return: (access token claims, initial ttl), or None if the store has no unexpired record for the jti.
+        """
+        try:
+            with time_phase('refresh_token_store'):
+                record = db.session.get(RefreshTokenRecord, jti)
+        except Exception as e:
+            db.session.rollback()
+            logger.error("could not read refresh token %s from the refresh token store; e: %s", jti, e)
+            raise DAOError(msg='Unable to read the refresh token; please retry the request.', code=500)
+        if not record or record.exp <= time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record.access_token, record.initial_ttl
+
+    def delete(self, jti):
+        """
+        Delete the record of a compact refresh token, so that it can no longer be used.
+        """
+        try:
+            RefreshTokenRecord.query.filter_by(jti=jti).delete()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("could not delete refresh token %s from the refresh token store; e: %s", jti, e)
+
+    def purge(self):
+        """
+        Delete the records of the refresh tokens that have expired, `purge_batch_size` records at a time, so that no
+        single delete holds its locks for long.
+        """
+        now = int(time.time())
+        expired = select(RefreshTokenRecord.jti).where(RefreshTokenRecord.exp <= now).limit(self.purge_batch_size)
+        purged = 0
+        while not self._stopped.is_set():
+            try:
+                with self._engine.begin() as connection:
+                    deleted = connection.execute(delete(RefreshTokenRecord.__table__).where(
+                        RefreshTokenRecord.jti.in_(expired.scalar_subquery()))).rowcount
+            except Exception as e:
+                logger.error("could not purge the expired refresh tokens; e: %s", e)
+                break
+            purged += deleted
+            if deleted < self.purge_batch_size:
+                break
+        self.purged += purged
+        if purged:
+            logger.debug("purged %s expired refresh tokens from the refresh token store.", purged)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'saves': self.saves,
+                'purged': self.purged}
+
+
+# singleton refresh token store; configured by init(), and the table is created, and the purger started, by
+# build_app() when compact_refresh_tokens is enabled.
+refresh_token_store = RefreshTokenStore()
+metrics.register_cache('refresh_token_store', refresh_token_store)
+
+
+def init():
+    """
+    Configure the refresh token store from the service config. Called by create_app(), after any config overrides
+    are applied.
+    """
+    refresh_token_store.configure(purge_interval=conf.refresh_token_store_purge_interval,
+                                  purge_batch_size=conf.refresh_token_store_purge_batch_size)
@@ -0,0 +1,362 @@
+import concurrent.futures
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tapisservice.config import conf
+from tapisservice import errors
+
+from service import auth
+from service.metrics import time_phase
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+class RevocationIndex(object):
+    """
+    In-process index of revoked token JTIs, so that the refresh path can reject revoked refresh tokens with an O(1)
+    lookup and no network call or file I/O. The site-router remains the system of record for revocations; this index
+    holds the revocations made through this Tokens API and, optionally, those recorded in a shared revocation file.
+
+    The index is an exact hash map of jti -> exp. Entries are pruned once the token's exp has passed, since an
+    expired token is rejected anyway, so the index only ever holds revoked tokens that are still unexpired.
+
+    When `path` is set, every revocation is also appended to that file as a JSON line, and a background thread loads
+    the lines appended by other workers or replicas sharing the file (e.g., on a shared volume) every `sync_interval`
+    seconds. When more than half of the records in the file have expired, pruning also compacts the file: it is
+    rewritten with the unexpired records and replaced, under an exclusive lock on `path`.lock (appends hold a shared
+    lock), and the other processes re-read the new file from the start. Without a file, a revocation is only seen by
+    the worker process that made it, so the file is configured by default (see the revocation_index_file config).
+    """
+    def __init__(self, path=None, sync_interval=5, prune_interval=60):
+        self.configure(path, sync_interval, prune_interval)
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # the inode of the revocation file read so far, the offset read up to, and the number of records in it --
+        self._inode = None
+        self._offset = 0
+        self._file_records = 0
+        self._last_prune = time.time()
+        self._thread = None
+        self._stopped = threading.Event()
+        # counters --
+        self.lookups = 0
+        self.rejections = 0
+        self.pruned = 0
+        self.compactions = 0
+
+    def configure(self, path=None, sync_interval=5, prune_interval=60):
+        """
+        Set the revocation file and the maintenance intervals; called before the index is started.
+        """
+        self.path = path or None
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+
+    def start(self):
+        """
+        Start the background thread that syncs from the revocation file and prunes the index.
+        """
+        if not self.path:
+            logger.warning("revocation_index_file is empty, so the revocations made by this process are not seen by "
+                           "the other workers and replicas, which will keep refreshing the revoked refresh tokens.")
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='revocation-index-maintenance', daemon=True)
+        self._thread.start()
+
+    def post_fork(self):
+        """
+        Start a new maintenance thread in a worker process forked from the process that started the index.
+        """
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        if self._thread:
+            self.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.sync_interval):
+            self.maintain()
+
+    def _file_lock(self, mode):
+        """
+        Open the lock file of the revocation file and lock it in `mode` (fcntl.LOCK_SH or fcntl.LOCK_EX); closing
+        the returned file releases the lock.
+        """
+        f = open(f'{self.path}.lock', 'a')
+        fcntl.flock(f, mode)
+        return f
+
+    def add(self, jti, exp):
+        """
+        Record that the token with this jti (expiring at exp, in seconds since the epoch) has been revoked.
+        """
+        if not jti:
+            return
+        if not isinstance(exp, (int, float)):
+            # without an exp we cannot tell when the entry can be pruned; keep it for the longest token lifetime
+            exp = time.time() + 60*60*24*365
+        with self._lock:
+            self._revoked[jti] = exp
+        if self.path:
+            try:
+                with self._file_lock(fcntl.LOCK_SH), open(self.path, 'a') as f:
+                    f.write(json.dumps({'jti': jti, 'exp': exp}) + '\n')
+            except Exception as e:
+                logger.error("could not write revocation of %s to the revocation file %s; e: %s", jti, self.path, e)
+
+    def is_revoked(self, jti):
+        """
+        Whether the token with this jti has been revoked.
+        """
+        self.lookups += 1
+        exp = self._revoked.get(jti)
+        if exp and exp > time.time():
+            self.rejections += 1
+            return True
+        return False
+
+    def maintain(self):
+        """
+        Sync from the revocation file, and prune expired entries when they are due. Called by the maintenance thread.
+        """
+        if self.path:
+            self.sync()
+        if time.time() - self._last_prune >= self.prune_interval:
+            self.prune()
+
+    def sync(self):
+        """
+        Load the revocations appended to the revocation file since the last sync, or all of them if the file was
+        replaced (compacted) since.
+        """
+        if not self.path or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                if not inode == self._inode:
+                    self._inode = inode
+                    self._offset = 0
+                    self._file_records = 0
+                f.seek(self._offset)
+                lines = f.readlines()
+                self._offset = f.tell()
+            loaded = self._load_lines(lines)
+            if loaded:
+                logger.debug("loaded %s revocations from %s.", loaded, self.path)
+        except Exception as e:
+            logger.error("got exception syncing the revocation index from %s; e: %s", self.path, e)
+        finally:
+            self._sync_lock.release()
+
+    def _load_lines(self, lines):
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for line in lines:
+                if not line.endswith(b'\n'):
+                    # a line still being written by another process; re-read it on the next sync
+                    self._offset -= len(line)
+                    break
+                self._file_records += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.info("skipping invalid line in revocation file %s.", self.path)
+                    continue
+                if record.get('exp', 0) > now:
+                    self._revoked[record['jti']] = record['exp']
+                    loaded += 1
+        return loaded
+
+    def prune(self):
+        """
+        Remove entries for tokens that have expired, and compact the revocation file if most of its records have.
+        """
+        now = time.time()
+        self._last_prune = now
+        with self._lock:
+            expired = [jti for jti, exp in self._revoked.items() if exp <= now]
+            for jti in expired:
+                del self._revoked[jti]
+        self.pruned += len(expired)
+        if self.path and self._file_records > 2 * len(self._revoked):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the revocation file with only its unexpired records. The file is read and replaced under the
+        exclusive lock, so no revocation appended by another process is lost; processes that have the old file open
+        re-read the new one from the start on their next sync.
+        """
+        with self._sync_lock:
+            try:
+                with self._file_lock(fcntl.LOCK_EX):
+                    with open(self.path, 'rb') as f:
+                        lines = f.readlines()
+                    now = time.time()
+                    records = {}
+                    for line in lines:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if record.get('exp', 0) > now:
+                            records[record['jti']] = record['exp']
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.revoked',
+                                                    suffix='.tmp')
+                    with os.fdopen(fd, 'w') as f:
+                        for jti, exp in records.items():
+                            f.write(json.dumps({'jti': jti, 'exp': exp}) + '\n')
+                    os.replace(tmp_path, self.path)
+                    self._inode = os.stat(self.path).st_ino
+                    self._offset = os.path.getsize(self.path)
+                    self._file_records = len(records)
+                with self._lock:
+                    self._revoked.update(records)
+                self.compactions += 1
+                logger.info("compacted the revocation file %s from %s to %s records.", self.path, len(lines),
+                            len(records))
+            except FileNotFoundError:
+                return
+            except Exception as e:
+                logger.error("could not compact the revocation file %s; e: %s", self.path, e)
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def stats(self):
+        return {'size': len(self._revoked),
+                'lookups': self.lookups,
+                'rejections': self.rejections,
+                'pruned': self.pruned,
+                'compactions': self.compactions}
+
+
+class SiteRouterClient(object):
+    """
+    Client for the token revocation endpoint of the site-router at this Tokens API's site. All calls share one
+    requests session with a keep-alive connection pool, a timeout, and retries on connection errors and
+    5xx responses (revoking a token is idempotent, so retrying the POST is safe).
+    """
+    def __init__(self, pool_size=16, timeout=5, retries=2, max_concurrency=16, base_url=None):
+        self.url = None
+        if base_url:
+            self.set_base_url(base_url)
+        self.configure(pool_size, timeout, retries, max_concurrency)
+
+    def configure(self, pool_size, timeout, retries, max_concurrency):
+        """
+        Set the connection pool size, timeout, retries and concurrency of the client, and re-create its session.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self.session = self.get_session()
+
+    def set_base_url(self, base_url):
+        self.url = f'{base_url}/v3/site-router/tokens/revoke'
+
+    def get_session(self):
+        retry = Retry(total=self.retries,
+                      backoff_factor=0.2,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def post_fork(self):
+        """
+        Re-create the connection pool in a forked worker process.
+        """
+        self.session = self.get_session()
+
+    def get_headers(self):
+        # we always call the site-router located at our site and with the X-Tapis-Tenant and User
+        # headers set to ourselves (tokens api)
+        request_tenant_id = conf.service_tenant_id
+        try:
+            service_token = auth.t.service_tokens[request_tenant_id]['access_token'].access_token
+        except Exception as e:
+            logger.error("Could not get the token's service access token; details: %s", e)
+            raise errors.ResourceError(msg='Service error revoking token: contact service admins.')
+        return {
+            'X-Tapis-Tenant': request_tenant_id,
+            'X-Tapis-User': conf.service_name,
+            'X-Tapis-Token': service_token,
+        }
+
+    def revoke(self, token_str, headers=None):
+        """
+        Add a token to the site-router's revocation table. Raises a ResourceError on failure.
+        """
+        if not headers:
+            headers = self.get_headers()
+        try:
+            with time_phase('revocation_http', upstream='site_router'):
+                rsp = self.session.post(self.url, headers=headers, json={"token": token_str}, timeout=self.timeout)
+                rsp.raise_for_status()
+        except Exception as e:
+            logger.info("Got exception in call to site-router; exception: %s", e)
+            raise errors.ResourceError(msg=f'Error contacting Tapis to revoke token; details: {e}')
+
+    def revoke_many(self, token_strs):
+        """
+        Revoke many tokens, with at most max_concurrency calls to the site-router in flight at once.
+        :param token_strs: list of raw tokens.
+        :return: list, in the same order as token_strs, with None for each token revoked or the ResourceError
+                 raised trying to revoke it.
+        """
+        headers = self.get_headers()
+
+        def revoke_one(token_str):
+            try:
+                self.revoke(token_str, headers)
+            except errors.ResourceError as e:
+                return e
+            return None
+
+        workers = max(1, min(self.max_concurrency, len(token_strs)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(revoke_one, token_strs))
+
+
+# the index is configured by init(), and seeded from the shared revocation file, if there is one, by create_app() --
+revocation_index = RevocationIndex()
+
+# the client is configured by init(), and the base URL is set by create_app() once the tapipy client is created --
+site_router = SiteRouterClient()
+
+
+def init():
+    """
+    Configure the revocation index and the site-router client from the service config. Called by create_app(), after
+    any config overrides are applied.
+    """
+    revocation_index.configure(path=conf.revocation_index_file,
+                               sync_interval=conf.revocation_index_sync_interval)
+    site_router.configure(pool_size=conf.site_router_pool_size,
+                          timeout=conf.site_router_timeout,
+                          retries=conf.site_router_retries,
+                          max_concurrency=conf.revoke_max_concurrency)
@@ -0,0 +1,295 @@
+import calendar
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import jwt
+from jwt.utils import base64url_encode
+from tapisservice.config import conf
+
+from service import logs
+from service.errors import SigningUnavailableError
+from service.keys import SigningKey, signing_keys
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the claims PyJWT converts from datetimes to NumericDate (integer) values --
+TIME_CLAIMS = ('exp', 'iat', 'nbf')
+
+# serializes claims exactly as PyJWT does; built once, since json.dumps() builds a new encoder for every call with
+# non-default arguments --
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def _plain(value):
+    """
+    Whether `value` only contains strings, (exact) integers, booleans, None, lists, tuples and dictionaries with string
+    keys: the values orjson serializes exactly as the json module does.
+    """
+    value_type = type(value)
+    if value_type is str or value_type is int or value_type is bool or value is None:
+        return True
+    if value_type is dict:
+        return all(type(name) is str and _plain(item) for name, item in value.items())
+    if value_type is list or value_type is tuple:
+        return all(_plain(item) for item in value)
+    return False
+
+
+def dumps_claims(claims):
+    """
+    Serialize a set of claims to the JSON of a JWT payload, byte for byte as PyJWT does: with the json module,
+    compact, with non-ASCII characters escaped. When orjson is installed, it is used for the claims it serializes
+    identically (see _plain()), unless they hold integers beyond 64 bits or non-ASCII characters. Floats (orjson writes
+    1e-07 as 1e-7 and NaN as null) and values the json module rejects, such as datetimes outside of the time claims,
+    for which it raises TypeError as PyJWT does, always go through the json module.
+    :return: (bytes) the JSON.
+    """
+    if orjson and _plain(claims):
+        try:
+            payload = orjson.dumps(claims)
+            if payload.isascii():
+                return payload
+        except TypeError:
+            pass
+    return _json_encode(claims).encode('utf-8')
+
+
+def tapis_encode(claims, key):
+    """
+    Encode and sign a set of claims as a compact JWT. Produces the same token as PyJWT's
+    jwt.encode(claims, key.private_key, algorithm=key.alg) with less work around the private key operation: the
+    header segment is built once per key (see SigningKey.header_segment), the claims are serialized with
+    dumps_claims() and the key's algorithm object is used directly, without PyJWT's argument handling.
+    :param claims: (dict) the token claims; not modified.
+    :param key: (service.keys.SigningKey) the tenant's signing key.
+    :return: (str) the compact JWT.
+    """
+    payload = claims.copy()
+    for claim in TIME_CLAIMS:
+        value = payload.get(claim)
+        if isinstance(value, datetime.datetime):
+            payload[claim] = calendar.timegm(value.utctimetuple())
+    signing_input = key.header_segment + b'.' + base64url_encode(dumps_claims(payload))
+    signature = key.algorithm.sign(signing_input, key.private_key)
+    return (signing_input + b'.' + base64url_encode(signature)).decode('utf-8')
+
+
+def pyjwt_encode(claims, key):
+    """
+    Encode and sign a set of claims with PyJWT's jwt.encode(). Used when the jwt_encoder config is "pyjwt".
+    """
+    return jwt.encode(claims, key.private_key, algorithm=key.alg)
+
+
+def get_encoder(name):
+    """
+    Return the JWT encoder selected by `name`, the value of the jwt_encoder config.
+    """
+    if name == 'pyjwt':
+        logger.info("using the PyJWT encoder.")
+        return pyjwt_encode
+    return tapis_encode
+
+
+# the JWT encoder used by the signing engines; set from the jwt_encoder config by init() --
+encode_token = tapis_encode
+
+
+class LocalSigner(object):
+    """
+    Signs tokens in the calling thread. This is the default signing engine.
+    """
+    def sign(self, claims, key):
+        """
+        Sign a set of claims with a tenant's signing key.
+        :param claims: (dict) the token claims.
+        :param key: (service.keys.SigningKey) the tenant's signing key.
+        :return: (str) the compact JWT.
+        """
+        return encode_token(claims, key)
+
+    def shutdown(self):
+        pass
+
+
+# Worker process state and functions for the PooledSigner. These run inside the pool's worker processes.
+# Each worker keeps its own parsed copy (a SigningKey) of every tenant key it has been asked to use, keyed by
+# tenant_id. Jobs only carry the key's id; a worker that does not have that key (e.g., after a rotation) returns
+# None and the job is sent again with the PEM.
+_worker_keys = {}
+
+
+def _init_worker(keys, start_method, jwt_encoder):
+    """
+    Pool initializer: select the JWT encoder and parse the signing keys known at the time the pool was started.
+    :param keys: list of (tenant_id, alg, private_key_pem) tuples.
+    :param start_method: the pool's multiprocessing start method.
+    :param jwt_encoder: the jwt_encoder config of the parent process.
+    """
+    global encode_token
+    if not start_method == 'spawn':
+        # the worker was forked from a process that imported the service modules, and its log writer thread did not
+        # survive the fork --
+        logs.post_fork()
+    encode_token = get_encoder(jwt_encoder)
+    for tenant_id, alg, pem in keys:
+        _worker_keys[tenant_id] = SigningKey(tenant_id, pem, alg)
+
+
+def _sign_in_worker(tenant_id, key_id, claims):
+    """
+    Sign with the worker's copy of the key `key_id`, or return None if the worker does not have that key.
+    """
+    key = _worker_keys.get(tenant_id)
+    if not key or not key.key_id == key_id:
+        return None
+    return encode_token(claims, key)
+
+
+def _sign_with_pem_in_worker(tenant_id, alg, pem, claims):
+    """
+    Parse and keep a tenant's key, then sign with it.
+    """
+    key = SigningKey(tenant_id, pem, alg)
+    _worker_keys[tenant_id] = key
+    return encode_token(claims, key)
+
+
+class PooledSigner(object):
+    """
+    Signs tokens in a pool of worker processes so that a single Tokens API process can use all available cores for
+    the (CPU-bound) private key operations. The number of signing requests submitted to the pool and not yet
+    completed is bounded by `max_pending`; when the pool is saturated, callers wait up to `queue_timeout` seconds
+    for a slot and then get a SigningUnavailableError (HTTP 503) instead of queueing without bound.
+    """
+    def __init__(self, workers, max_pending, queue_timeout, timeout, start_method, registry, jwt_encoder='tapis'):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.start_method = start_method
+        self.registry = registry
+        self.jwt_encoder = jwt_encoder
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        # counters --
+        self.submitted = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.key_misses = 0
+
+    def _get_executor(self):
+        # the pool is created on first use, and re-created if this process was forked after the pool was started
+        # (e.g., a pre-forking server with the app preloaded), since the pool's management threads do not
+        # survive a fork.
+        if self._executor and self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if not self._executor or not self._pid == os.getpid():
+                keys = [(k.tenant_id, k.alg, k.private_key_pem) for k in self.registry.keys()]
+                logger.info("starting signing pool with %s workers and %s keys.", self.workers, len(keys))
+                mp_context = multiprocessing.get_context(self.start_method)
+                if self.start_method == 'forkserver':
+                    # the service modules (and, through tapisservice, the tenant list) are imported once, in the fork
+                    # server, instead of in every worker --
+                    mp_context.set_forkserver_preload([__name__])
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=mp_context,
+                    initializer=_init_worker,
+                    initargs=(keys, self.start_method, self.jwt_encoder))
+                self._pid = os.getpid()
+        return self._executor
+
+    def _reset_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self.restarts += 1
+        executor.shutdown(wait=False)
+
+    def sign(self, claims, key):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            logger.info("signing pool saturated; rejecting signing request.")
+            raise SigningUnavailableError(msg='The Tokens API is at capacity; please retry the request.')
+        try:
+            self.submitted += 1
+            executor = self._get_executor()
+            try:
+                deadline = time.monotonic() + self.timeout
+                token = executor.submit(_sign_in_worker, key.tenant_id, key.key_id, claims).result(timeout=self.timeout)
+                if token is None:
+                    # the worker does not have this key yet --
+                    self.key_misses += 1
+                    future = executor.submit(_sign_with_pem_in_worker, key.tenant_id, key.alg, key.private_key_pem,
+                                             claims)
+                    token = future.result(timeout=max(0, deadline - time.monotonic()))
+                return token
+            except concurrent.futures.process.BrokenProcessPool as e:
+                logger.error("signing pool is broken; it will be restarted on the next request. e: %s", e)
+                self._reset_executor(executor)
+                raise SigningUnavailableError(msg='The Tokens API signing engine is restarting; please retry the request.')
+            except concurrent.futures.TimeoutError:
+                logger.error("signing request timed out after %s seconds.", self.timeout)
+                raise SigningUnavailableError(msg='Timed out signing the token; please retry the request.')
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        return {'workers': self.workers,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'restarts': self.restarts,
+                'key_misses': self.key_misses}
+
+
+def get_signer(registry):
+    """
+    Build the signing engine selected by the signing_engine config.
+    """
+    if conf.signing_engine == 'pool':
+        logger.info("using the pooled signing engine.")
+        return PooledSigner(workers=conf.signing_pool_workers,
+                            max_pending=conf.signing_pool_max_pending,
+                            queue_timeout=conf.signing_pool_queue_timeout,
+                            timeout=conf.signing_pool_timeout,
+                            start_method=conf.signing_pool_start_method,
+                            registry=registry,
+                            jwt_encoder=conf.jwt_encoder)
+    return LocalSigner()
+
+
+# the signing engine used by TapisToken.sign_token(); set from the signing_engine config by init() --
+signer = LocalSigner()
+
+
+def init():
+    """
+    Select the JWT encoder and build the signing engine from the service config. Called by create_app(), after any
+    config overrides are applied.
+    """
+    global encode_token, signer
+    encode_token = get_encoder(conf.jwt_encoder)
+    signer.shutdown()
+    signer = get_signer(signing_keys)
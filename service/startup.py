@@ -0,0 +1,129 @@
+import concurrent.futures
+import threading
+import time
+from contextlib import contextmanager
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+class StartupReport(object):
+    """
+    Collects the time spent in each phase of the service start up and, for per-tenant phases, the time spent on
+    each tenant, so that slow cold starts can be attributed to a phase or to specific tenants.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        # list of (phase, seconds), in the order the phases finished
+        self.phases = []
+        # maps phase -> {tenant_id: {'seconds': .., 'attempts': .., 'ok': ..}}
+        self.tenants = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing one phase of the start up.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def record_tenant(self, phase, tenant_id, seconds, attempts, ok):
+        with self._lock:
+            self.tenants.setdefault(phase, {})[tenant_id] = {'seconds': seconds, 'attempts': attempts, 'ok': ok}
+
+    def as_dict(self):
+        return {'total': time.monotonic() - self.started,
+                'phases': dict(self.phases),
+                'tenants': self.tenants}
+
+    def log(self, slowest=5):
+        """
+        Log the report: the total time, the time of each phase and, for per-tenant phases, the slowest tenants and
+        any tenants that needed retries or failed.
+        """
+        lines = [f"Tokens API start up took {time.monotonic() - self.started:.3f}s"]
+        for name, seconds in self.phases:
+            lines.append(f"  phase {name}: {seconds:.3f}s")
+            timings = self.tenants.get(name)
+            if not timings:
+                continue
+            ranked = sorted(timings.items(), key=lambda item: item[1]['seconds'], reverse=True)
+            for tenant_id, timing in ranked[:slowest]:
+                lines.append(f"    tenant {tenant_id}: {timing['seconds']:.3f}s")
+            retried = [tid for tid, timing in ranked if timing['attempts'] > 1]
+            failed = [tid for tid, timing in ranked if not timing['ok']]
+            lines.append(f"    tenants: {len(timings)}; retried: {retried}; failed: {failed}")
+        logger.info('\n'.join(lines))
+
+
+def run_for_tenants(fn, tenant_ids, phase, report=None, max_workers=16, timeout=10, retries=2, backoff=0.5,
+                    commit=None):
+    """
+    Call `fn(tenant_id)` for each tenant id with at most `max_workers` calls in flight at once.
+    Each attempt is given `timeout` seconds and failed (or timed out) attempts are retried up to `retries` times,
+    with a linear backoff. The time and number of attempts for each tenant are recorded in `report` under `phase`.
+    Note that an attempt that times out cannot be interrupted; it is abandoned and runs to completion in the
+    background, and its result is discarded. `fn` should therefore not have side effects: the result of the attempt
+    that succeeded in time is applied by `commit(tenant_id, result)`, if given, which is never called for an
+    abandoned attempt. `commit` is called once, after the retries; if it raises, the tenant fails without another
+    attempt.
+    :return: (results, failures): dicts mapping tenant_id to the value returned by fn, and tenant_id to the
+             exception raised for tenants that failed: the last attempt's, or the one raised by commit.
+    """
+    tenant_ids = list(tenant_ids)
+    results = {}
+    failures = {}
+    if not tenant_ids:
+        return results, failures
+    workers = max(1, min(max_workers, len(tenant_ids)))
+    # attempts run on their own pool, sized so that abandoned (timed out) attempts cannot starve the others.
+    attempts_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers * (retries + 1),
+                                                          thread_name_prefix=f'startup-{phase}')
+
+    def run_one(tenant_id):
+        start = time.monotonic()
+        error = None
+        for attempt in range(1, retries + 2):
+            try:
+                result = attempts_pool.submit(fn, tenant_id).result(timeout=timeout)
+                break
+            except concurrent.futures.TimeoutError:
+                error = TimeoutError(f"{phase} for tenant {tenant_id} timed out after {timeout}s.")
+            except Exception as e:
+                error = e
+            logger.info("attempt %s of %s for tenant %s failed; e: %s", attempt, phase, tenant_id, error)
+            if attempt <= retries:
+                time.sleep(backoff * attempt)
+        else:
+            if report:
+                report.record_tenant(phase, tenant_id, time.monotonic() - start, retries + 1, False)
+            raise error
+        # the result is applied once, outside of the retries: an error applying it (e.g., a ServiceConfigError for
+        # a key that does not match the tenant's algorithm) is not a failure to retrieve it, and would fail again --
+        if commit:
+            try:
+                commit(tenant_id, result)
+            except Exception as e:
+                logger.error("applying the result of %s for tenant %s failed; e: %s", phase, tenant_id, e)
+                if report:
+                    report.record_tenant(phase, tenant_id, time.monotonic() - start, attempt, False)
+                raise
+        if report:
+            report.record_tenant(phase, tenant_id, time.monotonic() - start, attempt, True)
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_one, tenant_id): tenant_id for tenant_id in tenant_ids}
+        for future in concurrent.futures.as_completed(futures):
+            tenant_id = futures[future]
+            try:
+                results[tenant_id] = future.result()
+            except Exception as e:
+                failures[tenant_id] = e
+    attempts_pool.shutdown(wait=False)
+    return results, failures
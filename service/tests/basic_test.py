@@ -99,6 +99,24 @@ def test_bad_refresh_token_gives_correct_error(client):
     assert response.status_code == 400
 
 
+def test_invalid_put_gives_openapi_error_message(client):
+    response = client.put(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps({"refresh_token": 5}),
+        content_type='application/json'
+    )
+    assert response.status_code == 400
+    assert response.json['message'] == "Invalid PUT data: refresh_token: 5 is not of type 'string'."
+    # a body that is not JSON --
+    response = client.put(
+        "http://localhost:5000/v3/tokens",
+        data="{",
+        content_type='application/json'
+    )
+    assert response.status_code == 400
+    assert response.json['message'].startswith("Invalid PUT data: invalid JSON body:")
+
+
 def test_custom_claims_show_up_in_access_token(client):
     payload = {
         "token_tenant_id": "admin",
@@ -311,4 +329,721 @@ def test_revoke_token(client):
     assert response.status_code == 400
 
 
+def test_revoked_refresh_token_cannot_be_refreshed(client, monkeypatch):
+    from service.revocation import site_router
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "generate_refresh_token": True,
+        "target_site_id": "admin"
+    }
+    response = client.post(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps(payload),
+        content_type='application/json',
+        headers=get_basic_auth_header()
+    )
+    assert response.status_code == 200
+    refresh_token = response.json['result']['refresh_token']['refresh_token']
+
+    # the site-router is not needed to reject the revoked token; only record the call --
+    revoked = []
+    monkeypatch.setattr(site_router, 'revoke', lambda token_str, headers=None: revoked.append(token_str))
+    response = client.post("http://localhost:5000/v3/tokens/revoke", json={"token": refresh_token})
+    assert response.status_code == 200
+    assert revoked == [refresh_token]
+
+    response = client.put(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type='application/json'
+    )
+    assert response.status_code == 400
+    assert response.json['message'] == 'Invalid PUT data: the refresh token has been revoked.'
+
+
+
+
+
+def test_batch_post(client):
+    payload = {
+        "tokens": [
+            {
+                "token_tenant_id": "admin",
+                "account_type": "service",
+                "token_username": "tenants",
+                "target_site_id": "admin",
+                "generate_refresh_token": True
+            },
+            {
+                "token_tenant_id": "admin",
+                "account_type": "service",
+                "token_username": "tenants",
+                "claims": {"test_claim": "here it is!"},
+                "target_site_id": "admin"
+            },
+            # invalid -- missing the required token_username
+            {
+                "token_tenant_id": "admin",
+                "account_type": "service",
+                "target_site_id": "admin"
+            }
+        ]
+    }
+    response = client.post(
+        "http://localhost:5000/v3/tokens/batch",
+        data=json.dumps(payload),
+        content_type='application/json',
+        headers=get_basic_auth_header()
+    )
+    assert response.status_code == 200
+    results = response.json['result']
+    assert len(results) == 3
+    assert results[0]['status'] == 'success'
+    assert "refresh_token" in results[0]['result'].keys()
+    assert results[1]['status'] == 'success'
+    access_token_data = auth.validate_token(results[1]['result']['access_token']['access_token'])
+    assert access_token_data['test_claim'] == "here it is!"
+    assert results[2]['status'] == 'error'
+    assert response.json['metadata']['errors'] == 1
+
+
+def test_batch_post_unexpected_error_fails_only_its_item(client, monkeypatch):
+    from service.controllers import TokensResource
+    generate_tokens = TokensResource.generate_tokens
+
+    def fail_for_bad_claim(validated_body):
+        if getattr(validated_body, 'claims', None):
+            raise ValueError('signing failed')
+        return generate_tokens(validated_body)
+
+    monkeypatch.setattr(TokensResource, 'generate_tokens', staticmethod(fail_for_bad_claim))
+    item = {"token_tenant_id": "admin", "account_type": "service", "token_username": "tenants",
+            "target_site_id": "admin"}
+    payload = {"tokens": [item, dict(item, claims={"test_claim": "fails"})]}
+    response = client.post("http://localhost:5000/v3/tokens/batch", data=json.dumps(payload),
+                           content_type='application/json', headers=get_basic_auth_header())
+    assert response.status_code == 200
+    results = response.json['result']
+    assert results[0]['status'] == 'success'
+    assert results[1]['status'] == 'error'
+    assert results[1]['code'] == 500
+    assert response.json['metadata']['errors'] == 1
+
+
+def test_revoke_tokens_batch(client):
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "generate_refresh_token": True,
+        "target_site_id": "admin"
+    }
+    response = client.post(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps(payload),
+        content_type='application/json',
+        headers=get_basic_auth_header()
+    )
+    assert response.status_code == 200
+    access_token = response.json['result']['access_token']['access_token']
+    refresh_token = response.json['result']['refresh_token']['refresh_token']
+
+    response = client.post(
+        "http://localhost:5000/v3/tokens/revoke/batch",
+        json={"tokens": [access_token, "bad", refresh_token]}
+    )
+    assert response.status_code == 200
+    results = response.json['result']
+    assert [r['status'] for r in results] == ['success', 'error', 'success']
+    assert response.json['metadata']['errors'] == 1
+
+    # the revoked tokens should now be rejected by the site-router
+    check_endpoint = f"{conf.primary_site_admin_tenant_base_url}/v3/site-router/tokens/check"
+    for token in (access_token, refresh_token):
+        response = requests.get(check_endpoint, headers={"x-tapis-token": token})
+        assert response.status_code == 400
+
+
+def test_startup_commit_errors_are_not_retried():
+    from tapisservice.errors import ServiceConfigError
+    from service.startup import StartupReport, run_for_tenants
+    calls = []
+
+    def fetch(tenant_id):
+        calls.append(tenant_id)
+        if len(calls) == 1:
+            raise ValueError('temporary error')
+        return tenant_id
+
+    def commit(tenant_id, result):
+        raise ServiceConfigError('the key does not match the signing algorithm')
+
+    report = StartupReport()
+    results, failures = run_for_tenants(fetch, ['admin'], 'signing_keys', report, retries=2, backoff=0,
+                                        commit=commit)
+    # the fetch error was retried; the commit error was not --
+    assert calls == ['admin', 'admin']
+    assert results == {}
+    assert isinstance(failures['admin'], ServiceConfigError)
+    assert report.tenants['signing_keys']['admin']['attempts'] == 2
+    assert not report.tenants['signing_keys']['admin']['ok']
+
+
+def test_role_members_cache(client, monkeypatch):
+    import types
+    from service import auth as service_auth
+    members = {'alice'}
+    calls = []
+
+    def get_users_with_role(tenant, roleName):
+        calls.append((tenant, roleName))
+        return types.SimpleNamespace(names=list(members))
+
+    monkeypatch.setattr(service_auth, 't', types.SimpleNamespace(sk=types.SimpleNamespace(
+        getUsersWithRole=get_users_with_role)), raising=False)
+    monkeypatch.setattr(conf, 'role_cache_negative_ttl', 60)
+    service_auth.role_members_cache.configure(maxsize=16, ttl=60)
+    cache = service_auth.role_members_cache
+    hits, misses = cache.hits, cache.misses
+    try:
+        # a miss calls the SK; a hit does not --
+        assert service_auth.user_has_role('admin', 'test_role', 'alice')
+        assert service_auth.user_has_role('admin', 'test_role', 'alice')
+        assert len(calls) == 1
+        assert (cache.hits - hits, cache.misses - misses) == (1, 1)
+        # a user who is not in the cached members is denied from the cache while it is younger than
+        # role_cache_negative_ttl --
+        members.add('bob')
+        assert not service_auth.user_has_role('admin', 'test_role', 'bob')
+        assert len(calls) == 1
+        # ... and checked with the SK again once it is older --
+        monkeypatch.setattr(conf, 'role_cache_negative_ttl', 0)
+        assert service_auth.user_has_role('admin', 'test_role', 'bob')
+        assert len(calls) == 2
+        # invalidating the tenant's roles makes the next check call the SK --
+        monkeypatch.setattr(conf, 'role_cache_negative_ttl', 60)
+        members.discard('alice')
+        assert service_auth.invalidate_role_cache('admin') == 1
+        assert not service_auth.user_has_role('admin', 'test_role', 'alice')
+        assert len(calls) == 3
+    finally:
+        service_auth.role_members_cache.configure(maxsize=conf.role_cache_max_size, ttl=conf.role_cache_ttl)
+
+
+def test_service_password_cache(client, monkeypatch):
+    import types
+    import tapipy
+    from tapisservice.errors import AuthenticationError
+    from service import auth as service_auth
+    from service.metrics import upstream_errors
+    calls = []
+
+    def validate_service_password(password, **kwargs):
+        calls.append(password)
+        if password == 'unregistered':
+            raise tapipy.errors.InvalidInputError(msg='service not registered')
+        return types.SimpleNamespace(isAuthorized=password == 'right-password')
+
+    monkeypatch.setattr(service_auth, 't', types.SimpleNamespace(sk=types.SimpleNamespace(
+        validateServicePassword=validate_service_password)), raising=False)
+    monkeypatch.setattr(conf, 'use_allservices_password', False)
+    service_auth.service_password_cache.configure(maxsize=16, ttl=60)
+    service_auth.service_password_negative_cache.configure(maxsize=16, ttl=60)
+    try:
+        # a valid password is checked with the SK once; the cached result skips the SK --
+        service_auth.check_service_password('admin', 'tenants', 'right-password')
+        service_auth.check_service_password('admin', 'tenants', 'right-password')
+        assert calls == ['right-password']
+        # a wrong password is not cached as valid: it is rejected, and the rejection is cached --
+        for _ in range(2):
+            with pytest.raises(AuthenticationError):
+                service_auth.check_service_password('admin', 'tenants', 'wrong-password')
+        assert calls == ['right-password', 'wrong-password']
+        # the SK rejecting the input is cached, and is not counted as an SK error --
+        errors = upstream_errors._samples.get(('sk',), 0)
+        for _ in range(2):
+            with pytest.raises(AuthenticationError):
+                service_auth.check_service_password('admin', 'tenants', 'unregistered')
+        assert calls == ['right-password', 'wrong-password', 'unregistered']
+        assert upstream_errors._samples.get(('sk',), 0) == errors
+    finally:
+        service_auth.init_caches()
+
+
+def test_metrics(client):
+    with client:
+        client.post("http://localhost:5000/v3/tokens")
+        # a valid request, so that the validation phase is recorded whatever tests ran before --
+        payload = {
+            "token_tenant_id": "admin",
+            "account_type": "service",
+            "token_username": "tenants",
+            "target_site_id": "admin"
+        }
+        response = client.post(
+            "http://localhost:5000/v3/tokens",
+            data=json.dumps(payload),
+            content_type='application/json',
+            headers=get_basic_auth_header()
+        )
+        assert response.status_code == 200
+        response = client.get("http://localhost:5000/v3/tokens/metrics")
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        body = response.data.decode('utf-8')
+        assert 'tokens_request_duration_seconds_bucket{route="/v3/tokens",method="POST",status="400"' in body
+        assert 'tokens_phase_duration_seconds_count{phase="validation"}' in body
+        assert 'tokens_cache_hit_ratio{cache="signing_keys"}' in body
+
+
+def test_metrics_require_authentication(client, monkeypatch):
+    monkeypatch.setattr(conf, 'use_sk', True)
+    with client:
+        response = client.get("http://localhost:5000/v3/tokens/metrics")
+        assert response.status_code == 400
+        assert response.json['message'] == 'No Tapis access token found in the request.'
+        monkeypatch.setattr(conf, 'metrics_public', True)
+        response = client.get("http://localhost:5000/v3/tokens/metrics")
+        assert response.status_code == 200
+
+
+def test_signing_key_registry_lazy_loading():
+    import threading
+    import time
+    import types
+    from service.keys import SigningKeyRegistry, generate_keypair
+    registry = SigningKeyRegistry()
+    private_key, _ = generate_keypair('ES256')
+    release = threading.Event()
+    calls = []
+
+    def loader(tenant_id):
+        calls.append(tenant_id)
+        release.wait(5)
+        if len(calls) == 1:
+            raise ValueError('SK unavailable')
+        registry.set_key(tenant_id, private_key, 'ES256', version=1)
+
+    registry.set_loader(loader)
+    tenant = types.SimpleNamespace(tenant_id='dev')
+    # a failed load is not cached; the next request loads the key again --
+    release.set()
+    with pytest.raises(ValueError):
+        registry.get_key(tenant)
+    release.clear()
+    # concurrent requests for a tenant without a key share one load --
+    keys = []
+    threads = [threading.Thread(target=lambda: keys.append(registry.get_key(tenant))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ['dev', 'dev']
+    assert len(keys) == 5 and all(key is keys[0] for key in keys)
+    # the key is now served from the registry --
+    assert registry.get_key(tenant) is keys[0]
+    stats = registry.stats()
+    assert (stats['hits'], stats['misses']) == (1, 6)
+    assert (stats['loads'], stats['load_failures'], stats['reloads']) == (1, 1, 1)
+    # a rotation replaces the key --
+    registry.set_key('dev', private_key, 'ES256', version=2)
+    assert registry.get_key(tenant).version == 2
+    assert registry.stats()['reloads'] == 2
+
+
+def test_pooled_signer():
+    import jwt
+    from service.errors import SigningUnavailableError
+    from service.keys import SigningKeyRegistry, generate_keypair
+    from service.signing import PooledSigner
+    registry = SigningKeyRegistry()
+    # forked workers do not import the service modules again, which would retrieve the tenants --
+    signer = PooledSigner(workers=1, max_pending=1, queue_timeout=0.05, timeout=30, start_method='fork',
+                          registry=registry)
+    claims = {'jti': 'abc', 'sub': 'testuser1@dev', 'exp': 4102444800}
+    try:
+        # the pool is started with the keys of the registry --
+        private_key, public_key = generate_keypair('EdDSA')
+        key = registry.set_key('dev', private_key, 'EdDSA')
+        assert jwt.decode(signer.sign(claims, key), public_key, algorithms=['EdDSA']) == claims
+        assert signer.stats()['key_misses'] == 0
+        # the worker does not have a rotated key: it misses it and the request is sent again with the PEM --
+        private_key, public_key = generate_keypair('EdDSA')
+        key = registry.set_key('dev', private_key, 'EdDSA')
+        assert jwt.decode(signer.sign(claims, key), public_key, algorithms=['EdDSA']) == claims
+        assert signer.stats()['key_misses'] == 1
+        # the worker now has the rotated key --
+        signer.sign(claims, key)
+        assert signer.stats()['key_misses'] == 1
+        # with max_pending requests in flight, the next one is rejected with a 503 after queue_timeout --
+        assert signer._slots.acquire(timeout=1)
+        try:
+            with pytest.raises(SigningUnavailableError) as e:
+                signer.sign(claims, key)
+            assert e.value.code == 503
+        finally:
+            signer._slots.release()
+        assert signer.stats()['rejected'] == 1
+        assert signer.stats()['submitted'] == 3
+    finally:
+        signer.shutdown()
+
+
+def test_validate_token_locally(client, monkeypatch):
+    import time
+    import jwt
+    from tapisservice.errors import AuthenticationError
+    from service import auth as service_auth, tenants
+    from service.keys import signing_keys
+    from service.signing import tapis_encode
+    claims = {'jti': 'abc', 'sub': 'testuser1@admin', 'tapis/tenant_id': 'admin', 'tapis/token_type': 'refresh',
+              'exp': int(time.time()) + 300}
+    key = signing_keys.get_key(tenants.get_tenant_config(tenant_id='admin'))
+    # tokens of the tenants served by this Tokens API are verified with the tenant's key --
+    assert service_auth.validate_token_locally(tapis_encode(claims, key), token_type='refresh') == claims
+    # a token whose alg header does not match the tenant's algorithm is rejected, even if its signature is valid
+    # for that alg --
+    with pytest.raises(AuthenticationError) as e:
+        service_auth.validate_token_locally(jwt.encode(claims, 'not-the-key', algorithm='HS256'))
+    assert e.value.msg == 'Invalid Tapis token.'
+    # tokens of other tenants are validated remotely --
+    remote = []
+
+    def validate_token(token_str):
+        remote.append(token_str)
+        return {'tapis/tenant_id': 'other-tenant'}
+
+    monkeypatch.setattr(service_auth.auth, 'validate_token', validate_token)
+    other_token = tapis_encode(dict(claims, **{'tapis/tenant_id': 'other-tenant'}), key)
+    assert service_auth.validate_token_locally(other_token) == {'tapis/tenant_id': 'other-tenant'}
+    assert remote == [other_token]
+
+
+def test_elliptic_curve_signing_algorithms():
+    import jwt
+    from service.keys import SigningKey, generate_keypair
+    from service.signing import tapis_encode
+    claims = {'jti': 'abc', 'sub': 'testuser1@dev', 'tapis/tenant_id': 'dev', 'exp': 4102444800}
+    for alg in ('ES256', 'EdDSA'):
+        private_key, public_key = generate_keypair(alg)
+        key = SigningKey('dev', private_key, alg)
+        token = tapis_encode(claims, key)
+        assert jwt.get_unverified_header(token) == {'alg': alg, 'typ': 'JWT'}
+        # the token verifies with the generated public key and with the one derived from the private key --
+        assert jwt.decode(token, public_key, algorithms=[alg]) == claims
+        assert jwt.decode(token, key.public_key, algorithms=[alg]) == claims
+
+
+def test_signing_key_must_match_algorithm():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from tapisservice.errors import ServiceConfigError
+    from service.keys import SigningKey, generate_keypair
+
+    def pem(private_key):
+        return private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                         format=serialization.PrivateFormat.PKCS8,
+                                         encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+    rsa_key = pem(rsa.generate_private_key(public_exponent=65537, key_size=2048))
+    p384_key = pem(ec.generate_private_key(ec.SECP384R1()))
+    es256_key, _ = generate_keypair('ES256')
+    for private_key, alg in ((rsa_key, 'ES256'), (rsa_key, 'EdDSA'), (p384_key, 'ES256'), (es256_key, 'RS256'),
+                             (es256_key, 'EdDSA')):
+        with pytest.raises(ServiceConfigError) as e:
+            SigningKey('dev', private_key, alg)
+        assert f'cannot sign {alg} tokens' in e.value.msg
+
+
+def test_server_timing(client, monkeypatch):
+    from service.profiling import format_server_timing
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "target_site_id": "admin"
+    }
+    with client:
+        response = client.post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                               content_type='application/json', headers=get_basic_auth_header())
+        assert response.status_code == 200
+        assert 'Server-Timing' not in response.headers
+        monkeypatch.setattr(conf, 'server_timing_enabled', True)
+        response = client.post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                               content_type='application/json', headers=get_basic_auth_header())
+        assert response.status_code == 200
+        phases = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+        for phase in ('authn_and_authz', 'validation', 'sign_token', 'total'):
+            assert phase in phases
+    # phases recorded more than once are summed --
+    assert format_server_timing([('sk', 0.001), ('sign_token', 0.002), ('sk', 0.003)], total=0.01) == \
+        'sk;dur=4.00, sign_token;dur=2.00, total;dur=10.00'
+
+
+def test_request_profiler_sampling(tmp_path):
+    import time
+    from service.profiling import RequestProfiler
+    profiler = RequestProfiler(sample_rate=0, directory=str(tmp_path), dump_every=2)
+    assert profiler.start() is None
+    profiler.set_sample_rate(1)
+    profile = profiler.start()
+    assert profile is not None
+    # only one request is profiled at a time --
+    assert profiler.start() is None
+    profiler.stop(profile)
+    profiler.stop(profiler.start())
+    assert (profiler.profiled, profiler.skipped, profiler.dumps) == (2, 1, 1)
+    assert (tmp_path / f'tokens-{profiler.stats()["pid"]}.prof').exists()
+    # a rate set for a limited time reverts to the configured rate --
+    profiler.set_sample_rate(1, duration=0.01)
+    time.sleep(0.02)
+    assert profiler.start() is None
+    assert profiler.sample_rate == 0
+
+
+def test_token_slots_and_claims_templates(client):
+    from service.models import ACCESS_TOKEN_CLAIM, TENANT_ID_CLAIM, AccessTokenData, TapisAccessToken, \
+        TapisRefreshToken, get_claims_template
+    data = AccessTokenData(jti=None, token_tenant_id='admin', token_username='testuser1', account_type='user')
+    data.claims = {'custom': 'value'}
+    access_token = TapisAccessToken(**TapisAccessToken.get_derived_values(data))
+    # the tokens have no instance dict --
+    assert not hasattr(access_token, '__dict__')
+    with pytest.raises(AttributeError):
+        access_token.unknown_attribute = 1
+    access_token.sign_token()
+    # the claims are a copy of the template shared by the tokens of the same type, tenant and account type, with
+    # the same keys, in the same order, and the interned claim names --
+    template = get_claims_template('access', 'admin', access_token.iss, 'user')
+    assert template is get_claims_template('access', 'admin', access_token.iss, 'user')
+    assert list(access_token.claims)[:len(template)] == list(template)
+    assert next(name for name in access_token.claims if name == 'tapis/tenant_id') is TENANT_ID_CLAIM
+    assert access_token.claims['custom'] == 'value'
+    # building the claims did not modify the template --
+    assert template['jti'] is None and 'custom' not in template
+    # the refresh token is built from the claims the access token was signed with --
+    refresh_token = TapisRefreshToken.from_access_token(access_token, compact=False)
+    assert not hasattr(refresh_token, '__dict__')
+    expected = {name: value for name, value in access_token.claims.items() if not name == 'exp'}
+    expected['ttl'] = access_token.ttl
+    assert refresh_token.access_token == expected
+    assert refresh_token.claims_to_dict()[ACCESS_TOKEN_CLAIM] is refresh_token.access_token
+
+
+def test_tapis_encoder_matches_pyjwt(client):
+    import datetime
+    from service.keys import signing_keys
+    from service.signing import pyjwt_encode, tapis_encode
+    exp = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=300)
+    claims = {'jti': 'abc', 'iss': 'https://dev.develop.tapis.io/v3/tokens', 'sub': 'testuser1@dev',
+              'tapis/delegation': False, 'tapis/delegation_sub': None, 'exp': exp,
+              'custom': {'list': [1, 'two', None], 'unicode': 'café', 'big': 2 ** 70}}
+    for key in signing_keys.keys():
+        header_and_payload = tapis_encode(claims, key).rsplit('.', 1)[0]
+        # ES256 signatures are randomized; the header and payload must still be identical --
+        assert header_and_payload == pyjwt_encode(claims, key).rsplit('.', 1)[0]
+        if not key.alg == 'ES256':
+            assert tapis_encode(claims, key) == pyjwt_encode(claims, key)
+
+
+def test_tapis_encoder_orjson_claims_match_pyjwt(client):
+    import datetime
+    import orjson
+    from service.keys import signing_keys
+    from service.signing import dumps_claims, pyjwt_encode, tapis_encode
+    exp = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=300)
+    # ASCII strings, integers, booleans and None only: serialized by orjson --
+    plain_claims = {'jti': 'abc', 'sub': 'testuser1@dev', 'tapis/delegation': False, 'tapis/delegation_sub': None,
+                    'exp': 1700000000, 'custom': {'list': [1, 'two', None], 'nested': {'ok': True}}}
+    assert dumps_claims(plain_claims) == orjson.dumps(plain_claims)
+    # floats are serialized with the json module, as PyJWT does --
+    float_claims = {'small': 1e-7, 'big': 1e16, 'nan': float('nan'), 'inf': float('inf'), 'pi': 3.14}
+    for claims in (plain_claims, float_claims):
+        for key in signing_keys.keys():
+            token = tapis_encode(dict(claims, exp=exp), key)
+            assert token.rsplit('.', 1)[0] == pyjwt_encode(dict(claims, exp=exp), key).rsplit('.', 1)[0]
+    # values PyJWT cannot serialize are rejected the same way --
+    with pytest.raises(TypeError):
+        dumps_claims({'exp': exp, 'custom': {'issued': exp}})
+
+
+@pytest.fixture
+def migrated_db():
+    """
+    Apply the database migrations (service/migrations) to the test database, as make migrate.upgrade does.
+    """
+    from flask_migrate import upgrade
+    from service import migrate
+    with app.app_context():
+        upgrade(directory=migrate.directory)
+
+
+def test_compact_refresh_token(client, migrated_db, monkeypatch):
+    monkeypatch.setattr(conf, 'compact_refresh_tokens', True)
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "generate_refresh_token": True,
+        "claims": {"test_claim": "here it is!"},
+        "target_site_id": "admin"
+    }
+    response = client.post(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps(payload),
+        content_type='application/json',
+        headers=get_basic_auth_header()
+    )
+    assert response.status_code == 200
+    refresh_token = response.json['result']['refresh_token']['refresh_token']
+
+    # the refresh token only carries its own claims --
+    refresh_token_data = auth.validate_token(refresh_token)
+    assert 'tapis/access_token' not in refresh_token_data
+    assert 'test_claim' not in refresh_token_data
+
+    # the access token is rebuilt from the refresh token store, custom claims included --
+    response2 = client.put(
+        "http://localhost:5000/v3/tokens",
+        data=json.dumps({"refresh_token": refresh_token}),
+        content_type='application/json'
+    )
+    assert response2.status_code == 200
+    access_token_data2 = auth.validate_token(response2.json['result']['access_token']['access_token'])
+    assert access_token_data2['test_claim'] == "here it is!"
+
+
+def test_issuance_ledger(client, migrated_db):
+    import time
+    from service import db
+    from service.ledger import IssuanceLedger
+    from service.models import IssuanceRecord
+    ledger = IssuanceLedger(enabled=True, batch_size=2, flush_interval=0.1)
+    ledger.start(app)
+    for jti in ('ledger-test-1', 'ledger-test-2', 'ledger-test-3'):
+        ledger.add_claims('revoke', {'jti': jti, 'sub': 'ledger-test@admin', 'tapis/tenant_id': 'admin',
+                                     'tapis/token_type': 'access', 'tapis/account_type': 'user',
+                                     'exp': int(time.time()) + 60})
+    ledger.stop()
+    with app.app_context():
+        records = ledger.find_by_sub('ledger-test@admin', tenant_id='admin')
+        assert {'ledger-test-1', 'ledger-test-2', 'ledger-test-3'} <= {r.jti for r in records}
+        IssuanceRecord.query.filter_by(sub='ledger-test@admin').delete()
+        db.session.commit()
+
+
+def test_idempotency_key(client):
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "target_site_id": "admin"
+    }
+    headers = dict(get_basic_auth_header(), **{'Idempotency-Key': 'test-idempotency-key'})
+    response = client.post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                           content_type='application/json', headers=headers)
+    assert response.status_code == 200
+    response2 = client.post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                            content_type='application/json', headers=headers)
+    assert response2.status_code == 200
+    # the same token is returned --
+    assert response.json['result']['access_token']['jti'] == response2.json['result']['access_token']['jti']
+
+    # the key cannot be used for a different request --
+    payload['access_token_ttl'] = 600
+    response3 = client.post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                            content_type='application/json', headers=headers)
+    assert response3.status_code == 422
+
+
+def test_concurrent_idempotent_requests_sign_once(client, monkeypatch):
+    import threading
+    import time
+    from service.controllers import TokensResource
+    payload = {
+        "token_tenant_id": "admin",
+        "account_type": "service",
+        "token_username": "tenants",
+        "target_site_id": "admin"
+    }
+    headers = dict(get_basic_auth_header(), **{'Idempotency-Key': 'test-concurrent-idempotency-key'})
+    generate_tokens = TokensResource.generate_tokens
+    calls = []
+
+    def slow_generate_tokens(validated_body):
+        calls.append(validated_body)
+        time.sleep(0.2)
+        return generate_tokens(validated_body)
+
+    monkeypatch.setattr(TokensResource, 'generate_tokens', staticmethod(slow_generate_tokens))
+    jtis = []
+
+    def post():
+        response = app.test_client().post("http://localhost:5000/v3/tokens", data=json.dumps(payload),
+                                          content_type='application/json', headers=headers)
+        assert response.status_code == 200
+        jtis.append(response.json['result']['access_token']['jti'])
+
+    threads = [threading.Thread(target=post) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # only the first request signed tokens; the others waited for it and got its tokens --
+    assert len(calls) == 1
+    assert len(jtis) == 5
+    assert len(set(jtis)) == 1
+
+
+def test_key_propagation(client, monkeypatch):
+    import tempfile
+    import time
+    from service import auth as service_auth
+    from service.key_propagation import DirectoryKeyChannel, KeyPropagator, LocalKeyChannel
+    from service.keys import signing_keys
+
+    def wait_for(condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    received = []
+    channel = DirectoryKeyChannel(tempfile.mkdtemp(), poll_interval=0.05)
+    channel.start(lambda tenant_id, version: received.append((tenant_id, version)))
+    try:
+        channel.publish('admin', 7)
+        assert wait_for(lambda: received)
+        # unchanged files are not delivered again --
+        time.sleep(0.2)
+        assert received == [('admin', 7)]
+    finally:
+        channel.stop()
+
+    # a test tenant, with a copy of one of the registry's keys at version 1 --
+    key = signing_keys.keys()[0]
+    signing_keys.set_key('propagation-test', key.private_key_pem, key.alg, version=1)
+    loads = []
+
+    def load_signing_key_from_sk(tenant_id):
+        loads.append(tenant_id)
+        signing_keys.set_key(tenant_id, key.private_key_pem, key.alg, version=2)
 
+    monkeypatch.setattr(conf, 'use_sk', True)
+    monkeypatch.setattr(service_auth, 'load_signing_key_from_sk', load_signing_key_from_sk)
+    channel = LocalKeyChannel()
+    propagator = KeyPropagator(channel, retries=0)
+    propagator.start()
+    try:
+        # versions that are not newer than the registry's are ignored; newer ones are loaded from the SK --
+        channel.publish('propagation-test', 1)
+        channel.publish('propagation-test', 2)
+        assert wait_for(lambda: signing_keys.get_version('propagation-test') == 2)
+        assert loads == ['propagation-test']
+    finally:
+        propagator.stop()
+        signing_keys.remove_key('propagation-test')
@@ -0,0 +1,103 @@
+import json
+import os
+from types import SimpleNamespace
+
+import yaml
+from flask import request
+from openapi_schema_validator import OAS30Validator, oas30_format_checker
+from werkzeug.exceptions import HTTPException
+
+from tapisservice import errors
+
+from service.metrics import time_phase
+
+# get the logger instance -
+from service.logs import get_logger
+logger = get_logger(__name__)
+
+
+SPEC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'openapi_v3.yml')
+
+
+def load_component_schemas(spec_path=SPEC_PATH):
+    """
+    Load the component schemas from the Tokens API OpenAPI spec.
+    :return: dict mapping schema name to its (jsonschema-compatible) definition.
+    """
+    with open(spec_path, 'r') as f:
+        spec = yaml.safe_load(f)
+    return spec['components']['schemas']
+
+
+class BodyValidator(object):
+    """
+    Validates a parsed JSON object against one of the component schemas in the OpenAPI spec. The validator is
+    compiled once, when the module is imported, and validates the already-parsed request JSON in a single pass;
+    free-form objects, such as the `claims` of a NewTokenRequest, are validated natively.
+    Schemas are validated with the same OpenAPI 3.0 validator openapi-core used. Invalid data is reported with one
+    message per schema error, prefixed by the path of the invalid property.
+    """
+    def __init__(self, schema_name, schemas, flask_parse_errors=False):
+        """
+        :param schema_name: (str) the name of the component schema.
+        :param schemas: (dict) the component schemas of the spec.
+        :param flask_parse_errors: (bool) report bodies that are not JSON with the message of flask's exception, as
+                                   the POST /v3/tokens endpoint always has.
+        """
+        self.schema_name = schema_name
+        self.schema = schemas[schema_name]
+        self.flask_parse_errors = flask_parse_errors
+        self.validator = OAS30Validator(self.schema, format_checker=oas30_format_checker, write=True)
+
+    def validate(self, data, method='POST'):
+        """
+        Validate `data` and return it as an object with an attribute for each property present in the data,
+        matching the validated body objects returned by openapi-core.
+        Raises errors.ResourceError if the data is invalid.
+        :param data: the parsed JSON body.
+        :param method: (str) the HTTP method, used in error messages.
+        """
+        with time_phase('validation'):
+            errs = tuple(self.validator.iter_errors(data))
+        if errs:
+            messages = []
+            for e in errs:
+                path = '.'.join(str(p) for p in e.absolute_path)
+                messages.append(f'{path}: {e.message}' if path else e.message)
+            raise errors.ResourceError(msg=f'Invalid {method} data: {"; ".join(messages)}.')
+        return SimpleNamespace(**data)
+
+    def validate_request(self):
+        """
+        Validate the JSON body of the current flask request.
+        """
+        method = request.method
+        if self.flask_parse_errors:
+            try:
+                data = request.get_json()
+            except HTTPException as e:
+                raise errors.ResourceError(msg=f'Invalid {method} data: {e}.')
+            return self.validate(data, method)
+        body = request.get_data(as_text=True)
+        if not body:
+            error = 'the request body is missing'
+        elif not request.mimetype == 'application/json':
+            error = f'unsupported media type {request.mimetype!r}; the body must be application/json'
+        else:
+            try:
+                data = json.loads(body)
+            except ValueError as e:
+                error = f'invalid JSON body: {e}'
+            else:
+                return self.validate(data, method)
+        raise errors.ResourceError(msg=f'Invalid {method} data: {error}.')
+
+
+_schemas = load_component_schemas()
+
+new_token_request_validator = BodyValidator('NewTokenRequest', _schemas, flask_parse_errors=True)
+refresh_token_request_validator = BodyValidator('RefreshTokenRequest', _schemas)
+revoke_token_request_validator = BodyValidator('RevokeTokenRequest', _schemas)
+revoke_tokens_batch_request_validator = BodyValidator('RevokeTokensBatchRequest', _schemas)
+new_signing_keys_request_validator = BodyValidator('NewSigningKeysRequest', _schemas)
+profiling_request_validator = BodyValidator('ProfilingRequest', _schemas)